@@ -1,2 +1,6 @@
 # python -m pip install -r requirements.txt
-# python version = Python 3.13.7
\ No newline at end of file
+# python version = Python 3.13.7
+# development server:  python app.py
+# production server:   uvicorn asgi:app --host 0.0.0.0 --port 5000
+# prebuild the food index (otherwise built on first start): python food_db.py build
+# load test against a mock ERNIE: python bench/load_bench.py [--server flask] [--compare bench/results/<earlier>.json]
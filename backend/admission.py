@@ -0,0 +1,239 @@
+"""Admission control: per-user and per-IP rate limits, priority scheduling of
+upstream calls per model, and early load shedding.
+
+Both servers check every request against AdmissionController.admit() before
+handling it. Upstream calls then wait for a slot in their model's
+PriorityLimiter, where food analyses go ahead of chat and chat ahead of meal
+plans. When too many calls are already waiting, new requests of the lower
+classes are turned away at once with a Retry-After instead of queueing
+until they time out.
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from errors import ServiceError
+
+# Lower runs first
+PRIORITIES = {"analyze": 0, "chat": 1, "meal_plan": 2}
+
+# Request paths that are admission controlled, and the class each belongs to
+ROUTE_CLASSES = {
+    "/analyze": "analyze",
+    "/analyze/batch": "analyze",
+    "/chat": "chat",
+    "/generate-meal-plan": "meal_plan",
+    "/generate-meal-plan/range": "meal_plan",
+    "/jobs": "jobs",
+}
+
+
+class RateLimited(ServiceError):
+    def __init__(self, message, retry_after, status=429):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
+class Overloaded(RateLimited):
+    def __init__(self, message, retry_after):
+        super().__init__(message, retry_after, status=503)
+
+
+class RateLimiter:
+    """Token buckets keyed by client: `rate` requests per second, bursts of up to `burst`.
+
+    Only the `max_keys` most recently seen clients are tracked; a client
+    that was evicted starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_keys=100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+        self.limited = 0
+
+    def take(self, key):
+        """Spend a token for `key`; return 0 if there was one, else seconds until there will be"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                self.limited += 1
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        return {"clients": len(self._buckets), "limited": self.limited}
+
+
+class PriorityLimiter:
+    """At most `limit` concurrent holders; waiters are let in by priority, then arrival.
+
+    Raises Overloaded instead of queueing once `max_waiting` are waiting.
+    Keeps a moving average of how long a slot is held, to estimate waits.
+    Used from one event loop.
+    """
+
+    def __init__(self, limit, max_waiting=1000):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.hold_seconds = None
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def waiting(self, priority=None):
+        """Waiters ahead of a new one at `priority` (all of them by default)"""
+        return sum(1 for p, _, future in self._waiters
+                   if not future.done() and (priority is None or p <= priority))
+
+    def expected_wait(self, priority=None):
+        """Rough seconds a new waiter at `priority` would wait for a slot"""
+        if self.active < self.limit and not self.waiting():
+            return 0.0
+        return (self.waiting(priority) + 1) * (self.hold_seconds or 1.0) / self.limit
+
+    def try_acquire(self):
+        """Take a free slot without waiting; False if there is none (or someone is already waiting)"""
+        if self.active < self.limit and not self.waiting():
+            self.active += 1
+            return True
+        return False
+
+    async def acquire(self, priority):
+        self.admitted += 1
+        if self.active < self.limit and not self.waiting():
+            self.active += 1
+            return
+        if self.waiting() >= self.max_waiting:
+            self.rejected += 1
+            raise Overloaded("The service is busy, please try again shortly", retry_after(self.expected_wait(priority)))
+
+        self.queued += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the waiter gave up
+                self.release()
+            raise
+
+    def release(self):
+        """Hand the slot to the most urgent waiter, or free it"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority):
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            self.hold_seconds = held if self.hold_seconds is None else 0.9 * self.hold_seconds + 0.1 * held
+            self.release()
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting(),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionController:
+    """Decides, before any work is done, whether a request may proceed.
+
+    A request spends a token from its user's bucket (when a trusted proxy
+    names the user) and from its IP's bucket. It is then shed if the upstream calls already
+    waiting, as reported by `backlog()`, exceed its class's share of
+    `max_queue`; `shed_shares` gives lower classes smaller shares so they are
+    turned away first. `expected_wait()` estimates the Retry-After.
+    """
+
+    def __init__(self, user_limiter, ip_limiter, backlog, expected_wait, max_queue=200,
+                 shed_shares=None, enabled=True):
+        self.user_limiter = user_limiter
+        self.ip_limiter = ip_limiter
+        self.backlog = backlog
+        self.expected_wait = expected_wait
+        self.max_queue = max_queue
+        self.shed_shares = shed_shares or {"analyze": 1.0, "chat": 0.75, "meal_plan": 0.5}
+        self.enabled = enabled
+
+        self.shed = {}
+
+    def admit(self, route_class, user=None, ip=None):
+        """Raise RateLimited (429) or Overloaded (503) if the request should not run"""
+        if not self.enabled or route_class is None:
+            return
+        for limiter, key, who in ((self.user_limiter, user, "user"), (self.ip_limiter, ip, "address")):
+            if limiter is None or not key:
+                continue
+            wait = limiter.take(key)
+            if wait:
+                raise RateLimited(f"Too many requests from this {who}, please slow down", retry_after(wait))
+
+        share = self.shed_shares.get(route_class)
+        if share is not None and self.backlog() >= share * self.max_queue:
+            self.shed[route_class] = self.shed.get(route_class, 0) + 1
+            raise Overloaded(
+                "The service is busy, please try again shortly",
+                retry_after(self.expected_wait(PRIORITIES.get(route_class))),
+            )
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "backlog": self.backlog(),
+            "max_queue": self.max_queue,
+            "shed": dict(self.shed),
+            "user": self.user_limiter.stats() if self.user_limiter else None,
+            "ip": self.ip_limiter.stats() if self.ip_limiter else None,
+        }
+
+
+def retry_after(seconds):
+    """Whole seconds for a Retry-After header, between 1 and 60"""
+    return min(60, max(1, math.ceil(seconds or 0)))
+
+
+def client_user(user_id, trust_proxy=False):
+    """The X-User-Id a trusted proxy vouches for; a client could send any value itself"""
+    return user_id if trust_proxy else None
+
+
+def client_ip(remote_addr, forwarded_for=None, trust_proxy=False):
+    """The client's address: the first X-Forwarded-For hop when behind a trusted proxy"""
+    if trust_proxy and forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return remote_addr
@@ -1,542 +1,242 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from openai import OpenAI
-import json
+from werkzeug.exceptions import RequestEntityTooLarge
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+import services
+from admission import ROUTE_CLASSES, client_ip, client_user
+from async_bridge import background_loop, iterate_sync, run_sync
+from errors import ServiceError
+from uploads import read_bounded
+
+# Largest decoded image accepted by /analyze. Request bodies may be up to a third larger
+# to fit the base64 JSON form; Flask rejects anything bigger before parsing it.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 15 * 1024 * 1024))
+
+MAX_BODY_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+# Batches carry several photos, so they get a larger overall body limit
+MAX_BATCH_BODY_BYTES = int(os.environ.get("MAX_BATCH_BODY_BYTES", 4 * MAX_BODY_BYTES))
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
 CORS(app)
 
-# Initialize OpenAI-compatible client for Baidu Studio
-client = OpenAI(
-    api_key="333e7636d5248dbf9dc3f237e4bc9e5c69157228",
-    base_url="https://aistudio.baidu.com/llm/lmapi/v3"
-)
+# The handlers below are thin sync wrappers: the work itself happens in the async
+# `services` module, run on a shared background event loop. See asgi.py for the
+# production server that awaits the same coroutines directly.
 
-def analyze_image_with_ernie(image_base64, additional_context="", lang="en"):
-    """Analyze food image directly using ERNIE vision model"""
-    try:
-        if lang == "zh":
-            # Pure Chinese prompt
-            base_prompt = """你是一位专业的营养分析专家，擅长解读中国食品包装标签。请仔细分析这张食品图片，从营养成分表中提取准确的营养数据。"""
-            
-            if additional_context:
-                base_prompt += f"\n\n用户补充说明：{additional_context}"
-            
-            prompt = base_prompt + """
-
-📋 分析步骤：
-1. 在包装上找到"营养成分表"区域
-2. 定位"每100克"或"每份"的标注
-3. 精确提取以下营养成分的数值：
-   • 能量（千焦kJ）→ 需换算为千卡kcal（除以4.184）
-   • 蛋白质（克）
-   • 脂肪（克）
-   • 碳水化合物（克）
-   • 钠（毫克）
-   • 膳食纤维（克，如有标注）
-   • 糖（克，如有标注）
-
-4. 识别产品信息：
-   • 产品中文名称
-   • 食品类别（调味料/零食/饮料/主食等）
-   • 包装上的所有可见文字
-
-📤 输出要求：
-请严格按照以下JSON格式返回，所有字段必须用中文填写：
-
-{
-  "name": "产品完整中文名称",
-  "category": "食品类别",
-  "calories": 整数（千卡，从能量字段换算），
-  "protein": 整数（克），
-  "carbs": 整数（克），
-  "fats": 整数（克），
-  "fiber": 整数（克，无标注则填0），
-  "sugar": 整数（克，无标注则填0），
-  "sodium": 整数（毫克），
-  "serving_size": "每100克 或 实际标注的份量",
-  "confidence": "高/中/低",
-  "benefits": ["健康益处1", "健康益处2", "健康益处3"],
-  "considerations": ["注意事项1", "注意事项2"],
-  "explanation": "你的分析依据和计算说明",
-  "detected_text": "包装上所有可见的中文文字"
-}
-
-⚠️ 重要规则：
-• 必须从营养成分表中读取数值，不可估算
-• 能量单位如为千焦（kJ），必须换算为千卡（kcal = kJ ÷ 4.184）
-• 所有数值四舍五入为整数
-• 如果营养成分表中没有膳食纤维或糖的数据，填写0
-• 只输出JSON格式，不要添加任何其他文字或符号"""
-
-        else:
-            # Pure English prompt
-            base_prompt = """You are a professional nutrition analysis expert specializing in reading Chinese food packaging labels. Carefully analyze this food image and extract accurate nutritional data from the nutrition facts table."""
-            
-            if additional_context:
-                base_prompt += f"\n\nUser Context: {additional_context}"
-            
-            prompt = base_prompt + """
-
-📋 Analysis Steps:
-1. Locate the "营养成分表" (Nutrition Facts Table) on the package
-2. Find the section marked "每100克" (per 100g) or "每份" (per serving)
-3. Extract exact values for these nutritional components:
-   • 能量 (Energy in kJ) → Convert to kcal by dividing by 4.184
-   • 蛋白质 (Protein in grams)
-   • 脂肪 (Fat in grams)
-   • 碳水化合物 (Carbohydrates in grams)
-   • 钠 (Sodium in mg)
-   • 膳食纤维 (Dietary Fiber in grams, if listed)
-   • 糖 (Sugar in grams, if listed)
-
-4. Identify product information:
-   • Product name (translate to English)
-   • Food category
-   • All visible text on the packaging
-
-📤 Output Format:
-Provide your response in this exact JSON structure:
-
-{
-  "name": "Product name in English",
-  "category": "Food category (Seasoning/Snack/Beverage/Meal/etc.)",
-  "calories": integer (kcal - converted from 能量/kJ),
-  "protein": integer (grams from 蛋白质),
-  "carbs": integer (grams from 碳水化合物),
-  "fats": integer (grams from 脂肪),
-  "fiber": integer (grams from 膳食纤维, use 0 if not listed),
-  "sugar": integer (grams from 糖, use 0 if not listed),
-  "sodium": integer (mg from 钠),
-  "serving_size": "per 100g or the actual serving size stated",
-  "confidence": "high/medium/low",
-  "benefits": ["health benefit 1", "health benefit 2", "health benefit 3"],
-  "considerations": ["dietary consideration 1", "consideration 2"],
-  "explanation": "Your analysis rationale and calculation details",
-  "detected_text": "All Chinese text visible on the packaging"
-}
-
-⚠️ Critical Rules:
-• Extract values ONLY from the nutrition facts table, do not estimate
-• If energy is in kJ (千焦), convert to kcal by dividing by 4.184
-• Round all numerical values to the nearest integer
-• If fiber or sugar is not listed in the table, use 0
-• Output ONLY valid JSON with no additional text or formatting"""
-
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
-                        }
-                    }
-                ]
-            }
-        ]
-        
-        response = client.chat.completions.create(
-            model="ernie-5.0-thinking-preview",
-            messages=messages,
-            max_completion_tokens=4096,
-            stream=False
-        )
-
-        if response.choices and len(response.choices) > 0:
-            result_text = response.choices[0].message.content.strip()
-            
-            # Extract JSON from response
-            start_idx = result_text.find('{')
-            end_idx = result_text.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx > start_idx:
-                json_str = result_text[start_idx:end_idx]
-                nutrition_data = json.loads(json_str)
-                return nutrition_data
-            else:
-                raise Exception("Could not parse JSON from ERNIE response")
-        else:
-            raise Exception("No response from ERNIE")
-            
-    except json.JSONDecodeError as e:
-        raise Exception(f"JSON parsing error: {str(e)}")
-    except Exception as e:
-        raise Exception(f"ERNIE Vision Analysis Error: {str(e)}")
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
 
-def analyze_text_with_ernie(description, lang="en"):
-    """Analyze food description using ERNIE text model"""
+@app.before_request
+def admit_request():
+    """Rate limit and shed load before the handler runs; see admission.py"""
+    if request.url_rule is None or request.method == 'OPTIONS':
+        return None
     try:
-        if lang == "zh":
-            prompt = f"""你是一位专业的营养分析专家。请根据以下食物描述，提供详细的营养信息估算。
-
-📝 食物描述：
-{description}
-
-📤 请严格按照以下JSON格式返回：
-
-{{
-  "name": "食物名称",
-  "category": "食品类别",
-  "calories": 整数（每份千卡）,
-  "protein": 整数（每份克）,
-  "carbs": 整数（每份克）,
-  "fats": 整数（每份克）,
-  "fiber": 整数（每份克）,
-  "sugar": 整数（每份克）,
-  "sodium": 整数（每份毫克）,
-  "serving_size": "份量描述",
-  "confidence": "高/中/低",
-  "benefits": ["健康益处1", "健康益处2", "健康益处3"],
-  "considerations": ["注意事项1", "注意事项2"],
-  "explanation": "营养分析的依据和说明"
-}}
-
-⚠️ 只输出JSON格式，不要添加任何其他内容。"""
-
-        else:
-            prompt = f"""You are a professional nutrition analysis expert. Based on the following food description, provide detailed nutritional information estimates.
-
-📝 Food Description:
-{description}
-
-📤 Provide your response in this exact JSON format:
-
-{{
-  "name": "Food name",
-  "category": "Food category",
-  "calories": integer (kcal per serving),
-  "protein": integer (grams per serving),
-  "carbs": integer (grams per serving),
-  "fats": integer (grams per serving),
-  "fiber": integer (grams per serving),
-  "sugar": integer (grams per serving),
-  "sodium": integer (mg per serving),
-  "serving_size": "serving size description",
-  "confidence": "high/medium/low",
-  "benefits": ["health benefit 1", "health benefit 2", "health benefit 3"],
-  "considerations": ["dietary consideration 1", "consideration 2"],
-  "explanation": "Brief rationale for the nutritional analysis"
-}}
-
-⚠️ Output ONLY valid JSON with no additional text."""
-
-        messages = [
-            {"role": "user", "content": prompt}
-        ]
-        
-        response = client.chat.completions.create(
-            model="ernie-5.0-thinking-preview",
-            messages=messages,
-            max_completion_tokens=2048,
-            stream=False
+        services.admission.admit(
+            ROUTE_CLASSES.get(request.url_rule.rule),
+            user=client_user(request.headers.get('X-User-Id'), services.TRUST_PROXY_HEADERS),
+            ip=client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'), services.TRUST_PROXY_HEADERS),
         )
-
-        if response.choices and len(response.choices) > 0:
-            result_text = response.choices[0].message.content.strip()
-            
-            start_idx = result_text.find('{')
-            end_idx = result_text.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx > start_idx:
-                json_str = result_text[start_idx:end_idx]
-                nutrition_data = json.loads(json_str)
-                return nutrition_data
-            else:
-                raise Exception("Could not parse JSON from ERNIE response")
-        else:
-            raise Exception("No response from ERNIE")
-            
-    except json.JSONDecodeError as e:
-        raise Exception(f"JSON parsing error: {str(e)}")
     except Exception as e:
-        raise Exception(f"ERNIE Analysis Error: {str(e)}")
-    
+        return error_response(e, "admission")
+    return None
+
+@app.after_request
+def record_request(response):
+    """Request latency by route; streamed responses are timed to their headers"""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.http_request_seconds.observe(
+        time.perf_counter() - g.started, endpoint, request.method, response.status_code
+    )
+    return response
+
+def error_response(e, handler):
+    """Map an exception raised while handling a request to a JSON error response"""
+    metrics.request_errors.inc(handler, type(e).__name__)
+    if isinstance(e, ServiceError):
+        retry_after = getattr(e, "retry_after", None)
+        return jsonify({"error": str(e)}), e.status, {"Retry-After": str(retry_after)} if retry_after else {}
+    if isinstance(e, RequestEntityTooLarge):
+        return jsonify({"error": "Request body too large"}), 413
+    metrics.log_event("request_error", logging.ERROR, handler=handler, error=type(e).__name__, message=str(e))
+    return jsonify({"error": str(e)}), 500
+
 @app.route('/analyze', methods=['POST'])
 def analyze_food():
-    """Analyze food from image or description using ERNIE"""
+    """Analyze food from image or description using ERNIE.
+
+    Accepts JSON with a base64 `image`, multipart/form-data with an `image` file
+    part, or a raw image/* body with `lang` and `description` in the query string.
+    """
     try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-
-        lang = data.get("lang", "en") 
-
-        # If image is provided - use ERNIE vision
-        if 'image' in data:
-            image_data = data['image']
-            # Remove data URL prefix if present
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            additional_context = data.get('description', '')
-            
-            nutrition_data = analyze_image_with_ernie(image_data, additional_context, lang=lang)
-            
-            # Extract detected text if available
-            detected_text = nutrition_data.get('detected_text', '')
-            ocr_results = []
-            if detected_text:
-                # Split text into lines for display
-                lines = detected_text.split('\n')
-                ocr_results = [
-                    {"text": line.strip(), "confidence": 0.95} 
-                    for line in lines if line.strip()
-                ]
-            
-            return jsonify({
-                "success": True,
-                "ocr_results": ocr_results,
-                "nutrition": nutrition_data
-            }), 200
-
-        # If only description is provided - use ERNIE text model
-        elif 'description' in data:
-            # Pass lang here too!
-            nutrition_data = analyze_text_with_ernie(data['description'], lang=lang)
-            return jsonify({
-                "success": True,
-                "nutrition": nutrition_data
-            }), 200
+        # Binary uploads skip the base64/JSON round trip entirely
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('image')
+            if upload is None:
+                return jsonify({"error": "No image file provided"}), 400
+            image_bytes = read_bounded(upload.stream, MAX_UPLOAD_BYTES)
+            result = run_sync(services.analyze_image_upload(
+                image_bytes,
+                request.form.get('description', ''),
+                lang=request.form.get('lang', 'en')
+            ))
+            return jsonify(result), 200
+
+        if request.mimetype.startswith('image/'):
+            image_bytes = read_bounded(request.stream, MAX_UPLOAD_BYTES, request.content_length)
+            if not image_bytes:
+                return jsonify({"error": "Empty image body"}), 400
+            result = run_sync(services.analyze_image_upload(
+                image_bytes,
+                request.args.get('description', ''),
+                lang=request.args.get('lang', 'en')
+            ))
+            return jsonify(result), 200
+
+        result = run_sync(services.analyze_request(request.get_json(silent=True)))
+        return jsonify(result), 200
+
+    except Exception as e:
+        return error_response(e, "analyze_food")
 
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Analyze several images and/or descriptions from one meal in parallel.
+
+    Takes JSON `items` ([{"image": ...} | {"description": ...}]) and/or a `meal`
+    string, or multipart `image` files. Returns per-item results plus meal
+    totals; with `stream` set, results are sent as NDJSON lines as they complete.
+    """
+    try:
+        request.max_content_length = MAX_BATCH_BODY_BYTES
+        if request.mimetype == 'multipart/form-data':
+            data = request.form.to_dict()
+            images = [
+                read_bounded(upload.stream, MAX_UPLOAD_BYTES)
+                for upload in request.files.getlist('image')
+            ]
         else:
-            return jsonify({"error": "No image or description provided"}), 400
+            data = request.get_json(silent=True) or {}
+            images = []
+
+        items = services.parse_batch_items(data, images)
+        lang = data.get('lang', 'en')
+        parallelism = services.parse_batch_parallelism(data)
+
+        if data.get('stream') in (True, 'true', '1'):
+            return Response(
+                iterate_sync(services.stream_batch(items, lang, parallelism)),
+                mimetype="application/x-ndjson"
+            )
+
+        return jsonify(run_sync(services.analyze_batch(items, lang, parallelism))), 200
 
     except Exception as e:
-        print(f"Error in analyze_food: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, "analyze_batch")
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    """General chat with ERNIE"""
+    """General chat with ERNIE.
+
+    Send `"stream": true` (or `Accept: text/event-stream`) to receive the reply
+    as Server-Sent Events; otherwise the whole reply is returned as JSON.
+    """
     try:
-        data = request.json
-        if not data or 'messages' not in data:
-            return jsonify({"error": "No messages provided"}), 400
-        
-        messages = data['messages']
-        
-        # Ensure messages are in the correct format for the API
-        # The frontend should send {role: 'user'|'assistant', content: '...'}
-        
-        lang = data.get("language", "en")
-
-        system_prompt_content = """You are a professional nutrition assistant. 
-            Your goal is to provide clear, structured, and easy-to-read advice.
-            
-            Guidelines:
-            1. Use clear section headings (e.g., **Key Recommendations**, **Top Food Choices**, **Things to Avoid**).
-            2. Use bullet points for lists.
-            3. Bold important keywords.
-            4. Keep paragraphs short and concise.
-            5. Avoid long blocks of text.
-            6. Use a professional yet friendly tone.
-            7. DO NOT answer questions that are not related to nutrition.
-            8. If you receive a question regarding what to eat today or meal plan of the day, please direct the user to the meal planner tab and append the tag [ACTION:NavigateToMealPlanner] at the end of your response."""
-
-        if lang == 'zh':
-            system_prompt_content = """你是一位专业的营养助手。
-            你的目标是提供清晰、结构化且易于阅读的建议。
-            
-            指南：
-            1. 使用清晰的章节标题（例如：**关键建议**、**首选食物**、**避免事项**）。
-            2. 使用项目符号列出清单。
-            3. 加粗重要的关键词。
-            4. 保持段落简短精炼。
-            5. 避免大段的文字。
-            6. 使用专业且友好的语气。
-            7. 不要回答与营养无关的问题。
-            8. 如果收到关于今天吃什么或每日膳食计划的问题，请引导用户去膳食计划标签页，并在回复末尾附加标签 [ACTION:NavigateToMealPlanner]。"""
-
-        system_prompt = {
-            "role": "system", 
-            "content": system_prompt_content
-        }
-        
-        formatted_messages = [system_prompt] + messages
-        
-        response = client.chat.completions.create(
-            model="ernie-5.0-thinking-preview",
-            messages=formatted_messages,
-            max_completion_tokens=2048,
-            stream=False
-        )
+        data = request.get_json(silent=True)
+        formatted_messages = services.parse_chat_request(data)
 
-        if response.choices and len(response.choices) > 0:
-            return jsonify({
-                "success": True,
-                "message": response.choices[0].message.content
-            }), 200
-        else:
-            return jsonify({"error": "No response from ERNIE"}), 500
+        if services.wants_stream(data, request.headers.get('Accept', '')):
+            return Response(
+                iterate_sync(services.stream_chat(formatted_messages)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        return jsonify(run_sync(services.complete_chat(formatted_messages))), 200
 
     except Exception as e:
-        print(f"Error in chat: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, "chat")
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters for the /analyze result cache"""
+    return jsonify(services.cache_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, phase and upstream metrics in Prometheus text format"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/generate-meal-plan', methods=['POST'])
 def generate_meal_plan():
     """Generate a structured meal plan using ERNIE"""
     try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-
-        user_profile = data.get('profile', {})
-        date = data.get('date', '')
-        lang = data.get('language', 'en')
-
-        # Construct prompt based on user profile
-        profile_text = f"""
-        Profile:
-        - Daily Calorie Goal: {user_profile.get('daily_calorie_goal', 2000)} kcal
-        - Protein Goal: {user_profile.get('daily_protein_goal', 150)}g
-        - Carbs Goal: {user_profile.get('daily_carbs_goal', 200)}g
-        - Fats Goal: {user_profile.get('daily_fats_goal', 65)}g
-        - Dietary Restrictions: {', '.join(user_profile.get('dietary_restrictions', []))}
-        - Disliked Foods: {', '.join(user_profile.get('disliked_foods', []))}
-        - Goal: {user_profile.get('goal_type', 'maintenance')}
-        """
-
-        if lang == 'zh':
-            prompt = f"""你是一位专业的营养师。请根据以下用户档案，为 {date} 制定一份详细的每日膳食计划。
-            
-            {profile_text}
-
-            请生成一份结构化的膳食计划，包含早餐、午餐、晚餐和加餐（可选）。
-            
-            输出必须是严格的 JSON 格式，如下所示：
-            {{
-                "date": "YYYY-MM-DD",
-                "summary": "通过一两句话总结今天的计划（中文）",
-                "total_nutrition": {{
-                    "calories": 总卡路里,
-                    "protein": 总蛋白质(g),
-                    "carbs": 总碳水(g),
-                    "fats": 总脂肪(g)
-                }},
-                "meals": [
-                    {{
-                        "type": "早餐",
-                        "name": "餐食名称",
-                        "description": "简短描述",
-                        "items": ["食物1", "食物2"],
-                        "nutrition": {{
-                            "calories": int,
-                            "protein": int,
-                            "carbs": int,
-                            "fats": int
-                        }},
-                        "tips": "烹饪或食用建议"
-                    }},
-                    // ... 其他餐食 (午餐, 晚餐, 加餐)
-                ]
-            }}
-            
-            只输出 JSON。不要输出其他文本。
-            """
-        else:
-            prompt = f"""You are a professional nutritionist. Please create a detailed daily meal plan for {date} based on the following user profile.
-
-            {profile_text}
-
-            Generate a structured meal plan including Breakfast, Lunch, Dinner, and optionally Snacks.
-
-            The output must be in strict JSON format as follows:
-            {{
-                "date": "YYYY-MM-DD",
-                "summary": "A brief 1-2 sentence summary of the day's plan",
-                "total_nutrition": {{
-                    "calories": total_calories_int,
-                    "protein": total_protein_g,
-                    "carbs": total_carbs_g,
-                    "fats": total_fats_g
-                }},
-                "meals": [
-                    {{
-                        "type": "Breakfast",
-                        "name": "Meal Name",
-                        "description": "Short description",
-                        "items": ["Item 1", "Item 2"],
-                        "nutrition": {{
-                            "calories": int,
-                            "protein": int,
-                            "carbs": int,
-                            "fats": int
-                        }},
-                        "tips": "Preparation or eating tip"
-                    }},
-                    // ... other meals (Lunch, Dinner, Snack)
-                ]
-            }}
-
-            Output ONLY valid JSON. No markdown formatting or other text.
-            """
-
-        messages = [
-            {"role": "user", "content": prompt}
-        ]
-
-        response = client.chat.completions.create(
-            model="ernie-4.0-8k-latest",
-            messages=messages,
-            max_completion_tokens=2048,
-            stream=False
-        )
+        result = run_sync(services.meal_plan_request(request.get_json(silent=True)))
+        return jsonify(result), 200
 
-        if response.choices and len(response.choices) > 0:
-            print(f"DEBUG: Response ID: {response.id}")
-            print(f"DEBUG: Finish Reason: {response.choices[0].finish_reason}")
-            result_text = response.choices[0].message.content
-            if not result_text:
-                print("DEBUG: Content is None or Empty")
-                result_text = ""
-            else:
-                result_text = result_text.strip()
-            print(f"DEBUG: Raw model response: {result_text}")
-            
-            # Simple cleanup of markdown blocks if they exist, to be safe
-            if "```json" in result_text:
-                result_text = result_text.replace("```json", "").replace("```", "")
-            elif "```" in result_text:
-                result_text = result_text.replace("```", "")
-            
-            start_idx = result_text.find('{')
-            end_idx = result_text.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx > start_idx:
-                json_str = result_text[start_idx:end_idx]
-                try:
-                    meal_plan = json.loads(json_str)
-                    return jsonify({
-                        "success": True,
-                        "plan": meal_plan
-                    }), 200
-                except json.JSONDecodeError as je:
-                    print(f"JSON Decode Error: {je}")
-                    print(f"Faulty JSON string: {json_str}")
-                    return jsonify({"error": f"Invalid JSON format from AI: {str(je)}"}), 500
-            else:
-                print(f"Failed to locate JSON brackets in: {result_text}")
-                return jsonify({"error": "Could not locate JSON in ERNIE response"}), 500
-        else:
-            return jsonify({"error": "No response from ERNIE"}), 500
+    except Exception as e:
+        return error_response(e, "generate_meal_plan")
 
+@app.route('/generate-meal-plan/range', methods=['POST'])
+def generate_meal_plan_range():
+    """Generate meal plans for a range of dates in parallel.
+
+    Takes `profile`, `language`, `start_date` and `end_date` (inclusive) or
+    `days`. With `stream` set, each day is sent as an NDJSON line as soon as
+    it is ready; otherwise all days are returned together in date order.
+    """
+    try:
+        data = request.get_json(silent=True)
+        profile, dates, lang = services.parse_meal_plan_range(data)
+        if data.get('stream') in (True, 'true', '1'):
+            return Response(
+                iterate_sync(services.stream_meal_plan_range(profile, dates, lang)),
+                mimetype="application/x-ndjson"
+            )
+        return jsonify(run_sync(services.meal_plan_range(profile, dates, lang))), 200
+
+    except Exception as e:
+        return error_response(e, "generate_meal_plan_range")
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue an analysis or meal plan and answer with its job ID at once.
+
+    Takes `{"type": "analyze" | "meal_plan", "request": <that endpoint's JSON
+    body>, "priority": "high" | "normal" | "low"}`.
+    """
+    try:
+        job = run_sync(services.submit_job(request.get_json(silent=True)))
+        return jsonify(job), 202, {"Location": f"/jobs/{job['id']}"}
+    except Exception as e:
+        return error_response(e, "submit_job")
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """A job's status and, once finished, its result; `?wait=N` long-polls for up to N seconds"""
+    try:
+        return jsonify(run_sync(services.job_status(job_id, request.args.get('wait')))), 200
     except Exception as e:
-        print(f"Error in generate_meal_plan: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, "job_status")
 
 if __name__ == '__main__':
     print("="*60)
     print("Starting ERNIE Vision API Server...")
     print("="*60)
+    # With the debug reloader only the child process serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        background_loop().call_soon_threadsafe(services.job_queue.start)
+        if services.MEAL_PLAN_PRECOMPUTE:
+            asyncio.run_coroutine_threadsafe(services.meal_plan_precomputer.run(), background_loop())
     app.run(host='0.0.0.0', port=5000, debug=True)
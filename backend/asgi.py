@@ -0,0 +1,330 @@
+"""Production ASGI server for the ERNIE backend.
+
+Serves the same routes as app.py, but awaits the async `services` coroutines
+directly on one event loop, so hundreds of requests waiting on the upstream
+cost a suspended coroutine each rather than a worker thread. Run with:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+import services
+from admission import ROUTE_CLASSES, client_ip, client_user
+from errors import ServiceError
+from uploads import UploadTooLarge, read_bounded
+
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 15 * 1024 * 1024))
+MAX_BODY_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+# Batches carry several photos, so they get a larger overall body limit
+MAX_BATCH_BODY_BYTES = int(os.environ.get("MAX_BATCH_BODY_BYTES", 4 * MAX_BODY_BYTES))
+
+
+class BodySizeLimit:
+    """Rejects request bodies over `limit` bytes while they are still being received.
+
+    Counts what the server hands to the app instead of trusting Content-Length
+    alone, so chunked uploads are cut off early as well. `overrides` maps
+    request paths to their own limits.
+    """
+
+    def __init__(self, app, limit, overrides=None):
+        self.app = app
+        self.limit = limit
+        self.overrides = overrides or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        limit = self.overrides.get(scope["path"], self.limit)
+        for name, value in scope["headers"]:
+            if name == b"content-length" and int(value) > limit:
+                response = JSONResponse({"error": "Request body too large"}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise UploadTooLarge(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class RequestMetrics:
+    """Records how long each request takes, by route, method and status.
+
+    Timed until the last body chunk is sent, so streamed responses (chat SSE,
+    batch NDJSON) count their whole duration.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            if not recorded:
+                recorded = True
+                # The router stores the matched route in the scope
+                endpoint = getattr(scope.get("route"), "path", "unmatched")
+                metrics.http_request_seconds.observe(
+                    time.perf_counter() - started, endpoint, scope["method"], status
+                )
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            record()
+
+
+class Admission:
+    """Rate limits and sheds load before a request reaches its handler; see admission.py"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        try:
+            services.admission.admit(
+                ROUTE_CLASSES.get(scope["path"]),
+                user=client_user(headers.get("x-user-id"), services.TRUST_PROXY_HEADERS),
+                ip=client_ip((scope.get("client") or (None,))[0], headers.get("x-forwarded-for"),
+                             services.TRUST_PROXY_HEADERS),
+            )
+        except Exception as e:
+            return await error_response(e, "admission")(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+def error_response(e, handler):
+    """Map an exception raised while handling a request to a JSON error response"""
+    metrics.request_errors.inc(handler, type(e).__name__)
+    if isinstance(e, ServiceError):
+        retry_after = getattr(e, "retry_after", None)
+        headers = {"Retry-After": str(retry_after)} if retry_after else None
+        return JSONResponse({"error": str(e)}, status_code=e.status, headers=headers)
+    metrics.log_event("request_error", logging.ERROR, handler=handler, error=type(e).__name__, message=str(e))
+    return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def read_json(request):
+    body = await request.body()
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def analyze_food(request):
+    """Analyze food from a JSON, multipart/form-data or raw image/* request"""
+    try:
+        content_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+        if content_type == "multipart/form-data":
+            async with request.form() as form:
+                upload = form.get("image")
+                if upload is None or isinstance(upload, str):
+                    return JSONResponse({"error": "No image file provided"}, status_code=400)
+                image_bytes = read_bounded(upload.file, MAX_UPLOAD_BYTES)
+                description = form.get("description", "")
+                lang = form.get("lang", "en")
+            result = await services.analyze_image_upload(image_bytes, description, lang=lang)
+            return JSONResponse(result)
+
+        if content_type.startswith("image/"):
+            image_bytes = bytearray()
+            async for chunk in request.stream():
+                if len(image_bytes) + len(chunk) > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(MAX_UPLOAD_BYTES)
+                image_bytes += chunk
+            if not image_bytes:
+                return JSONResponse({"error": "Empty image body"}, status_code=400)
+            result = await services.analyze_image_upload(
+                image_bytes,
+                request.query_params.get("description", ""),
+                lang=request.query_params.get("lang", "en"),
+            )
+            return JSONResponse(result)
+
+        result = await services.analyze_request(await read_json(request))
+        return JSONResponse(result)
+
+    except Exception as e:
+        return error_response(e, "analyze_food")
+
+
+async def analyze_batch(request):
+    """Analyze several images and/or descriptions from one meal in parallel"""
+    try:
+        content_type = request.headers.get("content-type", "").split(";")[0].strip()
+        if content_type == "multipart/form-data":
+            async with request.form() as form:
+                data = {key: value for key, value in form.items() if isinstance(value, str)}
+                images = [
+                    read_bounded(upload.file, MAX_UPLOAD_BYTES)
+                    for upload in form.getlist("image")
+                    if not isinstance(upload, str)
+                ]
+        else:
+            data = await read_json(request) or {}
+            images = []
+
+        items = services.parse_batch_items(data, images)
+        lang = data.get("lang", "en")
+        parallelism = services.parse_batch_parallelism(data)
+
+        if data.get("stream") in (True, "true", "1"):
+            return StreamingResponse(
+                services.stream_batch(items, lang, parallelism),
+                media_type="application/x-ndjson",
+            )
+
+        return JSONResponse(await services.analyze_batch(items, lang, parallelism))
+
+    except Exception as e:
+        return error_response(e, "analyze_batch")
+
+
+async def chat(request):
+    """General chat with ERNIE, streamed as Server-Sent Events on request"""
+    try:
+        data = await read_json(request)
+        formatted_messages = services.parse_chat_request(data)
+
+        if services.wants_stream(data, request.headers.get("accept", "")):
+            return StreamingResponse(
+                services.stream_chat(formatted_messages),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        return JSONResponse(await services.complete_chat(formatted_messages))
+
+    except Exception as e:
+        return error_response(e, "chat")
+
+
+async def health_check(request):
+    return JSONResponse({"status": "healthy"})
+
+
+async def cache_stats(request):
+    return JSONResponse(services.cache_stats())
+
+
+async def prometheus_metrics(request):
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def generate_meal_plan_range(request):
+    """Meal plans for a range of dates, streamed as NDJSON lines with `"stream": true`"""
+    try:
+        data = await read_json(request)
+        profile, dates, lang = services.parse_meal_plan_range(data)
+        if data.get("stream") in (True, "true", "1"):
+            return StreamingResponse(
+                services.stream_meal_plan_range(profile, dates, lang),
+                media_type="application/x-ndjson",
+            )
+        return JSONResponse(await services.meal_plan_range(profile, dates, lang))
+    except Exception as e:
+        return error_response(e, "generate_meal_plan_range")
+
+
+async def submit_job(request):
+    """Queue an analysis or meal plan and answer with its job ID at once"""
+    try:
+        job = await services.submit_job(await read_json(request))
+        return JSONResponse(job, status_code=202, headers={"Location": f"/jobs/{job['id']}"})
+    except Exception as e:
+        return error_response(e, "submit_job")
+
+
+async def job_status(request):
+    """A job's status and, once finished, its result; `?wait=N` long-polls for up to N seconds"""
+    try:
+        return JSONResponse(await services.job_status(request.path_params["job_id"], request.query_params.get("wait")))
+    except Exception as e:
+        return error_response(e, "job_status")
+
+
+async def generate_meal_plan(request):
+    """Generate a structured meal plan using ERNIE"""
+    try:
+        return JSONResponse(await services.meal_plan_request(await read_json(request)))
+    except Exception as e:
+        return error_response(e, "generate_meal_plan")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    services.job_queue.start()
+    precompute = None
+    if services.MEAL_PLAN_PRECOMPUTE:
+        precompute = asyncio.create_task(services.meal_plan_precomputer.run())
+    yield
+    if precompute is not None:
+        precompute.cancel()
+    await services.job_queue.stop()
+
+
+app = Starlette(
+    lifespan=lifespan,
+    routes=[
+        Route("/analyze", analyze_food, methods=["POST"]),
+        Route("/analyze/batch", analyze_batch, methods=["POST"]),
+        Route("/chat", chat, methods=["POST"]),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/cache/stats", cache_stats, methods=["GET"]),
+        Route("/metrics", prometheus_metrics, methods=["GET"]),
+        Route("/generate-meal-plan", generate_meal_plan, methods=["POST"]),
+        Route("/generate-meal-plan/range", generate_meal_plan_range, methods=["POST"]),
+        Route("/jobs", submit_job, methods=["POST"]),
+        Route("/jobs/{job_id}", job_status, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(RequestMetrics),
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(Admission),
+        Middleware(BodySizeLimit, limit=MAX_BODY_BYTES, overrides={"/analyze/batch": MAX_BATCH_BODY_BYTES}),
+    ],
+)
@@ -0,0 +1,35 @@
+import asyncio
+import threading
+
+_loop = None
+_lock = threading.Lock()
+
+
+def background_loop():
+    """Event loop shared by all sync (Flask) request threads, started on first use"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="upstream-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro, timeout=None):
+    """Run a coroutine on the background loop and block the calling thread for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, background_loop()).result(timeout)
+
+
+def iterate_sync(agen):
+    """Drive an async generator from a sync generator, e.g. for a streamed Flask response"""
+    loop = background_loop()
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
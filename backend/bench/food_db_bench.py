@@ -0,0 +1,122 @@
+"""Lookup latency and load time of the local food-composition database.
+
+Runs a fixed set of meal descriptions against the bundled table, then against
+a synthetic table of `--synthetic` foods (the bundled rows plus generated
+variants) to check that lookups stay sub-millisecond as the table grows.
+Run from backend/:
+
+    python bench/food_db_bench.py [--synthetic 300000] [--repeat 200]
+"""
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from food_db import DEFAULT_CSV, FoodDatabase  # noqa: E402
+
+QUERIES = [
+    ("2 boiled eggs and a slice of wholemeal toast", "en"),
+    ("200g rice, chicken curry, iced tea", "en"),
+    ("a bowl of oatmeal with banana", "en"),
+    ("sweet and sour pork with rice", "en"),
+    ("grilled chicken breast", "en"),
+    ("half a cup of milk", "en"),
+    ("3 cookies and a glass of cola", "en"),
+    ("两个鸡蛋，一碗米饭", "zh"),
+    ("一杯豆浆，两根油条", "zh"),
+    ("米饭和红烧肉", "zh"),
+    # Must fall back to the model
+    ("fried egg sandwich", "en"),
+    ("grandma's special stew", "en"),
+]
+
+ADJECTIVES = ["spicy", "garlic", "lemon", "honey", "smoky", "herb", "pepper", "ginger", "sesame", "chili"]
+STYLES = ["style", "deluxe", "classic", "mini", "family", "street", "house", "village", "royal", "golden"]
+
+
+def synthetic_csv(path, count):
+    """Write the bundled rows plus generated variants until there are `count` foods"""
+    with open(DEFAULT_CSV, encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        fields = reader.fieldnames
+        rows = list(reader)
+
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+        for i in range(count - len(rows)):
+            base = rng.choice(rows)
+            word = f"{rng.choice(ADJECTIVES)} {rng.choice(STYLES)} v{i}"
+            writer.writerow({
+                **base,
+                "name_en": f"{base['name_en']} {word}",
+                "name_zh": f"{base['name_zh']}{i}号",
+                "aliases": f"{word} {base['aliases'].split('|')[0]}",
+            })
+
+
+def time_lookups(db, repeat):
+    samples = []
+    for text, lang in QUERIES:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            db.estimate(text, lang)
+            samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "p50_us": statistics.median(samples),
+        "p99_us": samples[int(len(samples) * 0.99) - 1],
+        "max_us": samples[-1],
+    }
+
+
+def report(label, db, load_ms, repeat):
+    results = [(text, db.lookup(text)) for text, _ in QUERIES]
+    timings = time_lookups(db, repeat)
+    print(f"{label}: {len(db.names_en)} foods, {len(db.doc_food)} names, index {db.source}, load {load_ms:.1f} ms")
+    print(f"  lookup p50 {timings['p50_us']:.0f} µs, p99 {timings['p99_us']:.0f} µs, max {timings['max_us']:.0f} µs")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--synthetic", type=int, default=300_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        db = FoodDatabase.open(DEFAULT_CSV, os.path.join(tmp, "bundled"))
+        bundled = report("bundled", db, (time.perf_counter() - start) * 1000, args.repeat)
+        for text, items in bundled:
+            names = ", ".join(f"{db.names_en[food]} {grams:g}g" for food, grams in items) if items else "(model)"
+            print(f"    {text} -> {names}")
+
+        if args.synthetic:
+            path = os.path.join(tmp, "synthetic.csv")
+            synthetic_csv(path, args.synthetic)
+            index_dir = os.path.join(tmp, "synthetic_index")
+
+            start = time.perf_counter()
+            FoodDatabase.open(path, index_dir)
+            print(f"compiled {args.synthetic} foods in {(time.perf_counter() - start):.1f} s")
+
+            start = time.perf_counter()
+            db = FoodDatabase.open(path, index_dir)
+            synthetic = report("synthetic", db, (time.perf_counter() - start) * 1000, args.repeat)
+            changed = sum(
+                (a is None) != (b is None) for (_, a), (_, b) in zip(bundled, synthetic)
+            )
+            print(f"  {changed} of {len(QUERIES)} descriptions changed hit/fallback against the bundled table")
+
+
+if __name__ == "__main__":
+    main()
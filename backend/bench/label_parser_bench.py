@@ -0,0 +1,68 @@
+"""Hit rate, accuracy and latency of the local nutrition-label parser.
+
+Each corpus line is {"text", "lang", "expected"}; `expected` is null for
+descriptions that must fall back to ERNIE. Run from backend/:
+
+    python bench/label_parser_bench.py [--corpus bench/label_corpus.jsonl] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from label_parser import parse_nutrition_label  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(__file__), "label_corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    labels = [entry for entry in corpus if entry["expected"] is not None]
+    others = [entry for entry in corpus if entry["expected"] is None]
+
+    hits = 0
+    exact = 0
+    mismatches = []
+    for entry in labels:
+        result = parse_nutrition_label(entry["text"], entry["lang"])
+        if result is None:
+            mismatches.append((entry["text"], "fell back"))
+            continue
+        hits += 1
+        wrong = {k: (result[k], v) for k, v in entry["expected"].items() if result[k] != v}
+        if wrong:
+            mismatches.append((entry["text"], wrong))
+        else:
+            exact += 1
+
+    false_positives = [entry["text"] for entry in others if parse_nutrition_label(entry["text"], entry["lang"]) is not None]
+
+    timings = []
+    for _ in range(args.repeat):
+        for entry in corpus:
+            started = time.perf_counter()
+            parse_nutrition_label(entry["text"], entry["lang"])
+            timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+
+    print(f"corpus: {len(labels)} nutrition tables, {len(others)} free-text descriptions")
+    print(f"hit rate: {hits}/{len(labels)} ({hits / len(labels):.0%}), exact field match: {exact}/{len(labels)}")
+    print(f"false positives: {len(false_positives)}/{len(others)}")
+    print(f"latency: p50 {statistics.median(timings):.1f}us  p99 {timings[int(len(timings) * 0.99)]:.1f}us")
+    for text, problem in mismatches:
+        print(f"  mismatch: {text[:60]!r}: {problem}")
+    for text in false_positives:
+        print(f"  false positive: {text[:60]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""Throughput, latency and memory of the backend under load, against a mock ERNIE.
+
+Starts bench/mock_ernie.py and the backend (asgi.py under uvicorn, or app.py
+under the Flask server) with ERNIE_BASE_URL pointed at the mock, then drives
+each scenario twice: closed-loop at a fixed number of concurrent clients, and
+open-loop at a fixed arrival rate (Poisson arrivals, so queueing shows up as
+latency instead of being hidden by slower clients). Inputs are unique per
+request so the result caches do not answer for the upstream. Run from backend/:
+
+    python bench/load_bench.py [--server asgi] [--duration 20] [--concurrency 16] [--rate 8]
+    python bench/load_bench.py --output bench/results/new.json --compare bench/results/base.json
+
+Results are written as JSON; --compare prints the change per scenario and
+exits non-zero when throughput drops or p95 latency grows by more than
+--tolerance.
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from PIL import Image, ImageDraw
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(BACKEND, "bench", "results")
+
+DISHES = ["stew", "curry", "noodle soup", "casserole", "stir fry", "porridge", "salad bowl", "wrap"]
+STYLES = ["grandma's", "street-style", "homemade", "festival", "village", "midnight", "office canteen"]
+TOPICS = ["lose weight", "build muscle", "manage blood sugar", "eat before a run", "lower cholesterol"]
+GOALS = ["weight_loss", "muscle_gain", "maintenance"]
+
+# Request numbers are unique across the whole run, so no two requests share an input
+REQUEST_NUMBERS = itertools.count(1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def photo(seed):
+    """A small JPEG unlike any other seed's, so it misses the exact and perceptual caches"""
+    rng = random.Random(seed)
+    image = Image.new("RGB", (480, 360), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x, y = rng.randrange(480), rng.randrange(360)
+        draw.rectangle([x, y, x + rng.randrange(20, 160), y + rng.randrange(20, 120)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+# Each scenario turns a request number into (method, path, keyword arguments for httpx)
+
+def analyze_text(n):
+    rng = random.Random(n)
+    description = f"{rng.choice(STYLES)} {rng.choice(DISHES)} number {n}"
+    return "POST", "/analyze", {"json": {"description": description, "lang": "en"}}
+
+
+def analyze_image(n):
+    return "POST", "/analyze?lang=en", {"content": photo(n), "headers": {"Content-Type": "image/jpeg"}}
+
+
+def chat(n, stream=False):
+    rng = random.Random(n)
+    # Personal details keep the answer out of the shared chat answer cache
+    question = f"I am {18 + n % 60} years old and weigh {50 + n % 70}kg, how should I {rng.choice(TOPICS)}?"
+    return "POST", "/chat", {"json": {"messages": [{"role": "user", "content": question}], "stream": stream}}
+
+
+def chat_stream(n):
+    return chat(n, stream=True)
+
+
+def meal_plan(n):
+    rng = random.Random(n)
+    profile = {
+        "daily_calorie_goal": 1200 + 100 * (n % 30),
+        "daily_protein_goal": 60 + 10 * (n // 30 % 15),
+        "daily_carbs_goal": 150 + 10 * rng.randrange(20),
+        "daily_fats_goal": 40 + 10 * rng.randrange(6),
+        "goal_type": rng.choice(GOALS),
+    }
+    date = (datetime.date(2030, 1, 1) + datetime.timedelta(days=n // 450)).isoformat()
+    return "POST", "/generate-meal-plan", {"json": {"profile": profile, "date": date, "language": "en"}}
+
+
+SCENARIOS = {
+    "analyze_text": analyze_text,
+    "analyze_image": analyze_image,
+    "chat": chat,
+    "chat_stream": chat_stream,
+    "meal_plan": meal_plan,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.first_byte = []
+        self.statuses = {}
+        self.failures = {}
+
+    async def call(self, http, build, n):
+        # Inputs (photos especially) are built off the event loop and outside the timing
+        method, path, kwargs = await asyncio.to_thread(build, n)
+        started = time.perf_counter()
+        try:
+            async with http.stream(method, path, **kwargs) as response:
+                first = None
+                async for _ in response.aiter_raw():
+                    if first is None:
+                        first = time.perf_counter() - started
+                status = response.status_code
+        except httpx.HTTPError as e:
+            self.failures[type(e).__name__] = self.failures.get(type(e).__name__, 0) + 1
+            return
+        elapsed = time.perf_counter() - started
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status < 400:
+            self.latencies.append(elapsed)
+            if first is not None:
+                self.first_byte.append(first)
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        first_byte = sorted(self.first_byte)
+        total = sum(self.statuses.values()) + sum(self.failures.values())
+        ms = lambda value: round(value * 1000, 1) if value is not None else None  # noqa: E731
+        return {
+            "requests": total,
+            "ok": len(latencies),
+            "error_rate": round(1 - len(latencies) / total, 4) if total else None,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "failures": self.failures,
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "latency_ms": {
+                "mean": ms(statistics.fmean(latencies)) if latencies else None,
+                "p50": ms(percentile(latencies, 0.50)),
+                "p95": ms(percentile(latencies, 0.95)),
+                "p99": ms(percentile(latencies, 0.99)),
+                "max": ms(latencies[-1]) if latencies else None,
+            },
+            "first_byte_ms": {"p50": ms(percentile(first_byte, 0.50)), "p95": ms(percentile(first_byte, 0.95))},
+        }
+
+
+async def sample_memory(pid, samples, done):
+    while not done.is_set():
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(done.wait(), 0.25)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def fixed_concurrency(http, build, counter, concurrency, duration):
+    """`concurrency` clients, each sending its next request as soon as the last one returns"""
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            await recorder.call(http, build, next(counter))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return recorder, time.perf_counter() - started
+
+
+async def fixed_rate(http, build, counter, rate, duration, seed=0):
+    """Requests arriving at `rate` per second on average, whether or not earlier ones have returned"""
+    recorder = Recorder()
+    rng = random.Random(seed)
+    tasks = []
+    started = time.perf_counter()
+    next_at = started
+    while next_at < started + duration:
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        tasks.append(asyncio.create_task(recorder.call(http, build, next(counter))))
+        next_at += rng.expovariate(rate)
+    await asyncio.gather(*tasks)
+    return recorder, time.perf_counter() - started
+
+
+async def run_scenario(base_url, pid, name, mode, load, duration, timeout):
+    build = SCENARIOS[name]
+    counter = REQUEST_NUMBERS
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as http:
+        memory, done = [], asyncio.Event()
+        sampler = asyncio.create_task(sample_memory(pid, memory, done))
+        if mode == "concurrency":
+            recorder, elapsed = await fixed_concurrency(http, build, counter, load, duration)
+        else:
+            recorder, elapsed = await fixed_rate(http, build, counter, load, duration)
+        done.set()
+        await sampler
+
+    result = {"scenario": name, "mode": mode, "load": load, "duration_s": round(elapsed, 2), **recorder.summary(elapsed)}
+    result["memory_mb"] = {
+        "peak": round(max(memory) / 2**20, 1) if memory else None,
+        "end": round(memory[-1] / 2**20, 1) if memory else None,
+    }
+    return result
+
+
+def start(command, env, url, timeout=60):
+    process = subprocess.Popen(command, cwd=BACKEND, env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command[0]} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def shutdown(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def compare(results, baseline, tolerance):
+    """Print per-scenario changes against a baseline run; return the regressions"""
+    old = {(r["scenario"], r["mode"], r["load"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\ncompared with {baseline['meta'].get('started')} ({baseline['meta'].get('commit')}):")
+    for result in results:
+        key = (result["scenario"], result["mode"], result["load"])
+        before = old.get(key)
+        if before is None:
+            continue
+        changes = []
+        for label, now, then, worse in (
+            ("throughput", result["throughput_rps"], before["throughput_rps"], lambda d: d < -tolerance),
+            ("p95", result["latency_ms"]["p95"], before["latency_ms"]["p95"], lambda d: d > tolerance),
+            ("p99", result["latency_ms"]["p99"], before["latency_ms"]["p99"], lambda d: d > tolerance),
+            ("peak rss", result["memory_mb"]["peak"], before["memory_mb"]["peak"], lambda d: d > tolerance),
+        ):
+            if not now or not then:
+                continue
+            delta = now / then - 1
+            flag = " !" if worse(delta) and label in ("throughput", "p95") else ""
+            changes.append(f"{label} {delta:+.0%}{flag}")
+            if flag:
+                regressions.append((key, label, delta))
+        print(f"  {key[0]:<14} {key[1]:<11} {key[2]:<5} " + ", ".join(changes))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="16", help="comma-separated client counts for the closed-loop runs")
+    parser.add_argument("--rate", default="8", help="comma-separated arrival rates (requests/s) for the open-loop runs")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--mock-latency", type=float, default=1.0, help="median seconds to the first upstream token")
+    parser.add_argument("--mock-sigma", type=float, default=0.5)
+    parser.add_argument("--mock-tokens-per-second", type=float, default=60)
+    parser.add_argument("--mock-malformed-rate", type=float, default=0.0)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", default=None, help="where to save results (default bench/results/<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    runs = [("concurrency", int(n)) for n in args.concurrency.split(",") if n]
+    runs += [("rate", float(r)) for r in args.rate.split(",") if r]
+
+    mock_port, port = free_port(), free_port()
+    mock = start([
+        sys.executable, os.path.join("bench", "mock_ernie.py"), "--port", str(mock_port),
+        "--latency", str(args.mock_latency), "--sigma", str(args.mock_sigma),
+        "--tokens-per-second", str(args.mock_tokens_per_second),
+        "--malformed-rate", str(args.mock_malformed_rate), "--error-rate", str(args.mock_error_rate), "--seed", "0",
+    ], os.environ.copy(), f"http://127.0.0.1:{mock_port}/stats")
+
+    env = {
+        **os.environ,
+        "ERNIE_BASE_URL": f"http://127.0.0.1:{mock_port}/llm/lmapi/v3",
+        "ERNIE_API_KEY": "mock",
+        "MEAL_PLAN_PRECOMPUTE": "0",
+        # Every simulated user comes from one address
+        "RATE_LIMIT": "0",
+        "ANALYZE_CACHE_DB": "",
+        "MEAL_PLAN_CACHE_DB": "",
+    }
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    base_url = f"http://127.0.0.1:{port}"
+
+    meta = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "server": args.server,
+        "python": sys.version.split()[0],
+        "duration_s": args.duration,
+        "mock": {"latency": args.mock_latency, "sigma": args.mock_sigma,
+                 "tokens_per_second": args.mock_tokens_per_second,
+                 "malformed_rate": args.mock_malformed_rate, "error_rate": args.mock_error_rate},
+    }
+    results = []
+    try:
+        server = start(command, env, f"{base_url}/health")
+        try:
+            for name in scenarios:
+                for mode, load in runs:
+                    result = asyncio.run(run_scenario(base_url, server.pid, name, mode, load, args.duration, args.timeout))
+                    results.append(result)
+                    latency = result["latency_ms"]
+                    print(f"{name:<14} {mode:<11} {load:<5} {result['throughput_rps']:>7.2f} req/s  "
+                          f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms  "
+                          f"errors {result['error_rate']:.1%}  peak rss {result['memory_mb']['peak']} MB")
+            meta["mock_stats"] = httpx.get(f"http://127.0.0.1:{mock_port}/stats").json()
+        finally:
+            shutdown(server)
+    finally:
+        shutdown(mock)
+
+    output = args.output or os.path.join(RESULTS, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print(f"saved {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
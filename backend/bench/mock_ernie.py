@@ -0,0 +1,248 @@
+"""Local stand-in for the ERNIE /llm/lmapi/v3 chat-completions API, for load tests.
+
+Answers /llm/lmapi/v3/chat/completions in the OpenAI wire format, streamed or
+not, with a reply shaped like the real one for each kind of request (food
+analysis JSON, meal plan JSON, chat text, history summary). Time to the first
+token is drawn from a log-normal distribution and the rest of the reply is
+paced at `--tokens-per-second`; a `--malformed-rate` share of JSON replies is
+cut short and an `--error-rate` share of calls fails with a 503. Point the
+backend at it with:
+
+    python bench/mock_ernie.py --port 8100
+    ERNIE_BASE_URL=http://127.0.0.1:8100/llm/lmapi/v3 uvicorn asgi:app --port 5000
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_context import estimate_tokens  # noqa: E402
+
+# Roughly what a small photo costs in prompt tokens
+IMAGE_TOKENS = 765
+
+ANALYSIS = {
+    "name": "Chicken Rice",
+    "category": "Meal",
+    "calories": 607,
+    "protein": 27,
+    "carbs": 75,
+    "fats": 22,
+    "fiber": 2,
+    "sugar": 1,
+    "sodium": 1200,
+    "serving_size": "1 plate (350g)",
+    "confidence": "high",
+    "detected_text": "",
+    "benefits": ["Good source of protein"],
+    "considerations": ["High in sodium"],
+    "explanation": "Estimated from a typical hawker portion.",
+}
+
+MEALS = [
+    ("Breakfast", "Oatmeal with berries", ["oats", "blueberries", "milk"], (420, 18, 65, 10)),
+    ("Lunch", "Grilled chicken salad", ["chicken breast", "lettuce", "olive oil"], (560, 45, 30, 25)),
+    ("Snack", "Greek yogurt", ["greek yogurt", "honey"], (180, 15, 20, 4)),
+    ("Dinner", "Salmon with brown rice", ["salmon", "brown rice", "broccoli"], (640, 40, 60, 22)),
+]
+
+CHAT_REPLY = (
+    "**Key Recommendations**\n\n"
+    "- Build each meal around a palm-sized portion of **lean protein**.\n"
+    "- Fill half the plate with **vegetables** and choose whole grains.\n"
+    "- Keep sugary drinks and deep-fried snacks occasional.\n\n"
+    "**Top Food Choices**\n\n"
+    "- Eggs, tofu, fish and chicken breast\n"
+    "- Brown rice, oats and wholemeal bread\n"
+    "- Leafy greens, broccoli and fruit\n"
+)
+
+SUMMARY_REPLY = "The user wants to lose weight, avoids pork, and was advised to eat more protein and vegetables."
+
+
+def meal_plan():
+    meals = [
+        {"type": kind, "name": name, "items": items,
+         "nutrition": {"calories": c, "protein": p, "carbs": cb, "fats": f}}
+        for kind, name, items, (c, p, cb, f) in MEALS
+    ]
+    total = {key: sum(meal["nutrition"][key] for meal in meals) for key in ("calories", "protein", "carbs", "fats")}
+    return {"summary": "A balanced day built around lean protein and whole grains.",
+            "total_nutrition": total, "meals": meals}
+
+
+def request_kind(messages):
+    """Which backend call a request comes from, judged by its prompt"""
+    if any(message.get("role") == "system" for message in messages):
+        return "chat"
+    text = json.dumps(messages, ensure_ascii=False)
+    if "running summary" in text:
+        return "summary"
+    if "Daily Calorie Goal" in text:
+        return "meal_plan"
+    return "analyze"
+
+
+def prompt_tokens(messages):
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    tokens += IMAGE_TOKENS
+                else:
+                    tokens += estimate_tokens(part.get("text"))
+        else:
+            tokens += estimate_tokens(content)
+        tokens += 4
+    return tokens
+
+
+class MockErnie:
+    def __init__(self, latency=2.0, sigma=0.5, tokens_per_second=60.0, malformed_rate=0.0,
+                 error_rate=0.0, seed=None):
+        self.latency = latency
+        self.sigma = sigma
+        self.tokens_per_second = tokens_per_second
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.requests = {}
+        self.malformed = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def first_token_delay(self):
+        """Log-normal with median `latency` seconds"""
+        if self.latency <= 0:
+            return 0.0
+        return self.random.lognormvariate(math.log(self.latency), self.sigma)
+
+    def reply(self, kind):
+        if kind == "chat":
+            return CHAT_REPLY
+        if kind == "summary":
+            return SUMMARY_REPLY
+        text = json.dumps(meal_plan() if kind == "meal_plan" else ANALYSIS, ensure_ascii=False)
+        if self.random.random() < self.malformed_rate:
+            self.malformed += 1
+            # Output cut off mid-object, as when the model runs out of tokens
+            return "```json\n" + text[:self.random.randint(len(text) // 3, len(text) - 2)]
+        return f"```json\n{text}\n```"
+
+    def chunks(self, text, size=8):
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    async def completions(self, request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        kind = request_kind(messages)
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self.first_token_delay() / 4)
+            return JSONResponse({"error": {"message": "mock overloaded", "type": "server_error"}}, status_code=503)
+
+        text = self.reply(kind)
+        usage = {"prompt_tokens": prompt_tokens(messages), "completion_tokens": estimate_tokens(text)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        response_id = f"as-{uuid.uuid4().hex[:12]}"
+        model = body.get("model", "ernie-mock")
+        created = int(time.time())
+        per_chunk = 2 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+        if body.get("stream"):
+            return StreamingResponse(
+                self.stream(text, usage, response_id, model, created, per_chunk,
+                            (body.get("stream_options") or {}).get("include_usage")),
+                media_type="text/event-stream",
+            )
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.first_token_delay() + per_chunk * len(self.chunks(text)))
+        finally:
+            self.in_flight -= 1
+        return JSONResponse({
+            "id": response_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    async def stream(self, text, usage, response_id, model, created, per_chunk, include_usage):
+        def event(choices, **extra):
+            payload = {"id": response_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.first_token_delay())
+            for chunk in self.chunks(text):
+                yield event([{"index": 0, "delta": {"content": chunk}, "finish_reason": None}])
+                await asyncio.sleep(per_chunk)
+            yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                yield event([], usage=usage)
+            yield "data: [DONE]\n\n"
+        finally:
+            self.in_flight -= 1
+
+    async def stats(self, request):
+        return JSONResponse({
+            "requests": self.requests,
+            "malformed": self.malformed,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+        })
+
+
+def create_app(mock):
+    return Starlette(routes=[
+        Route("/llm/lmapi/v3/chat/completions", mock.completions, methods=["POST"]),
+        Route("/stats", mock.stats, methods=["GET"]),
+    ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=2.0, help="median seconds to the first token")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal shape of the first-token delay")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share of JSON replies cut short")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 503")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockErnie(args.latency, args.sigma, args.tokens_per_second, args.malformed_rate,
+                     args.error_rate, args.seed)
+    uvicorn.run(create_app(mock), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Token-bounded chat context: recent turns verbatim, older turns folded into a rolling summary.
+
+Token counts are a local estimate (no tokenizer round trip): one token per
+CJK character and one per four other characters, plus a few per message.
+Summaries are cached under a hash of the conversation prefix they cover, so
+each turn only folds in the turns that left the window since the last one.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+
+from metrics import log_event
+from single_flight import SingleFlight
+
+CJK = re.compile(r"[　-〿一-鿿＀-￯]")
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_HEADER = "Summary of the earlier conversation (older messages are not shown):\n"
+
+
+def estimate_tokens(text):
+    """Rough token count of a string"""
+    if not text:
+        return 0
+    text = text if isinstance(text, str) else json.dumps(text, ensure_ascii=False)
+    cjk = len(CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_tokens(messages):
+    return sum(estimate_tokens(message.get("content")) + MESSAGE_OVERHEAD for message in messages)
+
+
+def prefix_hashes(messages):
+    """hashes[i] identifies messages[:i], whatever follows it"""
+    hashes = [hashlib.sha256(b"").hexdigest()]
+    for message in messages:
+        digest = hashlib.sha256(hashes[-1].encode("ascii"))
+        digest.update(json.dumps([message.get("role"), message.get("content")], ensure_ascii=False).encode("utf-8"))
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+def turn_starts(messages):
+    """Indices of the user messages that open each turn"""
+    return [i for i, message in enumerate(messages) if message.get("role") == "user"]
+
+
+class ChatContext:
+    """Fits a conversation into `budget` estimated tokens before it goes upstream.
+
+    Conversations that already fit are sent unchanged. Otherwise the last
+    `keep_turns` turns stay verbatim and everything before them is replaced
+    by a summary appended to the system prompt. `summarize(summary, messages)`
+    folds messages into a summary, at most `summary_chunk` tokens of them per
+    call. When a cached summary plus the not-yet-summarized turns still fits,
+    the request goes out at once and the summary is extended in the background
+    for the next turn; only when it does not fit does the request wait.
+    """
+
+    def __init__(self, summarize, cache, budget=6000, keep_turns=6, summary_chunk=3000):
+        self.summarize = summarize
+        self.cache = cache
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.summary_chunk = summary_chunk
+
+        self._flight = SingleFlight()
+        self._tasks = set()
+
+        self.requests = 0
+        self.trimmed = 0
+        self.tokens_saved = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    async def prepare(self, formatted_messages):
+        """Return (messages to send, context report) for a system prompt plus history"""
+        self.requests += 1
+        head = 0
+        while head < len(formatted_messages) and formatted_messages[head].get("role") == "system":
+            head += 1
+        system, history = formatted_messages[:head], formatted_messages[head:]
+
+        full = count_tokens(formatted_messages)
+        starts = turn_starts(history)
+        window_start = starts[-self.keep_turns] if len(starts) >= self.keep_turns else 0
+        if full <= self.budget or window_start == 0:
+            return formatted_messages, self._report(full, full, 0, 0, False)
+
+        hashes = prefix_hashes(history[:window_start])
+        boundaries = [i for i in starts if i <= window_start]
+        summary, covered = self._cached_summary(hashes, boundaries)
+
+        pending = covered < window_start
+        if pending:
+            if count_tokens(self._build(system, summary, history[covered:])) > self.budget:
+                try:
+                    summary, covered = await self._extend(history, hashes, boundaries, summary, covered)
+                    pending = False
+                except Exception as e:
+                    # Better to lose the oldest turns than to fail the chat
+                    self.summary_failures += 1
+                    log_event("chat_summary_error", logging.WARNING, error=type(e).__name__, message=str(e))
+                    covered = window_start
+            else:
+                self._extend_later(history, hashes, boundaries, summary, covered)
+
+        kept = history[covered:]
+        messages = self._build(system, summary, kept)
+        dropped = 0
+        # Only very long recent turns get here; keep at least the latest one
+        kept_starts = turn_starts(kept)
+        while count_tokens(messages) > self.budget and len(kept_starts) > 1:
+            kept_starts.pop(0)
+            dropped = kept_starts[0]
+            messages = self._build(system, summary, kept[dropped:])
+
+        sent = count_tokens(messages)
+        self.trimmed += 1
+        self.tokens_saved += full - sent
+        return messages, self._report(full, sent, covered, dropped, pending)
+
+    def _cached_summary(self, hashes, boundaries):
+        """Longest summarized prefix of the history, as (summary, messages covered)"""
+        for end in reversed(boundaries):
+            if end == 0:
+                break
+            entry = self.cache.get(f"chat_summary:{hashes[end]}")
+            if entry is not None:
+                return entry["summary"], end
+        return None, 0
+
+    async def _extend(self, history, hashes, boundaries, summary, covered):
+        """Fold turns up to the last boundary into the summary, chunk by chunk"""
+        target = boundaries[-1]
+
+        async def fold():
+            nonlocal summary, covered
+            while covered < target:
+                # Whole turns, as many as fit in one chunk (at least one)
+                end = next(i for i in boundaries if i > covered)
+                for i in boundaries:
+                    if i > end and count_tokens(history[covered:i]) <= self.summary_chunk:
+                        end = i
+                summary = await self.summarize(summary, history[covered:end])
+                self.summaries += 1
+                self.cache.set(f"chat_summary:{hashes[end]}", {"summary": summary})
+                covered = end
+            return summary, covered
+
+        return await self._flight.do(hashes[target], fold)
+
+    def _extend_later(self, history, hashes, boundaries, summary, covered):
+        async def run():
+            try:
+                await self._extend(history, hashes, boundaries, summary, covered)
+            except Exception as e:
+                self.summary_failures += 1
+                log_event("chat_summary_error", logging.WARNING, error=type(e).__name__, message=str(e))
+
+        task = asyncio.get_running_loop().create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _build(self, system, summary, kept):
+        if not summary:
+            return list(system) + list(kept)
+        if system:
+            first = {**system[0], "content": f"{system[0]['content']}\n\n{SUMMARY_HEADER}{summary}"}
+            return [first, *system[1:], *kept]
+        return [{"role": "system", "content": SUMMARY_HEADER + summary}, *kept]
+
+    def _report(self, full, sent, summarized, dropped, pending):
+        return {
+            "tokens_full": full,
+            "tokens_sent": sent,
+            "tokens_saved": full - sent,
+            "summarized_messages": summarized,
+            "dropped_messages": dropped,
+            "summary_pending": pending,
+        }
+
+    def stats(self):
+        return {
+            "budget": self.budget,
+            "keep_turns": self.keep_turns,
+            "requests": self.requests,
+            "trimmed": self.trimmed,
+            "tokens_saved": self.tokens_saved,
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "summaries_in_flight": self._flight.stats()["in_flight"],
+        }
@@ -0,0 +1,6 @@
+class ServiceError(Exception):
+    """An error that should reach the client with a specific HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
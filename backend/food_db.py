@@ -0,0 +1,590 @@
+"""Local food-composition database for free-text meals, e.g. "2 boiled eggs and a slice of wholemeal toast".
+
+Foods come from data/foods.csv: per-100 g nutrients, English and Chinese
+names with aliases, and named portions such as piece=50. The CSV is compiled
+into flat NumPy arrays (an inverted token index over every name and alias)
+that are written next to it and memory-mapped on later starts, so loading
+stays fast and light as the table grows. Descriptions the table cannot
+account for return None, so the caller can fall back to the model.
+
+Build the index ahead of time with:
+
+    python food_db.py build [data/foods.csv] [data/foods_index]
+"""
+import bisect
+import csv
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import unicodedata
+
+import numpy as np
+
+from metrics import log_event
+
+NUTRIENTS = ("calories", "protein", "carbs", "fats", "fiber", "sugar", "sodium")
+
+DEFAULT_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "foods.csv")
+
+INDEX_ARRAYS = (
+    "nutrients", "doc_food", "doc_len", "doc_offsets", "doc_terms", "offsets", "postings", "posting_len", "idf",
+)
+
+TOKEN = re.compile(r"[a-z0-9]+|[一-鿿]+")
+CJK = re.compile(r"[一-鿿]")
+STOPWORDS = {"a", "an", "the", "of", "and", "with", "some", "my"}
+# Descriptive words that cost a match little when the table has no variant for them
+MODIFIERS = {
+    "grilled", "baked", "boiled", "steamed", "fried", "roasted", "cooked", "raw", "fresh",
+    "homemade", "plain", "small", "medium", "large", "big", "hot", "warm", "cold",
+}
+MODIFIER_WEIGHT = 0.25
+
+# Mass-equivalent units; ml is counted as grams, which is close enough for drinks and soups
+GRAMS_PER_UNIT = {"g": 1, "kg": 1000, "ml": 1, "l": 1000}
+
+UNIT_ALIASES = {
+    "g": "g", "gram": "g", "grams": "g", "克": "g",
+    "kg": "kg", "千克": "kg", "公斤": "kg",
+    "ml": "ml", "毫升": "ml",
+    "l": "l", "litre": "l", "litres": "l", "liter": "l", "liters": "l", "升": "l",
+    "cup": "cup", "cups": "cup", "杯": "cup",
+    "glass": "glass", "glasses": "glass",
+    "bowl": "bowl", "bowls": "bowl", "碗": "bowl",
+    "plate": "plate", "plates": "plate", "盘": "plate",
+    "slice": "slice", "slices": "slice", "片": "slice",
+    "piece": "piece", "pieces": "piece", "pcs": "piece",
+    "个": "piece", "只": "piece", "颗": "piece", "根": "piece", "条": "piece", "块": "piece", "串": "piece",
+    "serving": "serving", "servings": "serving", "portion": "serving", "portions": "serving", "份": "serving",
+    "tbsp": "tbsp", "tablespoon": "tbsp", "tablespoons": "tbsp", "勺": "tbsp", "汤匙": "tbsp",
+    "tsp": "tsp", "teaspoon": "tsp", "teaspoons": "tsp", "茶匙": "tsp",
+    "can": "can", "cans": "can", "瓶": "can", "罐": "can",
+    "handful": "handful", "handfuls": "handful", "把": "handful",
+    "scoop": "scoop", "scoops": "scoop",
+    "fillet": "fillet", "fillets": "fillet",
+    "bar": "bar", "bars": "bar",
+    "bag": "bag", "bags": "bag",
+    "pack": "pack", "packs": "pack", "packet": "pack", "包": "pack",
+    "tub": "tub", "tubs": "tub",
+}
+
+# Portions a food may list under a related name
+PORTION_FALLBACKS = {"glass": ("cup", 1), "cup": ("glass", 1), "tsp": ("tbsp", 1 / 3), "tbsp": ("tsp", 3)}
+
+EN_AMOUNTS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "half": 0.5, "half a": 0.5, "half an": 0.5, "a half": 0.5, "a couple of": 2,
+}
+ZH_DIGITS = {"一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+_EN_UNITS = "|".join(sorted((re.escape(u) for u in UNIT_ALIASES if u.isascii()), key=len, reverse=True))
+_ZH_UNITS = "|".join(sorted((re.escape(u) for u in UNIT_ALIASES if not u.isascii()), key=len, reverse=True))
+_EN_AMOUNT = "|".join(sorted((re.escape(a) for a in EN_AMOUNTS), key=len, reverse=True))
+
+# "2 slices of toast", "200g rice", "half a cup of milk"
+QUANTITY_EN = re.compile(
+    rf"^(?:(?P<amount>\d+(?:\.\d+)?(?:/\d+)?|(?:{_EN_AMOUNT})\b)\s*(?:x\b\s*)?)?"
+    rf"(?:(?P<unit>{_EN_UNITS})\b\s*)?(?:of\s+)?(?P<food>.+)$",
+    re.IGNORECASE,
+)
+# "两碗米饭", "2个鸡蛋"; a Chinese numeral must be followed by a unit so 三文鱼 stays salmon
+QUANTITY_ZH = re.compile(
+    rf"^(?:(?P<amount>\d+(?:\.\d+)?)\s*(?P<unit>{_ZH_UNITS})?|(?P<zh_amount>[一二两三四五六七八九十半]+)(?P<zh_unit>{_ZH_UNITS}))"
+    rf"\s*(?P<food>.+)$"
+)
+# "rice 200g", "鸡蛋2个", "eggs x2"
+QUANTITY_SUFFIX = re.compile(
+    rf"^(?P<food>.+?)\s*(?:x\s*(?P<times>\d+)|(?P<amount>\d+(?:\.\d+)?)\s*(?P<unit>{_EN_UNITS}|{_ZH_UNITS}))$",
+    re.IGNORECASE,
+)
+
+SEGMENT_SEPARATORS = re.compile(r"\s*(?:[,，、;；\n+&]|\bplus\b)\s*", re.IGNORECASE)
+CONJUNCTIONS = re.compile(r"\s+(?:and|with)\s+|\s*[和加配跟]\s*", re.IGNORECASE)
+
+
+def round_half_up(value):
+    return int(math.floor(value + 0.5))
+
+
+def _stem(word):
+    """Fold English plurals so "eggs" and "strawberries" index as "egg" and "strawberry\""""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("oes", "ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us")):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Index terms: stemmed English words, and Chinese character bigrams"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    tokens = []
+    for run in TOKEN.findall(text):
+        if CJK.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif run not in STOPWORDS and not run.isdigit():
+            tokens.append(_stem(run))
+    return list(dict.fromkeys(tokens))
+
+
+def _zh_number(text):
+    if text == "半":
+        return 0.5
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        return ZH_DIGITS.get(tens, 1) * 10 + ZH_DIGITS.get(ones, 0)
+    return ZH_DIGITS.get(text)
+
+
+def _amount(text):
+    text = text.casefold()
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return float(numerator) / float(denominator) if float(denominator) else None
+    if text in EN_AMOUNTS:
+        return EN_AMOUNTS[text]
+    return float(text)
+
+
+def parse_quantity(segment):
+    """Split one meal item into (amount, unit, food text); unit is None when not given"""
+    segment = unicodedata.normalize("NFKC", segment).strip()
+
+    match = QUANTITY_SUFFIX.match(segment)
+    if match and not QUANTITY_EN.match(segment).group("amount"):
+        if match.group("times"):
+            return float(match.group("times")), None, match.group("food")
+        return float(match.group("amount")), UNIT_ALIASES[match.group("unit").casefold()], match.group("food")
+
+    if CJK.match(segment) or re.match(r"\d+(?:\.\d+)?\s*(?:" + _ZH_UNITS + ")", segment):
+        match = QUANTITY_ZH.match(segment)
+        if match:
+            if match.group("zh_amount"):
+                amount = _zh_number(match.group("zh_amount"))
+                unit = match.group("zh_unit")
+            else:
+                amount = float(match.group("amount"))
+                unit = match.group("unit")
+            if amount:
+                return amount, UNIT_ALIASES[unit] if unit else None, match.group("food")
+        return 1, None, segment
+
+    match = QUANTITY_EN.match(segment)
+    amount = _amount(match.group("amount")) if match.group("amount") else 1
+    unit = match.group("unit")
+    return amount or 1, UNIT_ALIASES[unit.casefold()] if unit else None, match.group("food")
+
+
+def portion_grams(portions, amount, unit):
+    """Weight of `amount` `unit`s of a food, falling back to its default portion"""
+    if unit in GRAMS_PER_UNIT:
+        return amount * GRAMS_PER_UNIT[unit]
+    if unit in portions:
+        return amount * portions[unit]
+    if unit in PORTION_FALLBACKS:
+        other, ratio = PORTION_FALLBACKS[unit]
+        if other in portions:
+            return amount * portions[other] * ratio
+    return amount * next(iter(portions.values()))
+
+
+def _parse_portions(text):
+    portions = {}
+    for part in text.split("|"):
+        unit, _, grams = part.partition("=")
+        portions[unit.strip()] = float(grams)
+    return portions
+
+
+class FoodDatabase:
+    """Foods as column arrays, with inverted (term -> names) and forward (name -> terms) indexes.
+
+    Each English name, Chinese name and alias is one indexed name that points
+    at its food. Postings are ordered shortest name first. The vocabulary is
+    a sorted list, so a word missing from it can still match by prefix
+    ("straw" -> "strawberry").
+    """
+
+    def __init__(
+        self, names_en, names_zh, portions, vocab,
+        nutrients, doc_food, doc_len, doc_offsets, doc_terms, offsets, postings, posting_len, idf,
+    ):
+        self.names_en = names_en
+        self.names_zh = names_zh
+        self.portions = portions
+        self.vocab = vocab
+        self.token_ids = {token: i for i, token in enumerate(vocab)}
+        self.nutrients = nutrients
+        self.doc_food = doc_food
+        self.doc_len = doc_len
+        self.doc_offsets = doc_offsets
+        self.doc_terms = doc_terms
+        self.offsets = offsets
+        self.postings = postings
+        self.posting_len = posting_len
+        self.idf = idf
+        self.max_idf = float(idf.max()) if len(idf) else 1.0
+        self.source = "csv"
+        self._local = threading.local()
+
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_csv(cls, path):
+        names_en, names_zh, portions, nutrients = [], [], [], []
+        documents = []
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                food = len(names_en)
+                names_en.append(row["name_en"])
+                names_zh.append(row["name_zh"])
+                portions.append(_parse_portions(row["portions"]))
+                nutrients.append([float(row[field]) for field in NUTRIENTS])
+                names = [row["name_en"], row["name_zh"], *row["aliases"].split("|")]
+                seen = set()
+                for name in names:
+                    tokens = tokenize(name)
+                    key = tuple(sorted(tokens))
+                    if tokens and key not in seen:
+                        seen.add(key)
+                        documents.append((food, tokens))
+
+        vocab = sorted({token for _, tokens in documents for token in tokens})
+        token_ids = {token: i for i, token in enumerate(vocab)}
+        buckets = [[] for _ in vocab]
+        for doc, (_, tokens) in enumerate(documents):
+            for token in tokens:
+                buckets[token_ids[token]].append(doc)
+        # Shortest names first, so a lookup can stop reading where names get too long to match
+        doc_len = np.array([len(tokens) for _, tokens in documents], dtype=np.int16)
+        for bucket in buckets:
+            bucket.sort(key=lambda doc: doc_len[doc])
+
+        lengths = np.array([len(bucket) for bucket in buckets], dtype=np.int32)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        postings = np.fromiter((doc for bucket in buckets for doc in bucket), dtype=np.int32, count=int(offsets[-1]))
+        posting_len = np.minimum(doc_len[postings], 255).astype(np.uint8)
+        doc_offsets = np.zeros(len(documents), dtype=np.int64)
+        np.cumsum(doc_len[:-1], out=doc_offsets[1:])
+        doc_terms = np.fromiter(
+            (token_ids[token] for _, tokens in documents for token in tokens), dtype=np.int32, count=int(doc_len.sum())
+        )
+        idf = np.log(1 + len(documents) / np.maximum(lengths, 1)).astype(np.float32)
+
+        return cls(
+            names_en, names_zh, portions, vocab,
+            nutrients=np.array(nutrients, dtype=np.float32).reshape(-1, len(NUTRIENTS)),
+            doc_food=np.array([food for food, _ in documents], dtype=np.int32),
+            doc_len=doc_len,
+            doc_offsets=doc_offsets,
+            doc_terms=doc_terms,
+            offsets=offsets,
+            postings=postings,
+            posting_len=posting_len,
+            idf=idf,
+        )
+
+    def save(self, directory, source=None):
+        """Write the compiled index; meta.json goes last and marks it complete"""
+        os.makedirs(directory, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            tmp = os.path.join(directory, f"{name}.tmp.npy")
+            np.save(tmp, np.ascontiguousarray(getattr(self, name)))
+            os.replace(tmp, os.path.join(directory, f"{name}.npy"))
+        meta = {
+            "source": source,
+            "names_en": self.names_en,
+            "names_zh": self.names_zh,
+            "portions": self.portions,
+            "vocab": self.vocab,
+        }
+        tmp = os.path.join(directory, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(directory, "meta.json"))
+
+    @classmethod
+    def load(cls, directory, source=None):
+        """Memory-map a saved index; returns None if it is missing or was built from another CSV"""
+        try:
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if source is not None and meta.get("source") != source:
+                return None
+            # Plain ndarray views of the mapping; slicing np.memmap objects is several times slower
+            arrays = {
+                name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r").view(np.ndarray)
+                for name in INDEX_ARRAYS
+            }
+        except (OSError, ValueError):
+            return None
+        db = cls(meta["names_en"], meta["names_zh"], meta["portions"], meta["vocab"], **arrays)
+        db.source = "mmap"
+        return db
+
+    @classmethod
+    def open(cls, csv_path=DEFAULT_CSV, index_dir=None):
+        """Load the prebuilt index for `csv_path`, compiling and saving it first if it is stale"""
+        index_dir = index_dir or os.path.join(os.path.dirname(csv_path), "foods_index")
+        stat = os.stat(csv_path)
+        source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+        db = cls.load(index_dir, source)
+        if db is not None:
+            return db
+
+        db = cls.from_csv(csv_path)
+        try:
+            db.save(index_dir, source)
+        except OSError as e:
+            log_event("food_index_save_error", logging.WARNING, index_dir=index_dir, message=str(e))
+        return db
+
+    def _terms(self, token):
+        """Vocabulary ids a query token matches, with a weight discount for inexact matches"""
+        token_id = self.token_ids.get(token)
+        if token_id is not None:
+            return [(token_id, 1.0)]
+        if CJK.match(token) or len(token) < 3:
+            return []
+        # Query word is a prefix of indexed words ("straw"), or an indexed word prefixes it ("wholegrain")
+        start = bisect.bisect_left(self.vocab, token)
+        terms = []
+        for i in range(start, min(start + 8, len(self.vocab))):
+            if not self.vocab[i].startswith(token):
+                break
+            terms.append((i, 0.8))
+        for cut in range(len(token) - 1, max(len(token) - 4, 3), -1):
+            token_id = self.token_ids.get(token[:cut])
+            if token_id is not None:
+                terms.append((token_id, 0.8))
+                break
+        return terms
+
+    def match(self, text, min_score=0.0, min_coverage=0.0):
+        """Best (food id, score, coverage) for a food name, or None.
+
+        `coverage` is the share of the query the name explains; `score` also
+        penalises name words the query lacks, and is 1.0 for an exact name or alias.
+        Names that cannot reach `min_score` and `min_coverage` are never scored.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+
+        total = 0.0
+        query = []
+        for token in tokens:
+            terms = self._terms(token)
+            # Words the table has never seen count fully against the match
+            weight = max(float(self.idf[i]) for i, _ in terms) if terms else self.max_idf
+            total += weight * MODIFIER_WEIGHT if token in MODIFIERS else weight
+            if terms:
+                query.append((max(float(self.idf[i]) * discount for i, discount in terms), terms))
+        if not query:
+            return None
+
+        # Coverage cannot exceed the share of the query the table knows at all, and a
+        # name of n words matching k terms scores at most that times sqrt(k / n)
+        max_coverage = min(sum(weight for weight, _ in query) / total, 1.0)
+        if max_coverage < min_coverage or max_coverage < min_score:
+            return None
+        n_terms = sum(len(terms) for _, terms in query)
+        max_len = int(n_terms * (max_coverage / min_score) ** 2) if min_score > 0 else 255
+
+        # Only names containing at least one "essential" word can reach min_coverage:
+        # the rarer words, once the commonest words' combined weight falls short of it
+        query.sort(key=lambda entry: entry[0])
+        essential = []
+        skipped = 0.0
+        for weight, terms in query:
+            if skipped + weight < min_coverage * total:
+                skipped += weight
+            else:
+                essential.extend(terms)
+
+        candidates = []
+        for token_id, _ in essential:
+            start, end = self.offsets[token_id], self.offsets[token_id + 1]
+            end = start + int(np.searchsorted(self.posting_len[start:end], max_len, side="right"))
+            if end > start:
+                candidates.append(self.postings[start:end])
+        if not candidates:
+            return None
+        # A name holding several essential words appears more than once; scoring it twice is cheaper than deduplicating
+        docs = np.concatenate(candidates) if len(candidates) > 1 else candidates[0]
+
+        # Score candidates through the forward index (each name's terms) against
+        # per-thread term weights, so long postings of common words are never read
+        term_weight = self._term_weights()
+        for weight, terms in query:
+            for token_id, discount in terms:
+                term_weight[token_id] = self.idf[token_id] * discount
+        try:
+            lengths = self.doc_len[docs].astype(np.int64)
+            starts = np.asarray(self.doc_offsets[docs], dtype=np.int64)
+            segment_starts = np.zeros(len(docs), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=segment_starts[1:])
+            positions = np.repeat(starts - segment_starts, lengths) + np.arange(int(lengths.sum()))
+            weights = term_weight[self.doc_terms[positions]]
+            matched = np.add.reduceat(weights, segment_starts)
+            counts = np.add.reduceat((weights > 0).astype(np.int16), segment_starts)
+        finally:
+            for weight, terms in query:
+                for token_id, _ in terms:
+                    term_weight[token_id] = 0
+
+        coverage = np.minimum(matched / total, 1.0)
+        # Share of the query explained, damped by how much of the name went unmatched
+        scores = coverage * np.sqrt(np.minimum(counts / lengths, 1.0))
+        best = int(np.argmax(scores))
+        return int(self.doc_food[docs[best]]), float(scores[best]), float(coverage[best])
+
+    def _term_weights(self):
+        local = self._local
+        if not hasattr(local, "term_weight"):
+            local.term_weight = np.zeros(len(self.vocab), dtype=np.float32)
+        return local.term_weight
+
+    def _match_segment(self, segment, min_score, min_coverage, depth=0):
+        """Resolve one separator-delimited segment into [(food, grams)], or None"""
+        amount, unit, food_text = parse_quantity(segment)
+        found = self.match(food_text, min_score, min_coverage)
+        whole = None
+        if found is not None and found[1] >= min_score and found[2] >= min_coverage:
+            food = found[0]
+            whole = [(food, portion_grams(self.portions[food], amount, unit))]
+            if found[2] >= 0.999:
+                return whole
+
+        # "eggs and toast": split at one conjunction at a time, so that names like
+        # "sweet and sour pork" survive when the split falls elsewhere. A split that
+        # explains every word beats a whole-segment match that leaves some out.
+        if depth >= 3:
+            return whole
+        for conjunction in CONJUNCTIONS.finditer(segment):
+            left, right = segment[:conjunction.start()], segment[conjunction.end():]
+            if not left.strip() or not right.strip():
+                continue
+            resolved_left = self._match_segment(left, min_score, min_coverage, depth + 1)
+            if resolved_left is None:
+                continue
+            resolved_right = self._match_segment(right, min_score, min_coverage, depth + 1)
+            if resolved_right is not None:
+                return resolved_left + resolved_right
+        return whole
+
+    def lookup(self, description, min_score=0.75, min_coverage=0.8):
+        """Resolve a meal description into [(food, grams)], or None unless every item matches"""
+        if not description or len(description) > 500:
+            return None
+        items = []
+        for segment in SEGMENT_SEPARATORS.split(description.strip()):
+            if not segment.strip():
+                continue
+            resolved = self._match_segment(segment, min_score, min_coverage)
+            if resolved is None:
+                return None
+            items.extend(resolved)
+        return items or None
+
+    def estimate(self, description, lang="en", min_score=0.75, min_coverage=0.8):
+        """Return a nutrition dict in the /analyze schema, or None if any item is unknown"""
+        items = self.lookup(description, min_score, min_coverage)
+        with self._lock:
+            self.lookups += 1
+            if items is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if items is None:
+            return None
+
+        totals = np.zeros(len(NUTRIENTS), dtype=np.float64)
+        breakdown = []
+        for food, grams in items:
+            values = self.nutrients[food].astype(np.float64) * grams / 100
+            totals += values
+            breakdown.append((food, grams, values))
+        nutrition = {field: round_half_up(value) for field, value in zip(NUTRIENTS, totals)}
+        return self._describe(nutrition, breakdown, lang)
+
+    def _describe(self, nutrition, breakdown, lang):
+        """Wrap summed values in the same descriptive fields ERNIE returns"""
+        zh = lang == "zh"
+        names = self.names_zh if zh else self.names_en
+        benefits = []
+        considerations = []
+
+        if nutrition["protein"] >= 20:
+            benefits.append("蛋白质充足，有助于肌肉修复和增加饱腹感" if zh else "Good source of protein, which supports muscle repair and satiety")
+        if nutrition["fiber"] >= 5:
+            benefits.append("膳食纤维丰富，有助于消化健康" if zh else "Rich in dietary fiber, which supports digestion")
+        if nutrition["fats"] > 30:
+            considerations.append("脂肪含量较高，注意控制食用量" if zh else "Fairly high in fat; watch portion sizes")
+        if nutrition["sugar"] > 25:
+            considerations.append("糖含量较高，控糖人群应少量食用" if zh else "Fairly high in sugar; limit if managing blood sugar")
+        if nutrition["sodium"] > 800:
+            considerations.append("钠含量较高，高血压人群应谨慎食用" if zh else "High in sodium; take care if managing blood pressure")
+        if not considerations:
+            considerations.append("份量按常见份量估算，请按实际情况调整" if zh else "Portions are typical sizes; adjust if yours were larger or smaller")
+
+        if zh:
+            serving_size = "，".join(f"{names[food]} {round_half_up(grams)}克" for food, grams, _ in breakdown)
+            explanation = "数值由本地食物成分表按份量估算：" + "；".join(
+                f"{names[food]} {round_half_up(grams)}克 ≈ {round_half_up(values[0])}千卡"
+                for food, grams, values in breakdown
+            ) + "。"
+        else:
+            serving_size = ", ".join(f"{names[food]} {round_half_up(grams)}g" for food, grams, _ in breakdown)
+            explanation = "Estimated locally from a food-composition table: " + "; ".join(
+                f"{names[food]} {round_half_up(grams)}g ≈ {round_half_up(values[0])} kcal"
+                for food, grams, values in breakdown
+            ) + "."
+
+        single = len(breakdown) == 1
+        return {
+            "name": (" + " if not zh else "、").join(names[food] for food, _, _ in breakdown),
+            "category": ("食物" if single else "餐食") if zh else ("Food" if single else "Meal"),
+            **nutrition,
+            "serving_size": serving_size,
+            "confidence": "中" if zh else "medium",
+            "benefits": benefits,
+            "considerations": considerations,
+            "explanation": explanation,
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "foods": len(self.names_en),
+                "names": len(self.doc_food),
+                "index": self.source,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        sys.exit(__doc__)
+    csv_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CSV
+    index_dir = sys.argv[3] if len(sys.argv) > 3 else os.path.join(os.path.dirname(csv_path), "foods_index")
+    stat = os.stat(csv_path)
+    db = FoodDatabase.from_csv(csv_path)
+    db.save(index_dir, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    print(f"Indexed {len(db.names_en)} foods ({len(db.doc_food)} names, {len(db.vocab)} terms) into {index_dir}")
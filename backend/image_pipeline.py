@@ -0,0 +1,206 @@
+import base64
+import io
+import threading
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+DecodedImage = namedtuple("DecodedImage", ["image", "format"])
+PreparedImage = namedtuple(
+    "PreparedImage",
+    ["data_url", "original_bytes", "encoded_bytes", "size", "cropped", "passthrough"],
+)
+
+
+def find_label_box(image, min_trim=0.15, min_keep=0.05, padding=0.04):
+    """Bounding box of the text-dense region of a photo, or None if cropping would not help.
+
+    Nutrition tables and package text are dense in sharp edges, while table
+    tops, hands and backgrounds are not. Rows and columns whose edge density
+    is well below the busiest one are trimmed from the outside in. The box is
+    only returned when it removes at least `min_trim` of the area and keeps at
+    least `min_keep` of it, so an ambiguous photo is sent whole.
+    """
+    gray = image.convert("L")
+    gray.thumbnail((256, 256))
+    pixels = np.asarray(gray, dtype=np.int16)
+    if pixels.shape[0] < 16 or pixels.shape[1] < 16:
+        return None
+
+    edges = np.zeros(pixels.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(pixels, axis=1)) > 32
+    edges[1:, :] |= np.abs(np.diff(pixels, axis=0)) > 32
+
+    row_density = edges.mean(axis=1)
+    col_density = edges.mean(axis=0)
+    rows = np.flatnonzero(row_density > 0.2 * row_density.max())
+    cols = np.flatnonzero(col_density > 0.2 * col_density.max())
+    if rows.size == 0 or cols.size == 0:
+        return None
+
+    height, width = pixels.shape
+    pad_y = int(height * padding)
+    pad_x = int(width * padding)
+    top = max(rows[0] - pad_y, 0)
+    bottom = min(rows[-1] + 1 + pad_y, height)
+    left = max(cols[0] - pad_x, 0)
+    right = min(cols[-1] + 1 + pad_x, width)
+
+    kept = (bottom - top) * (right - left) / (height * width)
+    if kept > 1 - min_trim or kept < min_keep:
+        return None
+
+    scale_x = image.width / width
+    scale_y = image.height / height
+    return (
+        int(left * scale_x),
+        int(top * scale_y),
+        int(round(right * scale_x)),
+        int(round(bottom * scale_y)),
+    )
+
+
+class ImagePipeline:
+    """Shrinks uploaded photos before they are sent to the vision model.
+
+    The upload is decoded once (JPEGs straight to a reduced size), rotated per
+    its EXIF orientation, optionally cropped to the label region, downsized to
+    `max_edge` and re-encoded. If that does not make the payload smaller the
+    original bytes are forwarded unchanged.
+    """
+
+    def __init__(self, max_edge=1280, quality=80, fmt="JPEG", crop_label=True, enabled=True):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.fmt = fmt.upper()
+        self.crop_label = crop_label
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._latency = {True: [0, 0.0], False: [0, 0.0]}  # passthrough -> [count, total_ms]
+
+    def decode(self, image_bytes):
+        """Decode and orient an upload, or return None if Pillow cannot read it"""
+        try:
+            image = Image.open(io.BytesIO(image_bytes))
+            fmt = image.format
+            image.draft("RGB", (self.max_edge, self.max_edge))
+            image = ImageOps.exif_transpose(image)
+            image.load()
+            return DecodedImage(image, fmt)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+
+    def prepare(self, image_bytes, decoded=None):
+        """Build the data URL sent upstream; `decoded` reuses (and consumes) an earlier decode()"""
+        if self.enabled and decoded is None:
+            decoded = self.decode(image_bytes)
+        if not self.enabled or decoded is None:
+            return self._passthrough(image_bytes, decoded)
+
+        image = decoded.image
+        cropped = False
+        if self.crop_label:
+            box = find_label_box(image)
+            if box is not None:
+                image = image.crop(box)
+                cropped = True
+
+        if max(image.size) > self.max_edge:
+            # In place: the decoded image is not needed once it has been prepared
+            image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        if self.fmt == "WEBP":
+            image.save(buffer, "WEBP", quality=self.quality, method=4)
+        else:
+            image.save(buffer, "JPEG", quality=self.quality, optimize=True, progressive=True)
+        encoded = buffer.getbuffer()
+
+        if len(encoded) >= len(image_bytes) and not cropped and decoded.format in MIME_TYPES:
+            return self._passthrough(image_bytes, decoded)
+
+        return PreparedImage(
+            data_url=_data_url(MIME_TYPES[self.fmt], encoded),
+            original_bytes=len(image_bytes),
+            encoded_bytes=len(encoded),
+            size=image.size,
+            cropped=cropped,
+            passthrough=False,
+        )
+
+    def record(self, prepared, upstream_ms):
+        """Account one upstream call and return the per-request report.
+
+        `upstream_delta_ms` compares this call against the running mean of the
+        other kind (passthrough vs preprocessed), so it only becomes available
+        once both kinds have been observed, e.g. with IMAGE_PREPROCESS toggled.
+        """
+        with self._lock:
+            self.requests += 1
+            self.bytes_in += prepared.original_bytes
+            self.bytes_out += prepared.encoded_bytes
+            bucket = self._latency[prepared.passthrough]
+            bucket[0] += 1
+            bucket[1] += upstream_ms
+            other_count, other_total = self._latency[not prepared.passthrough]
+
+        delta = None
+        if other_count:
+            baseline, measured = other_total / other_count, upstream_ms
+            if prepared.passthrough:
+                baseline, measured = measured, baseline
+            delta = round(measured - baseline, 1)
+
+        return {
+            "original_bytes": prepared.original_bytes,
+            "upstream_bytes": prepared.encoded_bytes,
+            "bytes_saved": prepared.original_bytes - prepared.encoded_bytes,
+            "size": list(prepared.size) if prepared.size else None,
+            "cropped": prepared.cropped,
+            "passthrough": prepared.passthrough,
+            "upstream_ms": round(upstream_ms, 1),
+            "upstream_delta_ms": delta,
+        }
+
+    def stats(self):
+        with self._lock:
+            processed_count, processed_total = self._latency[False]
+            passthrough_count, passthrough_total = self._latency[True]
+            return {
+                "enabled": self.enabled,
+                "max_edge": self.max_edge,
+                "quality": self.quality,
+                "format": self.fmt,
+                "requests": self.requests,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "mean_upstream_ms": round(processed_total / processed_count, 1) if processed_count else None,
+                "mean_upstream_ms_passthrough": round(passthrough_total / passthrough_count, 1) if passthrough_count else None,
+            }
+
+    def _passthrough(self, image_bytes, decoded):
+        fmt = decoded.format if decoded is not None else None
+        return PreparedImage(
+            data_url=_data_url(MIME_TYPES.get(fmt, "image/jpeg"), image_bytes),
+            original_bytes=len(image_bytes),
+            encoded_bytes=len(image_bytes),
+            size=decoded.image.size if decoded is not None else None,
+            cropped=False,
+            passthrough=True,
+        )
+
+
+def _data_url(mime_type, data):
+    # A single base64 pass straight from the buffer, then one ASCII decode
+    return "data:" + mime_type + ";base64," + base64.b64encode(data).decode("ascii")
@@ -0,0 +1,322 @@
+"""Persistent job queue for long-running analyses and meal plans.
+
+A submitted job is written to SQLite and answered with its ID at once; a
+pool of worker coroutines on the server's event loop picks queued jobs up by
+priority, runs the registered handler for the job's kind and stores the
+result. Clients poll, or long-poll with `wait()`, for the outcome.
+
+Several processes may share one database. A job is claimed inside a
+`BEGIN IMMEDIATE` transaction and only if it is still queued, so no two
+workers run it. While it runs its worker renews a lease on it; a running job
+whose lease has expired (its process died) is queued again.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from errors import ServiceError
+from metrics import log_event
+from single_flight import flight_key
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class QueueFull(ServiceError):
+    def __init__(self, limit):
+        super().__init__(f"Too many queued jobs ({limit}), please try again shortly", status=503)
+
+
+class JobQueue:
+    """SQLite-backed priority queue served by `workers` coroutines.
+
+    Jobs with a higher priority run first, then the oldest. A submission
+    whose request key matches a job that is queued, running or succeeded
+    (and still retained) gets that job back instead of a new one. Finished
+    jobs are kept for `retention` seconds and at most `max_finished` of them;
+    at most `max_queued` jobs may wait at once. A running job's lease is
+    renewed every `lease / 3` seconds.
+    """
+
+    def __init__(self, db_path=":memory:", workers=8, retention=24 * 3600, max_finished=10_000,
+                 max_queued=1000, purge_interval=60, lease=60):
+        self.workers = workers
+        self.retention = retention
+        self.max_finished = max_finished
+        self.max_queued = max_queued
+        self.purge_interval = purge_interval
+        self.lease = lease
+
+        self._owner = uuid.uuid4().hex  # marks the jobs this queue's workers hold
+        self._running = set()
+        self._handlers = {}
+        self._tasks = []
+        self._wakeup = None
+        self._finished = {}  # job id -> asyncio.Event, for long-polling clients
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.requeued = 0
+
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Autocommit; transactions are opened explicitly with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, request_key TEXT NOT NULL, priority INTEGER NOT NULL, "
+            "status TEXT NOT NULL, payload TEXT, result TEXT, error TEXT, error_status INTEGER, "
+            "created_at REAL NOT NULL, started_at REAL, finished_at REAL, owner TEXT, lease_until REAL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (request_key, status)")
+        self._requeue_expired()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Caller holds the lock. IMMEDIATE takes the write lock up front, so other
+        # processes cannot change what this transaction has read before it writes.
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _requeue_expired(self):
+        """Queue again the running jobs whose worker stopped renewing their lease"""
+        with self._lock, self._transaction():
+            requeued = self._db.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, owner = NULL, lease_until = NULL "
+                "WHERE status = ? AND (lease_until IS NULL OR lease_until < ?)",
+                (QUEUED, RUNNING, time.time()),
+            ).rowcount
+        self.requeued += requeued
+        return requeued
+
+    def register(self, kind, handler):
+        """Run `await handler(payload)` for jobs of `kind`; its JSON-serializable return value is the result"""
+        self._handlers[kind] = handler
+
+    def start(self):
+        """Start the worker pool on the running event loop (once)"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, kind, payload, priority=0):
+        """Queue a job, or return the matching one already queued, running or done"""
+        if kind not in self._handlers:
+            raise ServiceError(f"Unknown job type: {kind}")
+        self.start()
+        key = flight_key({"kind": kind, "payload": payload})
+        now = time.time()
+        with self._lock, self._transaction():
+            row = self._db.execute(
+                "SELECT id, status, priority FROM jobs WHERE request_key = ? AND status IN (?, ?, ?) "
+                "ORDER BY created_at DESC LIMIT 1",
+                (key, QUEUED, RUNNING, SUCCEEDED),
+            ).fetchone()
+            if row is not None:
+                job_id, status, current = row
+                if status == QUEUED and priority > current:
+                    self._db.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id))
+                self.deduplicated += 1
+                return self._get(job_id)
+
+            queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull(self.max_queued)
+
+            job_id = uuid.uuid4().hex
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, request_key, priority, status, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, key, priority, QUEUED, json.dumps(payload, ensure_ascii=False), now),
+            )
+            self.submitted += 1
+            job = self._get(job_id)
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id):
+        """The job's public record, or None if it is unknown or no longer retained"""
+        with self._lock:
+            return self._get(job_id)
+
+    async def wait(self, job_id, timeout=None):
+        """Return the job once it has finished, or as it stands after `timeout` seconds"""
+        self.start()
+        job = self.get(job_id)
+        if job is None or job["status"] in FINISHED or timeout == 0:
+            return job
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except TimeoutError:
+            pass
+        return self.get(job_id)
+
+    def _get(self, job_id):
+        # Caller holds the lock
+        row = self._db.execute(
+            "SELECT id, kind, priority, status, result, error, error_status, created_at, started_at, finished_at "
+            "FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job_id, kind, priority, status, result, error, error_status, created_at, started_at, finished_at = row
+        job = {
+            "id": job_id,
+            "type": kind,
+            "priority": priority,
+            "status": status,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+        if status == SUCCEEDED:
+            job["result"] = json.loads(result)
+        elif status == FAILED:
+            job["error"] = error
+            job["error_status"] = error_status
+        return job
+
+    def _claim(self):
+        """Mark the next job running and return (id, kind, payload), or None if none is queued"""
+        with self._lock, self._transaction():
+            row = self._db.execute(
+                "SELECT id, kind, payload FROM jobs WHERE status = ? ORDER BY priority DESC, created_at LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            claimed = self._db.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, owner = ?, lease_until = ? WHERE id = ? AND status = ?",
+                (RUNNING, now, self._owner, now + self.lease, row[0], QUEUED),
+            ).rowcount
+        if not claimed:
+            return None
+        self._running.add(row[0])
+        return row[0], row[1], json.loads(row[2])
+
+    def _finish(self, job_id, result=None, error=None, error_status=None):
+        status = FAILED if error is not None else SUCCEEDED
+        self._running.discard(job_id)
+        with self._lock, self._transaction():
+            # The payload (possibly a large image) is not needed once the job is done.
+            # A job whose lease lapsed may have been claimed again elsewhere; that run records it.
+            finished = self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, error_status = ?, finished_at = ?, payload = NULL, "
+                "lease_until = NULL WHERE id = ? AND status = ? AND owner = ?",
+                (status, None if result is None else json.dumps(result, ensure_ascii=False), error, error_status,
+                 time.time(), job_id, RUNNING, self._owner),
+            ).rowcount
+        if not finished:
+            return
+        if status == SUCCEEDED:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        event = self._finished.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _work(self):
+        while True:
+            # Cleared before claiming, so a submission between the two still wakes this worker
+            self._wakeup.clear()
+            claimed = self._claim()
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.purge_interval)
+                except TimeoutError:
+                    self.purge()
+                continue
+
+            job_id, kind, payload = claimed
+            try:
+                result = await self._handlers[kind](payload)
+            except ServiceError as e:
+                self._finish(job_id, error=str(e), error_status=e.status)
+            except Exception as e:
+                log_event("job_error", logging.WARNING, job=job_id, type=kind, error=type(e).__name__, message=str(e))
+                self._finish(job_id, error=str(e), error_status=500)
+            else:
+                self._finish(job_id, result=result)
+
+            if time.monotonic() - self._last_purge > self.purge_interval:
+                self.purge()
+
+    async def _heartbeat(self):
+        """Renew the lease on the jobs this queue is running"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not self._running:
+                continue
+            running = list(self._running)
+            with self._lock, self._transaction():
+                self._db.execute(
+                    f"UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = ? "
+                    f"AND id IN ({','.join('?' * len(running))})",
+                    (time.time() + self.lease, self._owner, RUNNING, *running),
+                )
+
+    def purge(self):
+        """Requeue jobs whose lease expired, and drop finished jobs past the retention period or beyond `max_finished`"""
+        self._last_purge = time.monotonic()
+        self._requeue_expired()
+        with self._lock, self._transaction():
+            self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (*FINISHED, time.time() - self.retention),
+            )
+            self._db.execute(
+                "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN (?, ?) "
+                "ORDER BY finished_at DESC LIMIT -1 OFFSET ?)",
+                (*FINISHED, self.max_finished),
+            )
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": self.workers if self._tasks else 0,
+            "queued": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "retained": counts.get(SUCCEEDED, 0) + counts.get(FAILED, 0),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "requeued": self.requeued,
+        }
@@ -0,0 +1,221 @@
+"""Deterministic parser for pasted nutrition tables, e.g. "能量 1520kJ 蛋白质 8.2g 脂肪 20g 钠 560mg".
+
+Follows the same rules the ERNIE prompts spell out: energy in kJ is converted
+to kcal by dividing by 4.184, missing fiber/sugar become 0 and every value is
+rounded to an integer. Returns None whenever the text does not look like a
+nutrition table, so the caller can fall back to the model.
+"""
+import math
+import re
+
+KJ_PER_KCAL = 4.184
+# Sodium is 39.34% of table salt by mass
+SODIUM_MG_PER_SALT_G = 393.4
+
+# Longer labels come first within the alternation so that e.g. 饱和脂肪 is not read as 脂肪
+FIELD_LABELS = {
+    "ignored": [
+        "饱和脂肪酸", "饱和脂肪", "反式脂肪酸", "反式脂肪", "单不饱和脂肪酸", "多不饱和脂肪酸",
+        "胆固醇", "saturated fat", "saturates", "trans fat", "cholesterol",
+        "monounsaturated fat", "polyunsaturated fat", "添加糖", "added sugars", "added sugar",
+    ],
+    "energy": ["能量", "热量", "energy", "calories", "calorie"],
+    "protein": ["蛋白质", "protein"],
+    "fats": ["总脂肪", "脂肪", "total fat", "fat"],
+    "carbs": ["碳水化合物", "total carbohydrates", "total carbohydrate", "carbohydrates", "carbohydrate", "carbs"],
+    "fiber": ["膳食纤维", "dietary fibre", "dietary fiber", "fibre", "fiber"],
+    "sugar": ["of which sugars", "sugars", "sugar", "糖"],
+    "sodium": ["钠", "sodium"],
+    "salt": ["食盐", "盐", "salt"],
+}
+
+UNITS = {
+    "kj": "kJ", "千焦": "kJ",
+    "kcal": "kcal", "千卡": "kcal", "大卡": "kcal", "cal": "kcal",
+    "mg": "mg", "毫克": "mg",
+    "g": "g", "克": "g",
+}
+
+_LABEL_TO_FIELD = {}
+for _field, _labels in FIELD_LABELS.items():
+    for _label in _labels:
+        _LABEL_TO_FIELD[_label.casefold()] = _field
+
+_LABEL_PATTERN = "|".join(
+    re.escape(label) for label in sorted(_LABEL_TO_FIELD, key=len, reverse=True)
+)
+_UNIT_PATTERN = "|".join(re.escape(unit) for unit in sorted(UNITS, key=len, reverse=True))
+
+ROW = re.compile(
+    rf"(?P<label>{_LABEL_PATTERN})\s*"
+    rf"(?:[(（]\s*(?P<label_unit>{_UNIT_PATTERN})\s*[)）])?\s*[:：]?\s*"
+    rf"(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>{_UNIT_PATTERN})?(?![a-z])",
+    re.IGNORECASE,
+)
+
+PER_100 = re.compile(r"每\s*100\s*(?:克|g|毫升|ml)|per\s*100\s*(?:g|ml)|/\s*100\s*(?:g|ml)", re.IGNORECASE)
+PER_SERVING = re.compile(r"每份|per\s+serving", re.IGNORECASE)
+
+# Table furniture that carries no information of its own
+NOISE = re.compile(
+    r"营养成分表|营养成分|营养素参考值|nrv\s*%?|项目|nutrition\s+(?:facts|information)|typical\s+values"
+    r"|每\s*\d+\s*(?:克|g|毫升|ml)|每份|per\s*\d+\s*(?:g|ml)|per\s+serving|amount"
+    r"|\d+(?:\.\d+)?\s*%|[\s,，、;；:：|/()（）\-–—*·.。]+",
+    re.IGNORECASE,
+)
+
+MACROS = ("protein", "fats", "carbs")
+
+
+def round_half_up(value):
+    return int(math.floor(value + 0.5))
+
+
+def _to_grams(value, unit):
+    return value / 1000 if unit == "mg" else value
+
+
+def _to_milligrams(value, unit):
+    return value * 1000 if unit == "g" else value
+
+
+def parse_rows(text):
+    """Extract raw (field, value, unit, span) rows from a nutrition table"""
+    rows = []
+    for match in ROW.finditer(text):
+        field = _LABEL_TO_FIELD[match.group("label").casefold()]
+        unit = match.group("unit") or match.group("label_unit")
+        unit = UNITS.get(unit.casefold()) if unit else None
+        rows.append((field, float(match.group("value")), unit, match.span()))
+    return rows
+
+
+def parse_nutrition_label(text, lang="en", min_coverage=0.65):
+    """Return a nutrition dict in the /analyze schema, or None if parsing is not confident.
+
+    Confidence requires an energy value, at least two of protein/fat/carbs, and
+    that recognised rows and table furniture cover `min_coverage` of the text
+    (ignoring a short leading product name).
+    """
+    if not text or len(text) > 2000:
+        return None
+
+    rows = parse_rows(text)
+    if not rows:
+        return None
+
+    values = {}
+    energy_kcal = None
+    energy_kj = None
+    for field, value, unit, _ in rows:
+        if field == "ignored":
+            continue
+        if field == "energy":
+            if unit == "kJ" and energy_kj is None:
+                energy_kj = value
+            elif unit == "kcal" and energy_kcal is None:
+                energy_kcal = value
+            elif unit is None and energy_kcal is None and energy_kj is None:
+                # A bare number on a Chinese label is kJ; on an English one, kcal
+                energy_kj = value if re.search(r"[一-鿿]", text) else None
+                energy_kcal = None if energy_kj is not None else value
+            continue
+        if field in values:
+            continue
+        if field in ("sodium", "salt"):
+            values[field] = _to_milligrams(value, unit or ("g" if field == "salt" else "mg"))
+        else:
+            values[field] = _to_grams(value, unit or "g")
+
+    if energy_kcal is None and energy_kj is None:
+        return None
+    if sum(field in values for field in MACROS) < 2:
+        return None
+
+    # Everything that is not a recognised row or table furniture is unexplained text
+    first_start = rows[0][3][0]
+    name = text[:first_start].strip(" \t:：-–—|,，")
+    remainder = text[first_start:]
+    for _, _, _, (start, end) in reversed(rows):
+        start -= first_start
+        end -= first_start
+        remainder = remainder[:start] + " " + remainder[end:]
+    unexplained = len(NOISE.sub("", remainder))
+    total = len(NOISE.sub("", text[first_start:]))
+    if total == 0 or unexplained / total > 1 - min_coverage:
+        return None
+
+    name = NOISE.sub(" ", name).strip()
+    if len(name) > 40:
+        return None
+
+    if energy_kcal is not None:
+        calories = round_half_up(energy_kcal)
+        energy_note = None
+    else:
+        calories = round_half_up(energy_kj / KJ_PER_KCAL)
+        energy_note = (energy_kj, calories)
+
+    sodium = values.get("sodium")
+    if sodium is None and "salt" in values:
+        sodium = values["salt"] / 1000 * SODIUM_MG_PER_SALT_G
+
+    nutrition = {
+        "calories": calories,
+        "protein": round_half_up(values.get("protein", 0)),
+        "carbs": round_half_up(values.get("carbs", 0)),
+        "fats": round_half_up(values.get("fats", 0)),
+        "fiber": round_half_up(values.get("fiber", 0)),
+        "sugar": round_half_up(values.get("sugar", 0)),
+        "sodium": round_half_up(sodium or 0),
+    }
+
+    per_serving = PER_SERVING.search(text) and not PER_100.search(text)
+    return _describe(nutrition, values, name, per_serving, energy_note, lang)
+
+
+def _describe(nutrition, values, name, per_serving, energy_note, lang):
+    """Wrap parsed numbers in the same descriptive fields ERNIE returns"""
+    zh = lang == "zh"
+    benefits = []
+    considerations = []
+
+    # Per-100g "high" thresholds follow the UK front-of-pack traffic light scheme
+    if values.get("protein", 0) >= 10:
+        benefits.append("蛋白质含量较高，有助于肌肉修复和增加饱腹感" if zh else "High in protein, which supports muscle repair and satiety")
+    if values.get("fiber", 0) >= 6:
+        benefits.append("膳食纤维丰富，有助于消化健康" if zh else "Rich in dietary fiber, which supports digestion")
+    if values.get("fats", 0) <= 3:
+        benefits.append("低脂肪" if zh else "Low in fat")
+    if values.get("fats", 0) > 17.5:
+        considerations.append("脂肪含量高，注意控制食用量" if zh else "High in fat; watch portion sizes")
+    if values.get("sugar", 0) > 22.5:
+        considerations.append("糖含量高，控糖人群应少量食用" if zh else "High in sugar; limit if managing blood sugar")
+    if nutrition["sodium"] > 600:
+        considerations.append("钠含量高，高血压人群应谨慎食用" if zh else "High in sodium; take care if managing blood pressure")
+    if not considerations:
+        considerations.append("请结合包装标注的份量控制摄入" if zh else "Check the serving size on the package to keep portions in line")
+
+    if zh:
+        explanation = "数值由本地解析营养成分表得出"
+        if energy_note:
+            explanation += f"，能量 {energy_note[0]:g}千焦 ÷ 4.184 ≈ {energy_note[1]}千卡"
+        explanation += "；未标注的膳食纤维或糖按0计。"
+        serving_size = "每份" if per_serving else "每100克"
+    else:
+        explanation = "Values were parsed locally from the nutrition table"
+        if energy_note:
+            explanation += f"; energy {energy_note[0]:g} kJ ÷ 4.184 ≈ {energy_note[1]} kcal"
+        explanation += "; fiber or sugar not listed are counted as 0."
+        serving_size = "per serving" if per_serving else "per 100g"
+
+    return {
+        "name": name or ("营养成分表" if zh else "Nutrition label"),
+        "category": "包装食品" if zh else "Packaged food",
+        **nutrition,
+        "serving_size": serving_size,
+        "confidence": "高" if zh else "high",
+        "benefits": benefits,
+        "considerations": considerations,
+        "explanation": explanation,
+    }
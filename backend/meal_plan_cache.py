@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+import logging
+import math
+import threading
+from collections import Counter
+
+from metrics import log_event
+from single_flight import flight_key
+
+DEFAULT_PROFILE = {
+    "daily_calorie_goal": 2000,
+    "daily_protein_goal": 150,
+    "daily_carbs_goal": 200,
+    "daily_fats_goal": 65,
+    "goal_type": "maintenance",
+}
+
+
+def quantize(value, step, default):
+    """Round a numeric goal to the nearest multiple of `step`"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = default
+    if not math.isfinite(value):
+        value = default
+    # Half-up rather than Python's half-to-even, so 65 g with a 10 g step is 70 g, not 60 g
+    return int(math.floor(value / step + 0.5) * step) or step
+
+
+def _canonical_list(values):
+    if isinstance(values, str):
+        values = values.split(",")
+    return sorted({str(value).strip().casefold() for value in values or [] if str(value).strip()})
+
+
+def profile_bucket(user_profile, lang="en", calorie_step=100, macro_step=10):
+    """Canonical, quantized form of a profile; users in the same bucket share meal plans.
+
+    The result has the same keys as a profile, so the prompt can be built
+    from it directly and a cached plan always matches the bucket it is stored under.
+    """
+    user_profile = user_profile or {}
+    return {
+        "daily_calorie_goal": quantize(
+            user_profile.get("daily_calorie_goal"), calorie_step, DEFAULT_PROFILE["daily_calorie_goal"]
+        ),
+        "daily_protein_goal": quantize(
+            user_profile.get("daily_protein_goal"), macro_step, DEFAULT_PROFILE["daily_protein_goal"]
+        ),
+        "daily_carbs_goal": quantize(
+            user_profile.get("daily_carbs_goal"), macro_step, DEFAULT_PROFILE["daily_carbs_goal"]
+        ),
+        "daily_fats_goal": quantize(
+            user_profile.get("daily_fats_goal"), macro_step, DEFAULT_PROFILE["daily_fats_goal"]
+        ),
+        "dietary_restrictions": _canonical_list(user_profile.get("dietary_restrictions")),
+        "disliked_foods": _canonical_list(user_profile.get("disliked_foods")),
+        "goal_type": str(user_profile.get("goal_type") or DEFAULT_PROFILE["goal_type"]).strip().casefold(),
+        "lang": lang or "en",
+    }
+
+
+def rotation_variant(date, variants):
+    """Which cached variant of a bucket's plan a date is served, cycling day by day"""
+    try:
+        return datetime.date.fromisoformat(str(date)[:10]).toordinal() % variants
+    except ValueError:
+        return 0
+
+
+def meal_plan_key(bucket, date, variants):
+    return f"meal_plan:{flight_key(bucket)}:{rotation_variant(date, variants)}"
+
+
+def meal_plan_keys(bucket, date, variants):
+    """Every variant's key for a bucket, the one `date` is served first"""
+    first = rotation_variant(date, variants)
+    bucket_key = flight_key(bucket)
+    return [f"meal_plan:{bucket_key}:{(first + offset) % variants}" for offset in range(variants)]
+
+
+class ProfilePopularity:
+    """Counts requests per profile bucket to decide what to precompute.
+
+    Holds at most `max_buckets` buckets; when full, the least requested half
+    is dropped.
+    """
+
+    def __init__(self, max_buckets=10_000):
+        self.max_buckets = max_buckets
+        self._counts = Counter()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def record(self, bucket):
+        key = flight_key(bucket)
+        with self._lock:
+            self._counts[key] += 1
+            self._buckets[key] = bucket
+            if len(self._counts) > self.max_buckets:
+                for stale, _ in self._counts.most_common()[self.max_buckets // 2:]:
+                    del self._counts[stale]
+                    del self._buckets[stale]
+
+    def top(self, n):
+        with self._lock:
+            return [(self._buckets[key], count) for key, count in self._counts.most_common(n)]
+
+    def decay(self):
+        """Halve every count so that recent demand outweighs old demand"""
+        with self._lock:
+            for key in list(self._counts):
+                self._counts[key] //= 2
+                if not self._counts[key]:
+                    del self._counts[key]
+                    del self._buckets[key]
+
+
+class MealPlanPrecomputer:
+    """Background job that warms the meal-plan cache for the most requested buckets.
+
+    Once a day, during the off-peak `hours` window (local time, start inclusive,
+    end exclusive), it generates plans for each of the `top_n` buckets for the
+    next `variants` days, which covers every rotation variant. Plans are
+    generated one at a time so interactive traffic keeps the upstream slots.
+    """
+
+    def __init__(self, generate, popularity, top_n=20, hours=(2, 5), variants=3, check_interval=600):
+        self.generate = generate
+        self.popularity = popularity
+        self.top_n = top_n
+        self.hours = hours
+        self.variants = variants
+        self.check_interval = check_interval
+
+        self.last_run = None
+        self.generated = 0
+        self.failures = 0
+
+    def in_window(self, now):
+        start, end = self.hours
+        if start <= end:
+            return start <= now.hour < end
+        return now.hour >= start or now.hour < end
+
+    async def run(self):
+        while True:
+            now = datetime.datetime.now()
+            if self.in_window(now) and self.last_run != now.date():
+                self.last_run = now.date()
+                await self.precompute(now.date())
+            await asyncio.sleep(self.check_interval)
+
+    async def precompute(self, today):
+        """Warm the cache for the current top buckets, starting tomorrow"""
+        for bucket, _ in self.popularity.top(self.top_n):
+            for offset in range(1, self.variants + 1):
+                date = (today + datetime.timedelta(days=offset)).isoformat()
+                try:
+                    _, cached = await self.generate(bucket, date, bucket["lang"], record=False)
+                    if not cached:
+                        self.generated += 1
+                except Exception as e:
+                    self.failures += 1
+                    log_event("meal_plan_precompute_error", logging.WARNING, error=type(e).__name__, message=str(e))
+        self.popularity.decay()
+
+    def stats(self):
+        return {
+            "top_n": self.top_n,
+            "hours": list(self.hours),
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "generated": self.generated,
+            "failures": self.failures,
+        }
@@ -0,0 +1,241 @@
+"""Request and upstream metrics in Prometheus text format, and non-blocking logging.
+
+Counters and histograms are plain dicts keyed by label values behind one
+lock; they are rendered on scrape, so recording costs a dict update. Log
+records go through a queue to a background thread that does the writing,
+so request handlers never block on stdout. Set LOG_FORMAT=json for one JSON
+object per line, and LOG_LEVEL=DEBUG to see raw model responses.
+"""
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "nutrition_"
+
+# Seconds; upstream calls to the thinking model routinely take tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        key = tuple(str(value) for value in label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        key = tuple(str(v) for v in label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(float(series[-2]))}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """Metrics plus collectors that produce gauge samples at scrape time"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, name, help_text, labels, collect):
+        """`collect()` returns [(label values, value)], rendered as a gauge"""
+        self._collectors.append((PREFIX + name, help_text, tuple(labels), collect))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help_text, labels, collect in self._collectors:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for values, value in collect():
+                lines.append(f"{name}{_labels(labels, values)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds",
+    "Time to produce the response (headers, for streamed responses), by route",
+    ["endpoint", "method", "status"],
+)
+phase_seconds = registry.histogram(
+    "phase_duration_seconds",
+    "Time spent in each phase of handling a request: parse, prompt_build, "
+    "upstream_queue, upstream_wait, json_extract, image_preprocess",
+    ["operation", "phase"],
+)
+upstream_requests = registry.counter(
+    "upstream_requests_total", "Completed upstream completions", ["operation", "model", "finish_reason"]
+)
+upstream_tokens = registry.counter(
+    "upstream_tokens_total", "Upstream token usage as reported by the API", ["operation", "model", "kind"]
+)
+upstream_errors = registry.counter(
+    "upstream_errors_total", "Upstream calls that raised, by exception class", ["operation", "error"]
+)
+model_escalations = registry.counter(
+    "model_escalations_total", "Replies that sent a request on to a bigger model, by reason", ["operation", "model", "reason"]
+)
+model_json_repairs = registry.counter(
+    "model_json_repairs_total", "Model replies whose JSON was repaired locally or could not be", ["operation", "outcome"]
+)
+request_errors = registry.counter(
+    "request_errors_total", "Requests that ended in an error response, by exception class", ["endpoint", "error"]
+)
+
+
+def observe_phase(operation, phase, seconds):
+    phase_seconds.observe(seconds, operation, phase)
+
+
+@contextmanager
+def phase(operation, name):
+    """Time a block as one phase of `operation`"""
+    with phase_seconds.time(operation, name):
+        yield
+
+
+def record_completion(operation, model, usage=None, finish_reason=None):
+    """Count one finished upstream completion and its token usage"""
+    model = model or "unknown"
+    upstream_requests.inc(operation, model, finish_reason or "unknown")
+    if usage:
+        for kind in ("prompt_tokens", "completion_tokens"):
+            tokens = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+            if tokens:
+                upstream_tokens.inc(operation, model, kind.split("_")[0], amount=tokens)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        text = record.getMessage()
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+log = logging.getLogger("nutrition")
+
+
+def _setup_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if os.environ.get("LOG_FORMAT") == "json" else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    log.propagate = False
+
+
+_setup_logging()
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """Log `event` with structured fields; formatting and writing happen off the caller's thread"""
+    if log.isEnabledFor(level):
+        log.log(level, event, extra={"fields": fields})
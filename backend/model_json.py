@@ -0,0 +1,218 @@
+"""Tolerant extraction, repair and validation of the JSON in model replies.
+
+Replies are meant to be a bare JSON object but often are not: they come in
+```json fences, after a sentence of preamble, with `//` comments copied from
+the prompt, trailing commas, raw newlines inside strings, or cut off when the
+model runs out of tokens. extract_json() tries a plain json.loads from the
+first brace and the first bracket and only falls back to a single-pass repair
+when neither decodes; the schema helpers then coerce the fields the app relies on.
+"""
+import json
+import math
+import re
+
+CLOSING = {"{": "}", "[": "]"}
+
+_TOKEN = re.compile(
+    r'(?P<skip>\s+|//[^\n]*|/\*.*?(?:\*/|\Z))'
+    r'|(?P<string>"(?:[^"\\]|\\.)*(?:(?P<closed>")|\\?\Z))'
+    r'|(?P<structure>[{}\[\],:])'
+    r'|(?P<scalar>[^\s{}\[\],:"/]+)'
+    r'|(?P<other>.)',
+    re.DOTALL,
+)
+_CONTROL = re.compile(r"[\x00-\x1f]")
+_ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{4}|[\"\\/bfnrt])|\\", re.DOTALL)
+_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\Z")
+
+ANALYSIS_NUMBERS = ("calories", "protein", "carbs", "fats", "fiber", "sugar", "sodium")
+ANALYSIS_REQUIRED = ("calories", "protein", "carbs", "fats")
+MEAL_NUMBERS = ("calories", "protein", "carbs", "fats")
+
+
+def extract_json(text, expect=None):
+    """Return (value, repaired) for the first JSON value of type `expect` in `text`.
+
+    `expect` is dict or list, or None for either. The first `{` and the first
+    `[` are tried in the order they appear, so bracketed prose before an
+    object ("[per 100g]") is skipped. When neither decodes, the value from the
+    first `{` (if any) is repaired. Raises ValueError when there is nothing that
+    can be salvaged.
+    """
+    text = text or ""
+    openers = "{[" if expect is None else "{" if expect is dict else "["
+    starts = sorted(index for index in (text.find(opener) for opener in openers) if index != -1)
+    if not starts:
+        raise ValueError("no JSON object in the reply")
+    for start in starts:
+        end = text.rfind(CLOSING[text[start]]) + 1
+        if end <= start:
+            continue
+        try:
+            value = json.loads(text[start:end])
+        except ValueError:
+            continue
+        if expect is None or isinstance(value, expect):
+            return value, False
+    start = text.find("{") if "{" in openers and "{" in text else starts[0]
+    return json.loads(repair_json(text, start)), True
+
+
+def _string(raw, complete):
+    """A string token as valid JSON: control characters and stray backslashes escaped"""
+    inner = raw[1:-1] if complete else raw[1:]
+    if not complete:
+        # Drop a half-written escape at the cut
+        inner = re.sub(r"\\(u[0-9a-fA-F]{0,3})?\Z", "", inner)
+    inner = _ESCAPE.sub(lambda m: m.group(0) if m.group(1) else "\\\\", inner)
+    inner = _CONTROL.sub(lambda m: json.dumps(m.group(0))[1:-1], inner)
+    return f'"{inner}"'
+
+
+def _scalar(raw):
+    """A bare token as JSON: literals and numbers as they are, anything else (e.g. 607kcal) quoted"""
+    if raw in _LITERALS:
+        return _LITERALS[raw]
+    if _NUMBER.match(raw):
+        return raw
+    return json.dumps(raw, ensure_ascii=False)
+
+
+def repair_json(text, start=0):
+    """Rewrite the JSON value starting at `start` into valid JSON text.
+
+    Comments and stray characters are dropped, trailing or doubled commas
+    removed, missing commas between values inserted, and a mismatched closing
+    bracket replaced by the right one. If the text ends before the value
+    does, the unfinished tail (a dangling key, a number that may be cut
+    short) is removed and every open bracket closed. Anything after the
+    value is ignored.
+    """
+    out = []  # (kind, text) with kind "open", "close", ",", ":", "key", "value"
+    stack = []
+    for match in _TOKEN.finditer(text, start):
+        kind = match.lastgroup
+        raw = match.group()
+        if kind in ("skip", "other"):
+            continue
+        previous = out[-1][0] if out else None
+
+        if kind == "structure" and raw in "{[":
+            if previous in ("value", "close"):
+                out.append((",", ","))
+            out.append(("open", raw))
+            stack.append(raw)
+        elif kind == "structure" and raw in "}]":
+            if not stack:
+                break
+            while out and out[-1][0] in (",", ":", "key"):
+                out.pop()
+            out.append(("close", CLOSING[stack.pop()]))
+            if not stack:
+                break
+        elif raw == ",":
+            if previous in ("value", "close"):
+                out.append((",", ","))
+        elif raw == ":":
+            if previous == "key":
+                out.append((":", ":"))
+        else:
+            if not stack:
+                continue
+            value = _string(raw, match.group("closed") is not None) if kind == "string" else _scalar(raw)
+            if previous in ("value", "close"):
+                out.append((",", ","))
+                previous = ","
+            in_object = stack[-1] == "{"
+            is_key = in_object and previous in ("open", ",")
+            if is_key and kind != "string":
+                value = json.dumps(raw, ensure_ascii=False)
+            out.append(("key" if is_key else "value", value))
+            if match.end() == len(text) and kind == "scalar":
+                # The text stops inside this number or literal; it may be cut short
+                out.pop()
+
+    if not out:
+        raise ValueError("no JSON value in the reply")
+    while stack:
+        # Cut off: drop whatever cannot stand on its own, then close what is open
+        while out and out[-1][0] in (",", ":", "key"):
+            out.pop()
+        out.append(("close", CLOSING[stack.pop()]))
+    return "".join(token for _, token in out)
+
+
+def to_int(value):
+    """Integer for a number or numeric string ("607", "12.6 g", "1,200 mg"), else None (also for inf and NaN)"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if not isinstance(value, (int, float)):
+        match = re.search(r"-?\d+(?:\.\d+)?", str(value).replace(",", ""))
+        if match is None:
+            return None
+        value = float(match.group())
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return round(value)
+
+
+def _text_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    if isinstance(value, list):
+        return [str(item) for item in value if item is not None and str(item).strip()]
+    return [str(value)]
+
+
+def validate_analysis(data):
+    """The analysis with numbers as ints and lists as lists, or None if it lacks the nutrition fields"""
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    if not isinstance(data, dict) or not data.get("name"):
+        return None
+    data = dict(data)
+    for field in ANALYSIS_NUMBERS:
+        number = to_int(data.get(field))
+        if number is None:
+            if field in ANALYSIS_REQUIRED:
+                return None
+            number = 0
+        data[field] = number
+    for field in ("benefits", "considerations"):
+        data[field] = _text_list(data.get(field))
+    if "confidence" in data:
+        data["confidence"] = str(data["confidence"]).strip().lower()
+    return data
+
+
+def validate_meal_plan(data):
+    """The meal plan with ints throughout and `total_nutrition` the sum of its meals.
+
+    Meals without a name or calories (e.g. the last one of a cut-off reply)
+    are dropped. Raises ValueError when no usable meal is left.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("meal plan is not a JSON object")
+    meals = [
+        meal for meal in data.get("meals") or []
+        if isinstance(meal, dict) and meal.get("name") and isinstance(meal.get("nutrition"), dict)
+        and to_int(meal["nutrition"].get("calories")) is not None
+    ]
+    if not meals:
+        raise ValueError("meal plan has no meals")
+
+    data = dict(data)
+    totals = dict.fromkeys(MEAL_NUMBERS, 0)
+    for index, meal in enumerate(meals):
+        nutrition = {field: to_int(meal["nutrition"].get(field)) or 0 for field in MEAL_NUMBERS}
+        meal = dict(meal, nutrition=nutrition, items=_text_list(meal.get("items")))
+        meals[index] = meal
+        for field in MEAL_NUMBERS:
+            totals[field] += nutrition[field]
+    data["meals"] = meals
+    # The model's own totals often disagree with its meals; the meals are what gets eaten
+    data["total_nutrition"] = totals
+    return data
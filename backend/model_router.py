@@ -0,0 +1,155 @@
+"""Model tier routing and completion-token sizing for the JSON-producing calls.
+
+ModelRouter sends each request to the cheapest model tier that has
+recently met the quality bar for requests like it, and lists the bigger
+tiers to escalate to when a reply is not good enough. TokenSizer sets
+max_completion_tokens from the output lengths actually seen per task and
+model, instead of one fixed worst case.
+"""
+import random
+import threading
+from collections import deque
+
+from chat_context import CJK, estimate_tokens
+
+LOW_CONFIDENCE = {"low", "低"}
+REQUIRED_NUMBERS = ("calories", "protein", "carbs", "fats")
+
+
+def acceptable_analysis(data):
+    """Whether an analysis reply is usable as is: the nutrition schema, not low confidence"""
+    if not isinstance(data, dict) or not data.get("name"):
+        return False
+    for field in REQUIRED_NUMBERS:
+        value = data.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+    return str(data.get("confidence", "")).strip().lower() not in LOW_CONFIDENCE
+
+
+def request_class(kind, text="", lang="en"):
+    """Coarse class of an analysis request: input type, language and description length.
+
+    `kind` is "image" or "text". For text the language is taken from the
+    description itself, since users often describe meals in a language other
+    than the UI's.
+    """
+    if kind == "image":
+        return f"image:{lang}:{'context' if text else 'bare'}"
+    language = "zh" if CJK.search(text or "") else "en"
+    tokens = estimate_tokens(text)
+    length = "short" if tokens <= 12 else "medium" if tokens <= 60 else "long"
+    return f"text:{language}:{length}"
+
+
+class ModelRouter:
+    """Picks a model tier per request class from recent outcomes.
+
+    `tiers` maps a request kind to its models, cheapest first. A tier is used
+    for a class while at least `quality_bar` of its last `window` replies for
+    that class were acceptable; tiers with fewer than `min_samples` replies
+    are tried (optimistically), and tiers below the bar are still probed for
+    `explore` of requests so they can win the class back.
+    """
+
+    def __init__(self, tiers, quality_bar=0.9, window=200, min_samples=20, explore=0.05):
+        self.tiers = {kind: list(models) for kind, models in tiers.items()}
+        self.quality_bar = quality_bar
+        self.window = window
+        self.min_samples = min_samples
+        self.explore = explore
+        self._outcomes = {}  # (request class, model) -> deque of bools
+        self._lock = threading.Lock()
+
+        self.routed = {}
+
+    def plan(self, kind, route):
+        """Models to try for a request of class `route`, in order: the chosen tier, then every bigger one"""
+        models = self.tiers[kind]
+        with self._lock:
+            for index, model in enumerate(models[:-1]):
+                outcomes = self._outcomes.get((route, model))
+                if outcomes is None or len(outcomes) < self.min_samples:
+                    break
+                if sum(outcomes) >= self.quality_bar * len(outcomes):
+                    break
+                if random.random() < self.explore:
+                    break
+            else:
+                index = len(models) - 1
+            self.routed[models[index]] = self.routed.get(models[index], 0) + 1
+        return models[index:]
+
+    def record(self, route, model, accepted):
+        with self._lock:
+            outcomes = self._outcomes.get((route, model))
+            if outcomes is None:
+                outcomes = self._outcomes[(route, model)] = deque(maxlen=self.window)
+            outcomes.append(bool(accepted))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "routed": dict(self.routed),
+                "acceptance": {
+                    f"{route}|{model}": round(sum(outcomes) / len(outcomes), 3)
+                    for (route, model), outcomes in sorted(self._outcomes.items()) if outcomes
+                },
+            }
+
+
+class TokenSizer:
+    """max_completion_tokens per (task, model) from the observed output lengths.
+
+    The limit is the `quantile` of the last `window` completions times
+    `headroom`, kept between `floor` and the task's cap from `caps`. Until
+    `min_samples` completions are seen, the cap is used. A reply cut off at
+    the limit counts as needing at least the limit, which raises the estimate.
+    """
+
+    def __init__(self, caps, floor=256, headroom=1.25, quantile=0.99, window=500, min_samples=30):
+        self.caps = dict(caps)
+        self.floor = floor
+        self.headroom = headroom
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self._lengths = {}
+        self._lock = threading.Lock()
+
+        self.truncated = 0
+
+    def cap(self, task):
+        return self.caps[task]
+
+    def limit(self, task, model):
+        cap = self.caps[task]
+        with self._lock:
+            lengths = self._lengths.get((task, model))
+            if lengths is None or len(lengths) < self.min_samples:
+                return cap
+            ordered = sorted(lengths)
+        estimate = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))] * self.headroom
+        return max(self.floor, min(cap, int(estimate)))
+
+    def record(self, task, model, usage, finish_reason, limit):
+        tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+        if finish_reason == "length":
+            self.truncated += 1
+            # The reply needed more than it was given
+            tokens = max(tokens or 0, int(limit * self.headroom))
+        if not tokens:
+            return
+        with self._lock:
+            lengths = self._lengths.get((task, model))
+            if lengths is None:
+                lengths = self._lengths[(task, model)] = deque(maxlen=self.window)
+            lengths.append(tokens)
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._lengths)
+        return {
+            "truncated": self.truncated,
+            "limits": {f"{task}|{model}": self.limit(task, model) for task, model in keys},
+        }
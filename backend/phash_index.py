@@ -0,0 +1,196 @@
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+Match = namedtuple("Match", ["value", "distance", "image_hash"])
+
+
+def dhash(image, hash_size=8):
+    """Difference hash: compares neighbouring pixels of a (hash_size+1) x hash_size thumbnail"""
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return _pack_bits(bits)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def phash(image, hash_size=8):
+    """DCT hash: low-frequency 8x8 block of a 32x32 DCT compared against its median"""
+    small = image.convert("L").resize((32, 32), Image.Resampling.LANCZOS)
+    pixels = np.asarray(small, dtype=np.float64)
+    dct = _DCT_32 @ pixels @ _DCT_32.T
+    block = dct[:hash_size, :hash_size].flatten()
+    bits = block > np.median(block[1:])
+    return _pack_bits(bits)
+
+
+HASH_FUNCTIONS = {"dhash": dhash, "phash": phash}
+
+
+def _pack_bits(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hash_image(image, algorithm="dhash"):
+    """Perceptual hash of an already decoded and oriented Pillow image"""
+    return HASH_FUNCTIONS[algorithm](image)
+
+
+class _MultiIndex:
+    """Multi-index hashing over 64-bit hashes for one namespace.
+
+    The hash is split into `chunks` disjoint substrings. If two hashes differ in
+    at most `max_distance` bits, at least one substring differs in at most
+    `max_distance // chunks` bits, so a query only probes buckets within that
+    small radius of each of its own substrings. Wide substrings keep buckets
+    nearly empty even with hundreds of thousands of entries.
+    """
+
+    def __init__(self, max_distance, chunks=3):
+        self.chunks = chunks
+        radius = max_distance // chunks
+        width = HASH_BITS // chunks
+        self.spans = []
+        self.probes = []
+        offset = 0
+        for i in range(chunks):
+            bits = width + (1 if i < HASH_BITS % chunks else 0)
+            self.spans.append((offset, (1 << bits) - 1))
+            self.probes.append(_flip_masks(bits, radius))
+            offset += bits
+        self.tables = [dict() for _ in range(chunks)]
+
+    def _parts(self, value):
+        return [(value >> offset) & mask for offset, mask in self.spans]
+
+    def add(self, entry_id, value):
+        for table, part in zip(self.tables, self._parts(value)):
+            table.setdefault(part, set()).add(entry_id)
+
+    def remove(self, entry_id, value):
+        for table, part in zip(self.tables, self._parts(value)):
+            bucket = table.get(part)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del table[part]
+
+    def candidates(self, value):
+        """Yield entry ids that may lie within range; ids can repeat"""
+        for table, probes, part in zip(self.tables, self.probes, self._parts(value)):
+            for flip in probes:
+                bucket = table.get(part ^ flip)
+                if bucket:
+                    yield from bucket
+
+
+def _flip_masks(bits, radius):
+    masks = [0]
+    for distance in range(1, radius + 1):
+        masks.extend(
+            sum(1 << position for position in positions)
+            for positions in combinations(range(bits), distance)
+        )
+    return masks
+
+
+class PerceptualHashIndex:
+    """Near-duplicate lookup from perceptual image hashes to result cache keys.
+
+    Entries are partitioned by namespace (lang + additional context) so a match
+    never crosses prompt variants. The oldest entries are dropped once
+    `max_entries` is reached.
+    """
+
+    def __init__(self, max_distance=5, max_entries=200_000):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._indexes = {}
+        self._entries = OrderedDict()  # entry_id -> (namespace, hash, value)
+        self._ids = {}  # (namespace, hash) -> entry_id
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.near_hits = 0
+
+    def lookup(self, image_hash, namespace):
+        """Return the Match for the closest stored hash within range, or None"""
+        with self._lock:
+            self.lookups += 1
+            index = self._indexes.get(namespace)
+            if index is None:
+                return None
+
+            best = None
+            for entry_id in index.candidates(image_hash):
+                _, stored_hash, value = self._entries[entry_id]
+                distance = (stored_hash ^ image_hash).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best.distance):
+                    best = Match(value, distance, stored_hash)
+                    if distance == 0:
+                        break
+
+            if best is not None:
+                self.near_hits += 1
+            return best
+
+    def add(self, image_hash, namespace, value):
+        with self._lock:
+            existing = self._ids.get((namespace, image_hash))
+            if existing is not None:
+                self._entries[existing] = (namespace, image_hash, value)
+                self._entries.move_to_end(existing)
+                return
+
+            entry_id = self._next_id
+            self._next_id += 1
+            index = self._indexes.get(namespace)
+            if index is None:
+                index = self._indexes[namespace] = _MultiIndex(self.max_distance)
+            index.add(entry_id, image_hash)
+            self._entries[entry_id] = (namespace, image_hash, value)
+            self._ids[(namespace, image_hash)] = entry_id
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, image_hash, namespace):
+        """Forget a hash whose cached result is no longer available"""
+        with self._lock:
+            entry_id = self._ids.get((namespace, image_hash))
+            if entry_id is not None:
+                self._remove(entry_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_distance": self.max_distance,
+                "lookups": self.lookups,
+                "near_hits": self.near_hits,
+            }
+
+    def _remove(self, entry_id):
+        # Caller holds the lock
+        namespace, image_hash, _ = self._entries.pop(entry_id)
+        del self._ids[(namespace, image_hash)]
+        index = self._indexes[namespace]
+        index.remove(entry_id, image_hash)
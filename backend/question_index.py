@@ -0,0 +1,207 @@
+import hashlib
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+Match = namedtuple("Match", ["value", "similarity"])
+
+WORD = re.compile(r"[a-z0-9]+|[一-鿿]+")
+# Politeness and filler words that do not change the answer
+FILLER = {"a", "an", "the", "please", "can", "could", "you", "tell", "me", "about", "hi", "hello", "thanks"}
+# Grammatical words, left out of the comparison altogether
+FUNCTION_WORDS = FILLER | {
+    "is", "are", "was", "were", "be", "do", "does", "did", "to", "of", "for", "with", "in", "on", "at", "by",
+    "and", "or", "it", "its", "this", "that", "these", "those", "there", "what", "whats", "which", "how",
+    "why", "when", "who", "should", "would", "will", "i", "we", "any", "some", "s", "if", "than", "as",
+}
+FUNCTION_CHARS = set("的了吗呢吧啊是和与或在有么什怎样为哪个请问我你可以能")
+# Words that count towards similarity but may be added or dropped without changing the
+# answer; the rest (foods, conditions, nutrients, numbers, negations) have to agree
+GENERIC_WORDS = {
+    "people", "person", "someone", "anyone", "patient", "patients", "want", "need", "eat", "eating", "food",
+    "foods", "really", "actually", "generally", "usually", "ok", "okay", "also", "just", "get",
+}
+GENERIC_CHARS = set("人吃想要")
+# Questions whose content words are this far apart in order still share a pair shingle
+PAIR_WINDOW = 3
+
+# First-person details (age, weight, conditions, "my ...") make an answer personal
+PERSONAL = re.compile(
+    r"\b(?:my|mine|i'm|im|i am|i've|i have|i had|i weigh|i was|i've been)\b"
+    r"|\d+(?:\.\d+)?\s*(?:kg|kgs|lb|lbs|pounds|cm|ft|years?\s+old|yo)\b"
+    r"|我的|我是|我有|我今年|我体重|我身高|我患|我得了|\d+(?:\.\d+)?\s*(?:岁|公斤|斤|厘米)",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(text):
+    """Case, width and punctuation folded, whitespace collapsed"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return " ".join(WORD.findall(text))
+
+
+def is_personal(text):
+    return PERSONAL.search(unicodedata.normalize("NFKC", text or "")) is not None
+
+
+def question_tokens(text):
+    """The words of a question in order, without function words; Chinese is taken a character at a time"""
+    tokens = []
+    for run in WORD.findall(normalize_question(text)):
+        if "一" <= run[0] <= "鿿":
+            tokens.extend(char for char in run if char not in FUNCTION_CHARS)
+        elif run not in FUNCTION_WORDS:
+            tokens.append(run)
+    return tokens
+
+
+def question_shingles(text):
+    """The tokens, plus each ordered pair of tokens up to PAIR_WINDOW apart.
+
+    Pairs rather than bigrams keep a word inserted into a rephrasing from
+    breaking the shingles around it, while "rice worse than bread" and
+    "bread worse than rice" still differ.
+    """
+    tokens = question_tokens(text)
+    shingles = set(tokens)
+    for i, first in enumerate(tokens):
+        shingles.update(f"{first} {second}" for second in tokens[i + 1:i + 1 + PAIR_WINDOW])
+    return shingles
+
+
+def content_words(text):
+    """The words of a question that decide its answer, in order of first use: its tokens other than generic words"""
+    generic = GENERIC_WORDS | GENERIC_CHARS
+    return tuple(dict.fromkeys(token for token in question_tokens(text) if token not in generic))
+
+
+class MinHasher:
+    """MinHash signatures: `num_perm` multiply-shift hashes of 64-bit shingle hashes"""
+
+    def __init__(self, num_perm=128, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingles):
+        if not shingles:
+            return None
+        values = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # uint64 arithmetic wraps, which is the mod 2^64 the multiply-shift scheme wants
+        hashed = (self._a[:, None] * values[None, :] + self._b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+class QuestionIndex:
+    """Near-duplicate lookup from question signatures to answer cache keys.
+
+    Locality-sensitive hashing over MinHash signatures: each signature is cut
+    into `bands` bands, and questions sharing any band are candidates, kept
+    when the estimated Jaccard similarity of their shingles is at least
+    `threshold`. A candidate whose content words differ, or come in another
+    order, is rejected however similar it is, so "white rice" never matches a
+    stored question about "brown rice", nor "type 1" one about "type 2", nor
+    "rice worse than bread" one about "bread worse than rice"; rephrasings
+    that only add or drop generic words ("for people with diabetes") still
+    match. Entries
+    are partitioned by namespace (the prompt variant, i.e. language). The
+    least recently matched entries are dropped once `max_entries` is reached.
+    """
+
+    def __init__(self, threshold=0.4, num_perm=128, bands=64, max_entries=50_000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.hasher = MinHasher(num_perm)
+
+        self._buckets = {}  # (namespace, band, band bytes) -> set of entry ids
+        self._entries = OrderedDict()  # entry_id -> (namespace, signature, content words, value)
+        self._ids = {}  # (namespace, value) -> entry_id
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.near_hits = 0
+
+    def signature(self, question):
+        return self.hasher.signature(question_shingles(question))
+
+    def _bands(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def lookup(self, signature, namespace, words):
+        """Return the Match for the most similar stored question above the threshold
+        whose content words do not conflict with `words`, or None"""
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band, key in enumerate(self._bands(signature)):
+                candidates.update(self._buckets.get((namespace, band, key), ()))
+
+            best = None
+            for entry_id in candidates:
+                _, stored, stored_words, value = self._entries[entry_id]
+                if stored_words != words:
+                    continue
+                similarity = float(np.mean(stored == signature))
+                if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                    best = Match(value, similarity)
+                    best_id = entry_id
+
+            if best is not None:
+                self.near_hits += 1
+                self._entries.move_to_end(best_id)
+            return best
+
+    def add(self, signature, namespace, words, value):
+        with self._lock:
+            existing = self._ids.get((namespace, value))
+            if existing is not None:
+                self._remove(existing)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            for band, key in enumerate(self._bands(signature)):
+                self._buckets.setdefault((namespace, band, key), set()).add(entry_id)
+            self._entries[entry_id] = (namespace, signature, words, value)
+            self._ids[(namespace, value)] = entry_id
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, namespace, value):
+        """Forget a question whose cached answer is no longer available"""
+        with self._lock:
+            entry_id = self._ids.get((namespace, value))
+            if entry_id is not None:
+                self._remove(entry_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "near_hits": self.near_hits,
+            }
+
+    def _remove(self, entry_id):
+        # Caller holds the lock
+        namespace, signature, _, value = self._entries.pop(entry_id)
+        del self._ids[(namespace, value)]
+        for band, key in enumerate(self._bands(signature)):
+            bucket = self._buckets[(namespace, band, key)]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[(namespace, band, key)]
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Collapse whitespace and case so trivially different descriptions share a key"""
+    if not text:
+        return ""
+    return " ".join(str(text).split()).casefold()
+
+
+def analyze_namespace(lang="en", additional_context=""):
+    """Prompt variant an /analyze result belongs to, independent of the payload"""
+    return f"{lang or 'en'}\0{normalize_text(additional_context)}"
+
+
+def analyze_cache_key(kind, payload, lang="en", additional_context=""):
+    """Content-addressed key for an /analyze request.
+
+    `payload` is the decoded image bytes for image requests or the raw
+    description for text requests.
+    """
+    if isinstance(payload, str):
+        payload = normalize_text(payload).encode("utf-8")
+
+    digest = hashlib.sha256()
+    digest.update(kind.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update((lang or "en").encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(additional_context).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(payload)
+    return f"{kind}:{digest.hexdigest()}"
+
+
+class ResultCache:
+    """Thread-safe LRU cache with a TTL and an optional SQLite backing store.
+
+    Values are stored as JSON text, so every hit hands back a fresh copy and
+    the memory bound can be enforced on the serialized size. Expired entries
+    are kept for another `stale_ttl` seconds, invisible to get() but available
+    to get_stale() as a fallback when they cannot be recomputed.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=7 * 24 * 3600, db_path=None, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.db_path = db_path
+
+        self._entries = OrderedDict()  # key -> (expires_at, json_text)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+        self.sets = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time() - self.stale_ttl,))
+        self._db.commit()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, text = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(text)
+                if expires_at + self.stale_ttl <= now:
+                    self._drop(key)
+                    self.expirations += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    text, expires_at = row
+                    if expires_at > now:
+                        self._remember(key, expires_at, text)
+                        self.disk_hits += 1
+                        return json.loads(text)
+                    if expires_at + self.stale_ttl <= now:
+                        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                        self._db.commit()
+                        self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def get_stale(self, key):
+        """Return the value for `key` even if it has expired (within `stale_ttl`), or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                entry = self._db.execute(
+                    "SELECT expires_at, value FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+            if entry is None or entry[0] + self.stale_ttl <= now:
+                return None
+            self.stale_hits += 1
+            return json.loads(entry[1])
+
+    def set(self, key, value, ttl=None):
+        """Store a JSON-serializable value under `key`"""
+        text = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remember(key, expires_at, text)
+            self.sets += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, text, expires_at),
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM entries")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "persistent": self._db is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_hits": self.stale_hits,
+                "sets": self.sets,
+            }
+
+    def _remember(self, key, expires_at, text):
+        # Caller holds the lock
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (expires_at, text)
+        self._bytes += len(text)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        # Caller holds the lock
+        _, text = self._entries.pop(key)
+        self._bytes -= len(text)
@@ -0,0 +1,1627 @@
+import asyncio
+import base64
+import binascii
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from admission import PRIORITIES, AdmissionController, PriorityLimiter, RateLimiter
+from chat_context import ChatContext
+from errors import ServiceError
+from food_db import DEFAULT_CSV, FoodDatabase
+from image_pipeline import ImagePipeline
+from job_queue import JobQueue
+from label_parser import parse_nutrition_label
+from metrics import (
+    log_event, model_escalations, model_json_repairs, observe_phase, phase, record_completion, registry,
+    request_errors, upstream_errors
+)
+from model_json import extract_json, validate_analysis, validate_meal_plan
+from model_router import ModelRouter, TokenSizer, acceptable_analysis, request_class
+from meal_plan_cache import MealPlanPrecomputer, ProfilePopularity, meal_plan_key, meal_plan_keys, profile_bucket
+from phash_index import PerceptualHashIndex, hash_image
+from question_index import QuestionIndex, content_words, is_personal, normalize_question
+from result_cache import ResultCache, analyze_cache_key, analyze_namespace
+from single_flight import SingleFlight, flight_key
+from streaming import ActionTagFilter, find_action, sse_event
+from upstream_policy import CircuitBreaker, RetryBudget, UpstreamPolicy, UpstreamUnavailable
+
+# One pooled keep-alive HTTP client shared by every upstream call, in both the Flask
+# and the ASGI server. Connections are reused instead of re-handshaking per request.
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100))
+
+# Initialize OpenAI-compatible client for Baidu Studio. ERNIE_BASE_URL points it elsewhere,
+# e.g. at the mock server in bench/mock_ernie.py for load tests. Retries are left to the
+# upstream policies below; the read timeout bounds the gap between streamed chunks.
+client = AsyncOpenAI(
+    api_key=os.environ.get("ERNIE_API_KEY", "333e7636d5248dbf9dc3f237e4bc9e5c69157228"),
+    base_url=os.environ.get("ERNIE_BASE_URL", "https://aistudio.baidu.com/llm/lmapi/v3"),
+    max_retries=0,
+    timeout=httpx.Timeout(float(os.environ.get("UPSTREAM_READ_TIMEOUT", 90)), connect=10),
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        )
+    )
+)
+
+# Every model has a concurrency budget shared by all endpoints (MODEL_CONCURRENCY, or
+# MODEL_CONCURRENCY_LIMITS="model=limit,..." per model). Calls waiting for it are let in by
+# priority: analyses first, then chat, then meal plans.
+MODEL_CONCURRENCY = int(os.environ.get("MODEL_CONCURRENCY", 48))
+MODEL_CONCURRENCY_LIMITS = {
+    model.strip(): int(limit)
+    for model, _, limit in (entry.partition("=") for entry in os.environ.get("MODEL_CONCURRENCY_LIMITS", "").split(","))
+    if limit
+}
+MODEL_MAX_WAITING = int(os.environ.get("MODEL_MAX_WAITING", 500))
+model_budgets = {}
+# (model, budget) pairs, replaced whole when a model is added: Flask threads read it for
+# admission while the event loop may be adding to model_budgets
+model_budget_items = ()
+model_budgets_lock = threading.Lock()
+
+# Caps on in-flight upstream calls per endpoint, taken after the model budget. Requests
+# beyond a cap wait (costing only a suspended coroutine) instead of piling onto the upstream.
+upstream_slots = {
+    "analyze": PriorityLimiter(int(os.environ.get("UPSTREAM_CONCURRENCY_ANALYZE", 32)), MODEL_MAX_WAITING),
+    "chat": PriorityLimiter(int(os.environ.get("UPSTREAM_CONCURRENCY_CHAT", 32)), MODEL_MAX_WAITING),
+    "meal_plan": PriorityLimiter(int(os.environ.get("UPSTREAM_CONCURRENCY_MEAL_PLAN", 16)), MODEL_MAX_WAITING),
+}
+
+def model_budget(model):
+    global model_budget_items
+    budget = model_budgets.get(model)
+    if budget is None:
+        with model_budgets_lock:
+            budget = model_budgets.get(model)
+            if budget is None:
+                budget = model_budgets[model] = PriorityLimiter(
+                    MODEL_CONCURRENCY_LIMITS.get(model, MODEL_CONCURRENCY), MODEL_MAX_WAITING
+                )
+                model_budget_items = tuple(model_budgets.items())
+    return budget
+
+def upstream_limiters():
+    # The endpoint dict never changes size, so only the model budgets need the snapshot
+    return [budget for _, budget in model_budget_items] + list(upstream_slots.values())
+
+def upstream_backlog():
+    """Upstream calls waiting for a model budget or an endpoint slot"""
+    return sum(limiter.waiting() for limiter in upstream_limiters())
+
+def upstream_expected_wait(priority=None):
+    return max((limiter.expected_wait(priority) for limiter in upstream_limiters()), default=0.0)
+
+# Requests are rate limited per client IP, and the lower priority classes are shed with a
+# 503 and Retry-After once ADMISSION_MAX_QUEUE upstream calls are waiting (meal plans at
+# half of it, chat at three quarters). RATE_LIMIT=0 turns the rate limits off. Behind a
+# proxy that sets them, TRUST_PROXY_HEADERS=1 takes the IP from X-Forwarded-For and also
+# rate limits per user by X-User-Id; otherwise those headers are ignored.
+TRUST_PROXY_HEADERS = os.environ.get("TRUST_PROXY_HEADERS", "0") != "0"
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT", "1") != "0"
+admission = AdmissionController(
+    RateLimiter(
+        float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", 60)) / 60,
+        float(os.environ.get("RATE_LIMIT_USER_BURST", 20)),
+    ) if RATE_LIMIT_ENABLED else None,
+    RateLimiter(
+        float(os.environ.get("RATE_LIMIT_IP_PER_MINUTE", 300)) / 60,
+        float(os.environ.get("RATE_LIMIT_IP_BURST", 60)),
+    ) if RATE_LIMIT_ENABLED else None,
+    upstream_backlog,
+    upstream_expected_wait,
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 200)),
+    enabled=os.environ.get("ADMISSION_CONTROL", "1") != "0",
+)
+
+def upstream_policy(endpoint, deadline, attempt_timeout, hedge):
+    """Deadline, retry, hedging and circuit-breaker settings for one endpoint, from the environment"""
+    name = endpoint.upper()
+    return UpstreamPolicy(
+        endpoint,
+        deadline=float(os.environ.get(f"UPSTREAM_DEADLINE_{name}", deadline)),
+        attempt_timeout=float(os.environ.get(f"UPSTREAM_ATTEMPT_TIMEOUT_{name}", attempt_timeout)),
+        attempts=int(os.environ.get("UPSTREAM_ATTEMPTS", 3)),
+        hedge=hedge and os.environ.get("UPSTREAM_HEDGE", "1") != "0",
+        budget=RetryBudget(ratio=float(os.environ.get("UPSTREAM_RETRY_RATIO", 0.2))),
+        breaker=CircuitBreaker(
+            failure_ratio=float(os.environ.get("UPSTREAM_BREAKER_FAILURE_RATIO", 0.5)),
+            open_seconds=float(os.environ.get("UPSTREAM_BREAKER_OPEN_SECONDS", 30)),
+        ),
+    )
+
+# Every upstream call runs under its endpoint's policy. Analyze and meal-plan calls are
+# idempotent, so slow ones are hedged; chat is not.
+upstream_policies = {
+    "analyze": upstream_policy("analyze", deadline=120, attempt_timeout=75, hedge=True),
+    "chat": upstream_policy("chat", deadline=120, attempt_timeout=90, hedge=False),
+    "meal_plan": upstream_policy("meal_plan", deadline=120, attempt_timeout=75, hedge=True),
+}
+
+# Analyses go to the cheapest model tier (comma-separated, cheapest first) that has met
+# MODEL_QUALITY_BAR for similar requests, and escalate to the next tier when a reply is
+# not valid JSON or reports low confidence. Completion limits follow observed output lengths.
+ANALYZE_TEXT_MODELS = os.environ.get("ANALYZE_TEXT_MODELS", "ernie-4.5-turbo-128k,ernie-5.0-thinking-preview").split(",")
+ANALYZE_IMAGE_MODELS = os.environ.get("ANALYZE_IMAGE_MODELS", "ernie-4.5-turbo-vl-32k,ernie-5.0-thinking-preview").split(",")
+MEAL_PLAN_MODEL = os.environ.get("MEAL_PLAN_MODEL", "ernie-4.0-8k-latest")
+model_router = ModelRouter(
+    {"text": ANALYZE_TEXT_MODELS, "image": ANALYZE_IMAGE_MODELS},
+    quality_bar=float(os.environ.get("MODEL_QUALITY_BAR", 0.9)),
+)
+token_sizer = TokenSizer({"analyze_image": 4096, "analyze_text": 2048, "meal_plan": 2048})
+
+# Cache of /analyze results keyed on the decoded image bytes or normalized description.
+# Set ANALYZE_CACHE_DB to a file path to keep warm entries across restarts. Expired
+# results are served, marked stale, while the upstream is unavailable.
+analyze_cache = ResultCache(
+    max_entries=int(os.environ.get("ANALYZE_CACHE_SIZE", 2048)),
+    max_bytes=int(os.environ.get("ANALYZE_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    ttl=int(os.environ.get("ANALYZE_CACHE_TTL", 7 * 24 * 3600)),
+    db_path=os.environ.get("ANALYZE_CACHE_DB") or None,
+    stale_ttl=int(os.environ.get("ANALYZE_CACHE_STALE_TTL", 7 * 24 * 3600)),
+)
+
+# Perceptual hashes of analyzed photos, so a re-photographed package maps to its earlier result.
+# PHASH_MAX_DISTANCE is the largest Hamming distance (out of 64 bits) still treated as the same image.
+PHASH_ALGORITHM = os.environ.get("PHASH_ALGORITHM", "dhash")
+image_index = PerceptualHashIndex(
+    max_distance=int(os.environ.get("PHASH_MAX_DISTANCE", 5)),
+    max_entries=int(os.environ.get("PHASH_INDEX_SIZE", 200_000)),
+)
+
+# Decode/orient/crop/downsize photos before upload. IMAGE_PREPROCESS=0 forwards uploads untouched.
+image_pipeline = ImagePipeline(
+    max_edge=int(os.environ.get("IMAGE_MAX_EDGE", 1280)),
+    quality=int(os.environ.get("IMAGE_QUALITY", 80)),
+    fmt=os.environ.get("IMAGE_FORMAT", "JPEG"),
+    crop_label=os.environ.get("IMAGE_CROP_LABEL", "1") != "0",
+    enabled=os.environ.get("IMAGE_PREPROCESS", "1") != "0",
+)
+
+# Identical requests arriving while one is already in flight wait for its result instead
+# of making their own upstream call. SINGLE_FLIGHT_TIMEOUT bounds how long they wait.
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 180))
+analyze_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+chat_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+meal_plan_flight = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+
+# Descriptions that are just a pasted nutrition table are answered without the model.
+LABEL_PARSER_ENABLED = os.environ.get("LABEL_PARSER", "1") != "0"
+label_parser_stats = {"hits": 0, "fallbacks": 0}
+
+# Plain meal descriptions ("2 boiled eggs and a slice of toast") are estimated from a local
+# food-composition table when every item is found in it. FOOD_DB_PATH points at another CSV
+# in the same format; its compiled index is kept in FOOD_DB_INDEX (default: next to the CSV).
+FOOD_DB_ENABLED = os.environ.get("FOOD_DB", "1") != "0"
+FOOD_DB_MIN_SCORE = float(os.environ.get("FOOD_DB_MIN_SCORE", 0.75))
+food_db = FoodDatabase.open(
+    os.environ.get("FOOD_DB_PATH", DEFAULT_CSV),
+    os.environ.get("FOOD_DB_INDEX") or None,
+) if FOOD_DB_ENABLED else None
+
+# Meal plans are cached per quantized profile bucket. Goals are rounded to
+# MEAL_PLAN_CALORIE_STEP kcal / MEAL_PLAN_MACRO_STEP g, and each bucket keeps
+# MEAL_PLAN_VARIANTS plans that rotate by date (a week's worth, so a weekly plan
+# has no repeated day).
+MEAL_PLAN_CALORIE_STEP = int(os.environ.get("MEAL_PLAN_CALORIE_STEP", 100))
+MEAL_PLAN_MACRO_STEP = int(os.environ.get("MEAL_PLAN_MACRO_STEP", 10))
+MEAL_PLAN_VARIANTS = int(os.environ.get("MEAL_PLAN_VARIANTS", 7))
+meal_plan_cache = ResultCache(
+    max_entries=int(os.environ.get("MEAL_PLAN_CACHE_SIZE", 4096)),
+    max_bytes=int(os.environ.get("MEAL_PLAN_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    ttl=int(os.environ.get("MEAL_PLAN_CACHE_TTL", 3 * 24 * 3600)),
+    db_path=os.environ.get("MEAL_PLAN_CACHE_DB") or None,
+    stale_ttl=int(os.environ.get("MEAL_PLAN_CACHE_STALE_TTL", 7 * 24 * 3600)),
+)
+profile_popularity = ProfilePopularity()
+
+# /chat history is kept within CHAT_CONTEXT_BUDGET estimated tokens: the last
+# CHAT_KEEP_TURNS turns are sent verbatim and older ones as a rolling summary written
+# by CHAT_SUMMARY_MODEL. Summaries are cached per conversation prefix.
+CHAT_SUMMARY_MODEL = os.environ.get("CHAT_SUMMARY_MODEL", "ernie-4.0-8k-latest")
+chat_summary_cache = ResultCache(
+    max_entries=int(os.environ.get("CHAT_SUMMARY_CACHE_SIZE", 4096)),
+    max_bytes=int(os.environ.get("CHAT_SUMMARY_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+    ttl=int(os.environ.get("CHAT_SUMMARY_CACHE_TTL", 24 * 3600)),
+    db_path=os.environ.get("CHAT_SUMMARY_CACHE_DB") or None,
+)
+
+async def create_completion(endpoint, **kwargs):
+    """Call the chat completions API under the endpoint's upstream policy, holding one of its upstream slots.
+
+    The call first waits for its model's budget, at the endpoint's priority.
+    Records the wait for both, the upstream call itself (retries and hedges
+    included), and the model, token usage and finish reason of the response.
+    Raises UpstreamUnavailable when the call fails for good, runs past its
+    deadline or is refused by the circuit breaker.
+    """
+    queued = time.perf_counter()
+    priority = PRIORITIES[endpoint]
+    async with model_budget(kwargs["model"]).slot(priority), upstream_slots[endpoint].slot(priority):
+        started = time.perf_counter()
+        observe_phase(endpoint, "upstream_queue", started - queued)
+        try:
+            response = await upstream_policies[endpoint].call(
+                lambda: attempt_completion(endpoint, kwargs),
+                reserve_hedge=lambda: reserve_hedge_slot(endpoint, kwargs["model"]),
+            )
+        except UpstreamUnavailable as e:
+            upstream_errors.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            observe_phase(endpoint, "upstream_wait", time.perf_counter() - started)
+
+    finish_reason = response.choices[0].finish_reason if response.choices else None
+    record_completion(endpoint, getattr(response, "model", None) or kwargs.get("model"), response.usage, finish_reason)
+    return response
+
+def reserve_hedge_slot(endpoint, model):
+    """Take a model budget and an endpoint slot for a hedge if both are free at once.
+
+    Returns the function that gives them back, or None (the hedge is skipped)
+    so hedges never take the caps past their limits or jump the queue.
+    """
+    budget, slots = model_budget(model), upstream_slots[endpoint]
+    if not budget.try_acquire():
+        return None
+    if not slots.try_acquire():
+        budget.release()
+        return None
+
+    def release():
+        slots.release()
+        budget.release()
+    return release
+
+async def attempt_completion(endpoint, kwargs):
+    try:
+        return await client.chat.completions.create(**kwargs)
+    except Exception as e:
+        upstream_errors.inc(endpoint, type(e).__name__)
+        raise
+
+async def complete_analysis(kind, route, messages):
+    """Ask the routed model tier for an analysis, escalating while the reply is not acceptable.
+
+    A reply is escalated to the next tier when it is not valid nutrition JSON
+    or reports low confidence. The last tier's reply is returned as long as it
+    parses.
+    """
+    task = f"analyze_{kind}"
+    models = model_router.plan(kind, route)
+    nutrition_data = None
+    for model in models:
+        limit = token_sizer.limit(task, model)
+        nutrition_data, finish_reason = await request_analysis(task, model, messages, limit)
+        if nutrition_data is None and finish_reason == "length" and limit < token_sizer.cap(task):
+            # Cut off by our own sizing rather than the model's judgement, so retry it in full
+            model_escalations.inc("analyze", model, "length")
+            nutrition_data, finish_reason = await request_analysis(task, model, messages, token_sizer.cap(task))
+
+        accepted = acceptable_analysis(nutrition_data)
+        model_router.record(route, model, accepted)
+        if accepted:
+            return nutrition_data
+        if model != models[-1]:
+            reason = "invalid" if nutrition_data is None or "confidence" not in nutrition_data else "low_confidence"
+            model_escalations.inc("analyze", model, reason)
+            log_event("model_escalation", logging.DEBUG, route=route, model=model, reason=reason)
+
+    if nutrition_data is None:
+        raise Exception("Could not parse JSON from ERNIE response")
+    return nutrition_data
+
+async def request_analysis(task, model, messages, limit):
+    """One analysis completion; returns (parsed JSON or None, finish reason)"""
+    response = await create_completion(
+        "analyze",
+        model=model,
+        messages=messages,
+        max_completion_tokens=limit,
+        stream=False
+    )
+    if not response.choices:
+        raise Exception("No response from ERNIE")
+    finish_reason = response.choices[0].finish_reason
+    token_sizer.record(task, model, response.usage, finish_reason, limit)
+
+    with phase("analyze", "json_extract"):
+        try:
+            nutrition_data = parse_model_json("analyze", response.choices[0].message.content)
+        except ServiceError:
+            return None, finish_reason
+        return validate_analysis(nutrition_data), finish_reason
+
+def parse_model_json(operation, text, expect=dict):
+    """The JSON object (or `expect` value) in a model reply, repaired locally if needed; ServiceError if beyond repair"""
+    try:
+        value, repaired = extract_json(text, expect)
+    except ValueError as e:
+        model_json_repairs.inc(operation, "unrecoverable")
+        log_event("model_json_unrecoverable", logging.WARNING, operation=operation, error=str(e))
+        raise ServiceError(f"Could not parse JSON from ERNIE response: {e}", status=500)
+    if repaired:
+        model_json_repairs.inc(operation, "repaired")
+    return value
+
+async def analyze_image_with_ernie(image_url, additional_context="", lang="en"):
+    """Analyze food image directly using ERNIE vision model (image_url is a data: URL)"""
+    started = time.perf_counter()
+    try:
+        if lang == "zh":
+            # Pure Chinese prompt
+            base_prompt = """你是一位专业的营养分析专家，擅长解读中国食品包装标签。请仔细分析这张食品图片，从营养成分表中提取准确的营养数据。"""
+            
+            if additional_context:
+                base_prompt += f"\n\n用户补充说明：{additional_context}"
+            
+            prompt = base_prompt + """
+
+📋 分析步骤：
+1. 在包装上找到"营养成分表"区域
+2. 定位"每100克"或"每份"的标注
+3. 精确提取以下营养成分的数值：
+   • 能量（千焦kJ）→ 需换算为千卡kcal（除以4.184）
+   • 蛋白质（克）
+   • 脂肪（克）
+   • 碳水化合物（克）
+   • 钠（毫克）
+   • 膳食纤维（克，如有标注）
+   • 糖（克，如有标注）
+
+4. 识别产品信息：
+   • 产品中文名称
+   • 食品类别（调味料/零食/饮料/主食等）
+   • 包装上的所有可见文字
+
+📤 输出要求：
+请严格按照以下JSON格式返回，所有字段必须用中文填写：
+
+{
+  "name": "产品完整中文名称",
+  "category": "食品类别",
+  "calories": 整数（千卡，从能量字段换算），
+  "protein": 整数（克），
+  "carbs": 整数（克），
+  "fats": 整数（克），
+  "fiber": 整数（克，无标注则填0），
+  "sugar": 整数（克，无标注则填0），
+  "sodium": 整数（毫克），
+  "serving_size": "每100克 或 实际标注的份量",
+  "confidence": "高/中/低",
+  "benefits": ["健康益处1", "健康益处2", "健康益处3"],
+  "considerations": ["注意事项1", "注意事项2"],
+  "explanation": "你的分析依据和计算说明",
+  "detected_text": "包装上所有可见的中文文字"
+}
+
+⚠️ 重要规则：
+• 必须从营养成分表中读取数值，不可估算
+• 能量单位如为千焦（kJ），必须换算为千卡（kcal = kJ ÷ 4.184）
+• 所有数值四舍五入为整数
+• 如果营养成分表中没有膳食纤维或糖的数据，填写0
+• 只输出JSON格式，不要添加任何其他文字或符号"""
+
+        else:
+            # Pure English prompt
+            base_prompt = """You are a professional nutrition analysis expert specializing in reading Chinese food packaging labels. Carefully analyze this food image and extract accurate nutritional data from the nutrition facts table."""
+            
+            if additional_context:
+                base_prompt += f"\n\nUser Context: {additional_context}"
+            
+            prompt = base_prompt + """
+
+📋 Analysis Steps:
+1. Locate the "营养成分表" (Nutrition Facts Table) on the package
+2. Find the section marked "每100克" (per 100g) or "每份" (per serving)
+3. Extract exact values for these nutritional components:
+   • 能量 (Energy in kJ) → Convert to kcal by dividing by 4.184
+   • 蛋白质 (Protein in grams)
+   • 脂肪 (Fat in grams)
+   • 碳水化合物 (Carbohydrates in grams)
+   • 钠 (Sodium in mg)
+   • 膳食纤维 (Dietary Fiber in grams, if listed)
+   • 糖 (Sugar in grams, if listed)
+
+4. Identify product information:
+   • Product name (translate to English)
+   • Food category
+   • All visible text on the packaging
+
+📤 Output Format:
+Provide your response in this exact JSON structure:
+
+{
+  "name": "Product name in English",
+  "category": "Food category (Seasoning/Snack/Beverage/Meal/etc.)",
+  "calories": integer (kcal - converted from 能量/kJ),
+  "protein": integer (grams from 蛋白质),
+  "carbs": integer (grams from 碳水化合物),
+  "fats": integer (grams from 脂肪),
+  "fiber": integer (grams from 膳食纤维, use 0 if not listed),
+  "sugar": integer (grams from 糖, use 0 if not listed),
+  "sodium": integer (mg from 钠),
+  "serving_size": "per 100g or the actual serving size stated",
+  "confidence": "high/medium/low",
+  "benefits": ["health benefit 1", "health benefit 2", "health benefit 3"],
+  "considerations": ["dietary consideration 1", "consideration 2"],
+  "explanation": "Your analysis rationale and calculation details",
+  "detected_text": "All Chinese text visible on the packaging"
+}
+
+⚠️ Critical Rules:
+• Extract values ONLY from the nutrition facts table, do not estimate
+• If energy is in kJ (千焦), convert to kcal by dividing by 4.184
+• Round all numerical values to the nearest integer
+• If fiber or sugar is not listed in the table, use 0
+• Output ONLY valid JSON with no additional text or formatting"""
+
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url
+                        }
+                    }
+                ]
+            }
+        ]
+        observe_phase("analyze", "prompt_build", time.perf_counter() - started)
+
+        return await complete_analysis("image", request_class("image", additional_context, lang), messages)
+
+    except json.JSONDecodeError as e:
+        raise Exception(f"JSON parsing error: {str(e)}")
+    except ServiceError:
+        raise
+    except Exception as e:
+        raise Exception(f"ERNIE Vision Analysis Error: {str(e)}")
+
+async def analyze_text_with_ernie(description, lang="en"):
+    """Analyze food description using ERNIE text model"""
+    started = time.perf_counter()
+    try:
+        if lang == "zh":
+            prompt = f"""你是一位专业的营养分析专家。请根据以下食物描述，提供详细的营养信息估算。
+
+📝 食物描述：
+{description}
+
+📤 请严格按照以下JSON格式返回：
+
+{{
+  "name": "食物名称",
+  "category": "食品类别",
+  "calories": 整数（每份千卡）,
+  "protein": 整数（每份克）,
+  "carbs": 整数（每份克）,
+  "fats": 整数（每份克）,
+  "fiber": 整数（每份克）,
+  "sugar": 整数（每份克）,
+  "sodium": 整数（每份毫克）,
+  "serving_size": "份量描述",
+  "confidence": "高/中/低",
+  "benefits": ["健康益处1", "健康益处2", "健康益处3"],
+  "considerations": ["注意事项1", "注意事项2"],
+  "explanation": "营养分析的依据和说明"
+}}
+
+⚠️ 只输出JSON格式，不要添加任何其他内容。"""
+
+        else:
+            prompt = f"""You are a professional nutrition analysis expert. Based on the following food description, provide detailed nutritional information estimates.
+
+📝 Food Description:
+{description}
+
+📤 Provide your response in this exact JSON format:
+
+{{
+  "name": "Food name",
+  "category": "Food category",
+  "calories": integer (kcal per serving),
+  "protein": integer (grams per serving),
+  "carbs": integer (grams per serving),
+  "fats": integer (grams per serving),
+  "fiber": integer (grams per serving),
+  "sugar": integer (grams per serving),
+  "sodium": integer (mg per serving),
+  "serving_size": "serving size description",
+  "confidence": "high/medium/low",
+  "benefits": ["health benefit 1", "health benefit 2", "health benefit 3"],
+  "considerations": ["dietary consideration 1", "consideration 2"],
+  "explanation": "Brief rationale for the nutritional analysis"
+}}
+
+⚠️ Output ONLY valid JSON with no additional text."""
+
+        messages = [
+            {"role": "user", "content": prompt}
+        ]
+        observe_phase("analyze", "prompt_build", time.perf_counter() - started)
+
+        return await complete_analysis("text", request_class("text", description, lang), messages)
+
+    except json.JSONDecodeError as e:
+        raise Exception(f"JSON parsing error: {str(e)}")
+    except ServiceError:
+        raise
+    except Exception as e:
+        raise Exception(f"ERNIE Analysis Error: {str(e)}")
+
+async def analyze_image_bytes(image_bytes, additional_context="", lang="en"):
+    """Run an uploaded photo through the caches and, on a miss, the preprocessing pipeline and ERNIE.
+
+    Returns (nutrition_data, cached, preprocess_report); the report is None for cache hits
+    and for requests that joined an identical one in flight.
+    """
+    cache_key = analyze_cache_key("image", image_bytes, lang, additional_context)
+    nutrition_data = analyze_cache.get(cache_key)
+    if nutrition_data is not None:
+        return nutrition_data, True, None
+
+    # A follower did not run the analysis, so it reports cached and has no preprocessing of its own
+    return await analyze_flight.do(
+        cache_key,
+        lambda: analyze_uncached_image(image_bytes, cache_key, additional_context, lang),
+        follower=lambda result: (result[0], True, None),
+    )
+
+async def analyze_uncached_image(image_bytes, cache_key, additional_context="", lang="en"):
+    """Near-duplicate lookup, then preprocessing and ERNIE, for an exact-cache miss"""
+    namespace = analyze_namespace(lang, additional_context)
+    # Decoding and hashing are CPU-bound, so keep them off the event loop
+    decoded = await asyncio.to_thread(image_pipeline.decode, image_bytes)
+    image_hash = None
+    if decoded is not None:
+        image_hash = await asyncio.to_thread(hash_image, decoded.image, PHASH_ALGORITHM)
+        match = image_index.lookup(image_hash, namespace)
+        if match is not None:
+            nutrition_data = analyze_cache.get(match.value)
+            if nutrition_data is not None:
+                return nutrition_data, True, None
+            image_index.discard(match.image_hash, namespace)
+
+    with phase("analyze", "image_preprocess"):
+        prepared = await asyncio.to_thread(image_pipeline.prepare, image_bytes, decoded)
+    started = time.perf_counter()
+    nutrition_data = await analyze_image_with_ernie(prepared.data_url, additional_context, lang=lang)
+    report = image_pipeline.record(prepared, (time.perf_counter() - started) * 1000)
+    log_event(
+        "image_preprocess",
+        logging.DEBUG,
+        original_bytes=report["original_bytes"],
+        upstream_bytes=report["upstream_bytes"],
+        upstream_ms=report["upstream_ms"],
+        upstream_delta_ms=report["upstream_delta_ms"],
+    )
+
+    analyze_cache.set(cache_key, nutrition_data)
+    if image_hash is not None:
+        image_index.add(image_hash, namespace, cache_key)
+    return nutrition_data, False, report
+
+async def analyze_image_upload(image_bytes, additional_context="", lang="en"):
+    """Response body for an image analysis, shared by the JSON and binary upload paths"""
+    stale = False
+    try:
+        nutrition_data, cached, preprocess_report = await analyze_image_bytes(
+            image_bytes, additional_context, lang=lang
+        )
+    except UpstreamUnavailable:
+        nutrition_data = analyze_cache.get_stale(analyze_cache_key("image", image_bytes, lang, additional_context))
+        if nutrition_data is None:
+            raise
+        cached, stale, preprocess_report = True, True, None
+
+    # Extract detected text if available
+    detected_text = nutrition_data.get('detected_text', '')
+    ocr_results = []
+    if detected_text:
+        # Split text into lines for display
+        lines = detected_text.split('\n')
+        ocr_results = [
+            {"text": line.strip(), "confidence": 0.95}
+            for line in lines if line.strip()
+        ]
+
+    response = {
+        "success": True,
+        "cached": cached,
+        "ocr_results": ocr_results,
+        "nutrition": nutrition_data,
+        "preprocess": preprocess_report
+    }
+    if stale:
+        response["stale"] = True
+    return response
+
+async def analyze_description(description, lang="en"):
+    """Response body for a text description analysis.
+
+    Pasted nutrition tables are parsed locally and meals made of known foods are
+    estimated from the local food table; anything else goes to ERNIE.
+    """
+    if LABEL_PARSER_ENABLED:
+        nutrition_data = parse_nutrition_label(description, lang)
+        if nutrition_data is not None:
+            label_parser_stats["hits"] += 1
+            return {
+                "success": True,
+                "cached": False,
+                "source": "label_parser",
+                "nutrition": nutrition_data
+            }
+        label_parser_stats["fallbacks"] += 1
+
+    if food_db is not None:
+        nutrition_data = food_db.estimate(description, lang, min_score=FOOD_DB_MIN_SCORE)
+        if nutrition_data is not None:
+            return {
+                "success": True,
+                "cached": False,
+                "source": "food_db",
+                "nutrition": nutrition_data
+            }
+
+    cache_key = analyze_cache_key("text", description, lang)
+    nutrition_data = analyze_cache.get(cache_key)
+    cached = nutrition_data is not None
+    if not cached:
+        async def analyze():
+            result = await analyze_text_with_ernie(description, lang=lang)
+            analyze_cache.set(cache_key, result)
+            return result, False
+
+        try:
+            nutrition_data, cached = await analyze_flight.do(
+                cache_key, analyze, follower=lambda result: (result[0], True)
+            )
+        except UpstreamUnavailable:
+            nutrition_data = analyze_cache.get_stale(cache_key)
+            if nutrition_data is None:
+                raise
+            return {
+                "success": True,
+                "cached": True,
+                "stale": True,
+                "nutrition": nutrition_data
+            }
+    return {
+        "success": True,
+        "cached": cached,
+        "nutrition": nutrition_data
+    }
+
+async def analyze_request(data):
+    """Handle the JSON form of /analyze: a base64 `image` or a text `description`"""
+    if not data:
+        raise ServiceError("No data provided")
+
+    lang = data.get("lang", "en")
+
+    # If image is provided - use ERNIE vision
+    if 'image' in data:
+        with phase("analyze", "parse"):
+            image_bytes = decode_base64_image(data['image'])
+        return await analyze_image_upload(image_bytes, data.get('description', ''), lang=lang)
+
+    # If only description is provided - use ERNIE text model
+    if 'description' in data:
+        return await analyze_description(data['description'], lang=lang)
+
+    raise ServiceError("No image or description provided")
+
+# Batch analysis: how many items of one request may be in flight at once, and how many
+# items a single request may carry.
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", 4))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 16))
+
+NUTRIENT_FIELDS = ["calories", "protein", "carbs", "fats", "fiber", "sugar", "sodium"]
+
+MEAL_SEPARATORS = re.compile(r"\s*[,，、;；\n]\s*")
+
+def split_meal_description(meal):
+    """Split a free-text meal like "rice, curry chicken, iced tea" into items"""
+    return [part for part in MEAL_SEPARATORS.split(meal or "") if part and part.strip()]
+
+def decode_base64_image(image_data):
+    """Decode a base64 image, with or without a data URL prefix"""
+    try:
+        # Skip any data URL prefix via a view rather than copying the payload
+        payload = memoryview(image_data.encode('ascii'))[image_data.find(',') + 1:]
+        image_bytes = base64.b64decode(payload)
+    except (AttributeError, binascii.Error, ValueError):
+        raise ServiceError("Invalid base64 image data")
+    if not image_bytes:
+        raise ServiceError("Invalid base64 image data")
+    return image_bytes
+
+@phase("analyze_batch", "parse")
+def parse_batch_items(data, images=()):
+    """Turn a batch request into a list of (cache_key, item) pairs.
+
+    `items` holds {"image": base64} / {"description": text} objects, `meal` a
+    comma-separated description, and `images` raw uploads. Items that cannot
+    be decoded are kept with their error so they are reported in place.
+    """
+    data = data or {}
+    lang = data.get('lang', 'en')
+    items = []
+
+    for raw in data.get('items') or []:
+        if not isinstance(raw, dict):
+            items.append((None, {"error": "Item must be an object"}))
+        elif not isinstance(raw.get('description', ''), str):
+            items.append((None, {"error": "description must be text"}))
+        elif 'image' in raw:
+            try:
+                image_bytes = decode_base64_image(raw['image'])
+            except ServiceError as e:
+                items.append((None, {"error": str(e)}))
+                continue
+            context = raw.get('description', '')
+            items.append((
+                analyze_cache_key("image", image_bytes, lang, context),
+                {"image": image_bytes, "description": context}
+            ))
+        elif raw.get('description'):
+            items.append((analyze_cache_key("text", raw['description'], lang), {"description": raw['description']}))
+        else:
+            items.append((None, {"error": "No image or description provided"}))
+
+    if not isinstance(data.get('meal') or '', str):
+        raise ServiceError("meal must be text")
+    for description in split_meal_description(data.get('meal', '')):
+        items.append((analyze_cache_key("text", description, lang), {"description": description}))
+
+    for image_bytes in images:
+        items.append((analyze_cache_key("image", image_bytes, lang), {"image": image_bytes, "description": ""}))
+
+    if not items:
+        raise ServiceError("No items provided")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ServiceError(f"A batch may contain at most {MAX_BATCH_ITEMS} items")
+    return items
+
+def parse_batch_parallelism(data):
+    """The `parallelism` of a batch request clamped to 1..MAX_BATCH_ITEMS, or None for the default"""
+    value = (data or {}).get('parallelism')
+    if value in (None, ''):
+        return None
+    try:
+        if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+            raise ValueError
+        parallelism = int(value)
+    except (TypeError, ValueError):
+        raise ServiceError("parallelism must be a whole number")
+    return max(1, min(parallelism, MAX_BATCH_ITEMS))
+
+async def analyze_batch_item(item, lang="en"):
+    if 'error' in item:
+        raise ServiceError(item['error'])
+    if 'image' in item:
+        return await analyze_image_upload(item['image'], item['description'], lang=lang)
+    return await analyze_description(item['description'], lang=lang)
+
+async def iter_batch(items, lang="en", parallelism=None):
+    """Analyze batch items concurrently, yielding one result per item as it completes.
+
+    Identical items share a single analysis. At most `parallelism` distinct
+    items run at once, so a slow item only delays its own result.
+    """
+    groups = {}
+    for index, (key, item) in enumerate(items):
+        group_key = key if key is not None else f"invalid:{index}"
+        groups.setdefault(group_key, (item, []))[1].append(index)
+
+    semaphore = asyncio.Semaphore(max(1, min(parallelism or BATCH_PARALLELISM, MAX_BATCH_ITEMS)))
+
+    async def run(item, indices):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                return indices, await analyze_batch_item(item, lang), None, started
+            except ServiceError as e:
+                return indices, None, str(e), started
+            except Exception as e:
+                log_event("batch_item_error", logging.ERROR, error=type(e).__name__, message=str(e))
+                return indices, None, str(e), started
+
+    tasks = [asyncio.create_task(run(item, indices)) for item, indices in groups.values()]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indices, result, error, started = await next_done
+            elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+            for index in indices:
+                if error is None:
+                    yield {"index": index, "success": True, "elapsed_ms": elapsed_ms, **result}
+                else:
+                    yield {"index": index, "success": False, "elapsed_ms": elapsed_ms, "error": error}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def meal_totals(results):
+    """Sum the nutrition of every successfully analyzed batch item"""
+    totals = dict.fromkeys(NUTRIENT_FIELDS, 0)
+    for result in results:
+        nutrition = result.get('nutrition') or {}
+        for field in NUTRIENT_FIELDS:
+            value = nutrition.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[field] += value
+    return {field: round(value) for field, value in totals.items()}
+
+async def analyze_batch(items, lang="en", parallelism=None):
+    """Response body for a non-streaming /analyze/batch request, items in request order"""
+    results = [None] * len(items)
+    async for result in iter_batch(items, lang, parallelism):
+        results[result['index']] = result
+
+    succeeded = [result for result in results if result['success']]
+    return {
+        "success": bool(succeeded),
+        "items": results,
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "totals": meal_totals(succeeded)
+    }
+
+async def stream_batch(items, lang="en", parallelism=None):
+    """NDJSON lines for /analyze/batch: one per item as it completes, then the meal totals"""
+    succeeded = []
+    failed = 0
+    async for result in iter_batch(items, lang, parallelism):
+        if result['success']:
+            succeeded.append(result)
+        else:
+            failed += 1
+        yield json.dumps({"type": "item", **result}, ensure_ascii=False) + "\n"
+
+    yield json.dumps({
+        "type": "summary",
+        "success": bool(succeeded),
+        "succeeded": len(succeeded),
+        "failed": failed,
+        "totals": meal_totals(succeeded)
+    }, ensure_ascii=False) + "\n"
+
+def build_chat_messages(messages, lang="en"):
+    """Prepend the nutrition assistant system prompt to the client's messages"""
+    system_prompt_content = """You are a professional nutrition assistant. 
+        Your goal is to provide clear, structured, and easy-to-read advice.
+        
+        Guidelines:
+        1. Use clear section headings (e.g., **Key Recommendations**, **Top Food Choices**, **Things to Avoid**).
+        2. Use bullet points for lists.
+        3. Bold important keywords.
+        4. Keep paragraphs short and concise.
+        5. Avoid long blocks of text.
+        6. Use a professional yet friendly tone.
+        7. DO NOT answer questions that are not related to nutrition.
+        8. If you receive a question regarding what to eat today or meal plan of the day, please direct the user to the meal planner tab and append the tag [ACTION:NavigateToMealPlanner] at the end of your response."""
+
+    if lang == 'zh':
+        system_prompt_content = """你是一位专业的营养助手。
+        你的目标是提供清晰、结构化且易于阅读的建议。
+        
+        指南：
+        1. 使用清晰的章节标题（例如：**关键建议**、**首选食物**、**避免事项**）。
+        2. 使用项目符号列出清单。
+        3. 加粗重要的关键词。
+        4. 保持段落简短精炼。
+        5. 避免大段的文字。
+        6. 使用专业且友好的语气。
+        7. 不要回答与营养无关的问题。
+        8. 如果收到关于今天吃什么或每日膳食计划的问题，请引导用户去膳食计划标签页，并在回复末尾附加标签 [ACTION:NavigateToMealPlanner]。"""
+
+    system_prompt = {
+        "role": "system", 
+        "content": system_prompt_content
+    }
+
+    return [system_prompt] + messages
+
+async def stream_chat(formatted_messages):
+    """Relay a streamed ERNIE chat completion as Server-Sent Events.
+
+    Yields `token` events as text arrives (with any [ACTION:...] tag held back),
+    then a `done` event with the full message, detected action, usage, timing
+    and the context report.
+    """
+    started = time.perf_counter()
+    first_token_ms = None
+    parts = []
+    usage = None
+    finish_reason = None
+    model = "ernie-5.0-thinking-preview"
+    tag_filter = ActionTagFilter()
+
+    try:
+        question = cacheable_question(formatted_messages)
+        if question is not None:
+            namespace = chat_namespace(formatted_messages)
+            answer = cached_chat_answer(question, namespace)
+            if answer is not None:
+                visible = tag_filter.feed(answer["message"]) + tag_filter.flush()
+                if visible:
+                    yield sse_event("token", {"content": visible})
+                yield sse_event("done", {
+                    **answer,
+                    "cached": True,
+                    "timing": {"first_token_ms": None, "total_ms": round((time.perf_counter() - started) * 1000, 1)}
+                })
+                return
+
+        formatted_messages, context = await chat_context.prepare(formatted_messages)
+
+        # The slot is held for the whole stream, not just until the first byte
+        queued = time.perf_counter()
+        async with model_budget(model).slot(PRIORITIES["chat"]), upstream_slots["chat"].slot(PRIORITIES["chat"]):
+            upstream_started = time.perf_counter()
+            observe_phase("chat", "upstream_queue", upstream_started - queued)
+            # Only opening the stream is retried; once tokens flow, a failure ends the reply
+            stream = await upstream_policies["chat"].call(lambda: attempt_completion("chat", {
+                "model": model,
+                "messages": formatted_messages,
+                "max_completion_tokens": 2048,
+                "stream": True,
+                "stream_options": {"include_usage": True}
+            }))
+
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage.model_dump()
+                if not chunk.choices:
+                    continue
+
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+                delta = choice.delta.content if choice.delta else None
+                if not delta:
+                    continue
+
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - started) * 1000
+                parts.append(delta)
+                visible = tag_filter.feed(delta)
+                if visible:
+                    yield sse_event("token", {"content": visible})
+            observe_phase("chat", "upstream_wait", time.perf_counter() - upstream_started)
+        record_completion("chat", model, usage, finish_reason)
+
+        rest = tag_filter.flush()
+        if rest:
+            yield sse_event("token", {"content": rest})
+
+        message = "".join(parts)
+        # Only complete answers are reused
+        if question is not None and finish_reason == "stop":
+            store_chat_answer(question, namespace, {"success": True, "message": message, "action": find_action(message)})
+        yield sse_event("done", {
+            "success": True,
+            "message": message,
+            "action": find_action(message),
+            "cached": False,
+            "finish_reason": finish_reason,
+            "usage": usage,
+            "timing": {
+                "first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1)
+            },
+            "context": context
+        })
+
+    except Exception as e:
+        request_errors.inc("chat_stream", type(e).__name__)
+        log_event("chat_stream_error", logging.ERROR, error=type(e).__name__, message=str(e))
+        yield sse_event("error", {"error": str(e)})
+
+async def summarize_chat(summary, messages):
+    """Fold `messages` into the running summary of a chat"""
+    transcript = "\n".join(f"{message.get('role')}: {message.get('content')}" for message in messages)
+    prompt = f"""Update the running summary of a conversation between a user and a nutrition assistant.
+Keep what matters for later answers: the user's goals, allergies, dietary restrictions, health conditions,
+foods they like or avoid, and the advice already given. Write at most 200 words, in the language of the
+conversation, and reply with the summary only.
+
+Current summary:
+{summary or "(none)"}
+
+New messages:
+{transcript}"""
+
+    response = await create_completion(
+        "chat",
+        model=CHAT_SUMMARY_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        max_completion_tokens=512,
+        stream=False
+    )
+    if response.choices and response.choices[0].message.content:
+        return response.choices[0].message.content.strip()
+    raise ServiceError("No summary from ERNIE", status=500)
+
+chat_context = ChatContext(
+    summarize_chat,
+    chat_summary_cache,
+    budget=int(os.environ.get("CHAT_CONTEXT_BUDGET", 6000)),
+    keep_turns=int(os.environ.get("CHAT_KEEP_TURNS", 6)),
+    summary_chunk=int(os.environ.get("CHAT_SUMMARY_CHUNK", 3000)),
+)
+
+# Single-turn questions with no personal details are answered from earlier answers to the
+# same or a rephrased question (MinHash/LSH, estimated Jaccard >= CHAT_CACHE_THRESHOLD, and
+# the same foods, conditions and numbers).
+CHAT_CACHE_ENABLED = os.environ.get("CHAT_CACHE", "1") != "0"
+CHAT_CACHE_MAX_QUESTION = int(os.environ.get("CHAT_CACHE_MAX_QUESTION", 300))
+chat_answer_cache = ResultCache(
+    max_entries=int(os.environ.get("CHAT_ANSWER_CACHE_SIZE", 4096)),
+    max_bytes=int(os.environ.get("CHAT_ANSWER_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    ttl=int(os.environ.get("CHAT_ANSWER_CACHE_TTL", 7 * 24 * 3600)),
+    db_path=os.environ.get("CHAT_ANSWER_CACHE_DB") or None,
+)
+question_index = QuestionIndex(
+    threshold=float(os.environ.get("CHAT_CACHE_THRESHOLD", 0.4)),
+    max_entries=int(os.environ.get("CHAT_QUESTION_INDEX_SIZE", 50_000)),
+)
+
+def cacheable_question(formatted_messages):
+    """The question of a single-turn chat without personal details, or None"""
+    if not CHAT_CACHE_ENABLED:
+        return None
+    history = [message for message in formatted_messages if message.get("role") != "system"]
+    if len(history) != 1 or history[0].get("role") != "user":
+        return None
+    question = history[0].get("content")
+    if not isinstance(question, str) or len(question) > CHAT_CACHE_MAX_QUESTION or is_personal(question):
+        return None
+    return question if normalize_question(question) else None
+
+def chat_namespace(formatted_messages):
+    """The system prompt differs per language, so answers are partitioned by it"""
+    return flight_key([message.get("content") for message in formatted_messages if message.get("role") == "system"])
+
+def chat_answer_key(question, namespace):
+    return f"chat_answer:{flight_key([namespace, normalize_question(question)])}"
+
+def cached_chat_answer(question, namespace):
+    """Stored answer to the same or a near-identical question, or None"""
+    answer = chat_answer_cache.get(chat_answer_key(question, namespace))
+    if answer is not None:
+        return answer
+
+    signature = question_index.signature(question)
+    match = question_index.lookup(signature, namespace, content_words(question)) if signature is not None else None
+    if match is None:
+        return None
+    answer = chat_answer_cache.get(match.value)
+    if answer is None:
+        question_index.discard(namespace, match.value)
+    return answer
+
+def store_chat_answer(question, namespace, answer):
+    key = chat_answer_key(question, namespace)
+    chat_answer_cache.set(key, answer)
+    signature = question_index.signature(question)
+    if signature is not None:
+        question_index.add(signature, namespace, content_words(question), key)
+
+def wants_stream(data, accept=""):
+    """Whether a /chat request asked for Server-Sent Events"""
+    return bool(data.get('stream')) or 'text/event-stream' in (accept or '')
+
+def parse_chat_request(data):
+    """Validate a /chat body and return the messages to send upstream"""
+    with phase("chat", "parse"):
+        if not data or 'messages' not in data:
+            raise ServiceError("No messages provided")
+
+    # The frontend should send {role: 'user'|'assistant', content: '...'}
+    with phase("chat", "prompt_build"):
+        return build_chat_messages(data['messages'], data.get("language", "en"))
+
+async def complete_chat(formatted_messages):
+    """Response body for a non-streaming /chat request"""
+    question = cacheable_question(formatted_messages)
+    if question is not None:
+        namespace = chat_namespace(formatted_messages)
+        answer = cached_chat_answer(question, namespace)
+        if answer is not None:
+            return {**answer, "cached": True}
+
+    formatted_messages, context = await chat_context.prepare(formatted_messages)
+    result = await chat_flight.do(flight_key(formatted_messages), lambda: request_chat(formatted_messages))
+    # Only complete answers are reused, as in stream_chat
+    if question is not None and result["finish_reason"] == "stop" and result["message"]:
+        store_chat_answer(question, namespace, {
+            "success": True, "message": result["message"], "action": result["action"]
+        })
+    return {**result, "cached": False, "context": context}
+
+async def request_chat(formatted_messages):
+    response = await create_completion(
+        "chat",
+        model="ernie-5.0-thinking-preview",
+        messages=formatted_messages,
+        max_completion_tokens=2048,
+        stream=False
+    )
+
+    if response.choices and len(response.choices) > 0:
+        message = response.choices[0].message.content or ""
+        return {
+            "success": True,
+            "message": message,
+            "action": find_action(message),
+            "finish_reason": response.choices[0].finish_reason
+        }
+    raise ServiceError("No response from ERNIE", status=500)
+
+def build_meal_plan_prompt(user_profile, date, lang="en", avoid=()):
+    """Prompt asking ERNIE for a one-day meal plan matching the user's goals.
+
+    `avoid` lists dishes already planned for other days, to keep a range varied.
+    """
+    # Construct prompt based on user profile
+    profile_text = f"""
+    Profile:
+    - Daily Calorie Goal: {user_profile.get('daily_calorie_goal', 2000)} kcal
+    - Protein Goal: {user_profile.get('daily_protein_goal', 150)}g
+    - Carbs Goal: {user_profile.get('daily_carbs_goal', 200)}g
+    - Fats Goal: {user_profile.get('daily_fats_goal', 65)}g
+    - Dietary Restrictions: {', '.join(user_profile.get('dietary_restrictions', []))}
+    - Disliked Foods: {', '.join(user_profile.get('disliked_foods', []))}
+    - Goal: {user_profile.get('goal_type', 'maintenance')}
+    """
+
+    if lang == 'zh':
+        prompt = f"""你是一位专业的营养师。请根据以下用户档案，为 {date} 制定一份详细的每日膳食计划。
+        
+        {profile_text}
+
+        请生成一份结构化的膳食计划，包含早餐、午餐、晚餐和加餐（可选）。
+        
+        输出必须是严格的 JSON 格式，如下所示：
+        {{
+            "date": "YYYY-MM-DD",
+            "summary": "通过一两句话总结今天的计划（中文）",
+            "total_nutrition": {{
+                "calories": 总卡路里,
+                "protein": 总蛋白质(g),
+                "carbs": 总碳水(g),
+                "fats": 总脂肪(g)
+            }},
+            "meals": [
+                {{
+                    "type": "早餐",
+                    "name": "餐食名称",
+                    "description": "简短描述",
+                    "items": ["食物1", "食物2"],
+                    "nutrition": {{
+                        "calories": int,
+                        "protein": int,
+                        "carbs": int,
+                        "fats": int
+                    }},
+                    "tips": "烹饪或食用建议"
+                }},
+                // ... 其他餐食 (午餐, 晚餐, 加餐)
+            ]
+        }}
+        
+        只输出 JSON。不要输出其他文本。
+        """
+        if avoid:
+            prompt += f"\n        为了保持多样性，请不要重复其他日子已安排的菜品：{'、'.join(avoid)}\n"
+    else:
+        prompt = f"""You are a professional nutritionist. Please create a detailed daily meal plan for {date} based on the following user profile.
+
+        {profile_text}
+
+        Generate a structured meal plan including Breakfast, Lunch, Dinner, and optionally Snacks.
+
+        The output must be in strict JSON format as follows:
+        {{
+            "date": "YYYY-MM-DD",
+            "summary": "A brief 1-2 sentence summary of the day's plan",
+            "total_nutrition": {{
+                "calories": total_calories_int,
+                "protein": total_protein_g,
+                "carbs": total_carbs_g,
+                "fats": total_fats_g
+            }},
+            "meals": [
+                {{
+                    "type": "Breakfast",
+                    "name": "Meal Name",
+                    "description": "Short description",
+                    "items": ["Item 1", "Item 2"],
+                    "nutrition": {{
+                        "calories": int,
+                        "protein": int,
+                        "carbs": int,
+                        "fats": int
+                    }},
+                    "tips": "Preparation or eating tip"
+                }},
+                // ... other meals (Lunch, Dinner, Snack)
+            ]
+        }}
+
+        Output ONLY valid JSON. No markdown formatting or other text.
+        """
+        if avoid:
+            prompt += f"\n        For variety, do not repeat dishes already planned for other days: {'; '.join(avoid)}\n"
+
+    return prompt
+
+async def generate_meal_plan(user_profile, date, lang="en", record=True, avoid=()):
+    """Return (plan, cached) for one day, reusing the plan cached for the profile's bucket.
+
+    Profiles are quantized into buckets and the prompt is built from the bucket,
+    so a cached plan always fits every profile in it. The date picks one of
+    MEAL_PLAN_VARIANTS plans per bucket, so consecutive days rotate. `avoid`
+    only steers a newly generated plan away from dishes planned for other days.
+    """
+    bucket = profile_bucket(user_profile, lang, MEAL_PLAN_CALORIE_STEP, MEAL_PLAN_MACRO_STEP)
+    if record:
+        profile_popularity.record(bucket)
+
+    cache_key = meal_plan_key(bucket, date, MEAL_PLAN_VARIANTS)
+    meal_plan = meal_plan_cache.get(cache_key)
+    cached = meal_plan is not None
+
+    if not cached:
+        async def generate():
+            with phase("meal_plan", "prompt_build"):
+                prompt = build_meal_plan_prompt(bucket, date, lang, avoid)
+            result = await request_meal_plan(prompt)
+            meal_plan_cache.set(cache_key, result)
+            return result
+
+        meal_plan = await meal_plan_flight.do(cache_key, generate)
+
+    if date:
+        meal_plan['date'] = date
+    return meal_plan, cached
+
+async def request_meal_plan(prompt):
+    messages = [
+        {"role": "user", "content": prompt}
+    ]
+
+    limit = token_sizer.limit("meal_plan", MEAL_PLAN_MODEL)
+    response = await create_completion(
+        "meal_plan",
+        model=MEAL_PLAN_MODEL,
+        messages=messages,
+        max_completion_tokens=limit,
+        stream=False
+    )
+    finish_reason = response.choices[0].finish_reason if response.choices else None
+    token_sizer.record("meal_plan", MEAL_PLAN_MODEL, response.usage, finish_reason, limit)
+    if finish_reason == "length" and limit < token_sizer.cap("meal_plan"):
+        # Cut off by our own sizing; ask again with the full allowance
+        model_escalations.inc("meal_plan", MEAL_PLAN_MODEL, "length")
+        response = await create_completion(
+            "meal_plan",
+            model=MEAL_PLAN_MODEL,
+            messages=messages,
+            max_completion_tokens=token_sizer.cap("meal_plan"),
+            stream=False
+        )
+
+    if response.choices and len(response.choices) > 0:
+        log_event("meal_plan_response", logging.DEBUG, id=response.id, finish_reason=response.choices[0].finish_reason)
+        result_text = response.choices[0].message.content
+        if not result_text:
+            log_event("meal_plan_empty_content", logging.WARNING, id=response.id)
+            result_text = ""
+        else:
+            result_text = result_text.strip()
+        log_event("meal_plan_raw", logging.DEBUG, content=result_text)
+
+        with phase("meal_plan", "json_extract"):
+            meal_plan = parse_model_json("meal_plan", result_text)
+            try:
+                return validate_meal_plan(meal_plan)
+            except ValueError as e:
+                log_event("meal_plan_json_error", logging.WARNING, error=str(e), content=result_text)
+                raise ServiceError(f"Invalid JSON format from AI: {e}", status=500)
+    else:
+        raise ServiceError("No response from ERNIE", status=500)
+
+async def meal_plan_request(data):
+    """Response body for /generate-meal-plan"""
+    if not data:
+        raise ServiceError("No data provided")
+
+    profile, date, lang = data.get('profile', {}), data.get('date', ''), data.get('language', 'en')
+    try:
+        meal_plan, cached = await generate_meal_plan(profile, date, lang)
+    except UpstreamUnavailable:
+        meal_plan = stale_meal_plan(profile, date, lang)
+        if meal_plan is None:
+            raise
+        return {
+            "success": True,
+            "cached": True,
+            "stale": True,
+            "plan": meal_plan
+        }
+    return {
+        "success": True,
+        "cached": cached,
+        "plan": meal_plan
+    }
+
+# Days in a range rotate through the bucket's MEAL_PLAN_VARIANTS plans, so a longer range
+# would repeat days; the cap is never more than that
+MEAL_PLAN_MAX_RANGE_DAYS = min(int(os.environ.get("MEAL_PLAN_MAX_RANGE_DAYS", MEAL_PLAN_VARIANTS)), MEAL_PLAN_VARIANTS)
+MEAL_PLAN_RANGE_PARALLELISM = int(os.environ.get("MEAL_PLAN_RANGE_PARALLELISM", 3))
+# Most dish names passed on to later days as the variety constraint
+MEAL_PLAN_AVOID_MAX = int(os.environ.get("MEAL_PLAN_AVOID_MAX", 30))
+
+def parse_meal_plan_range(data):
+    """(profile, dates, lang) for /generate-meal-plan/range.
+
+    Takes `start_date` and either an inclusive `end_date` or a number of `days`.
+    """
+    if not data:
+        raise ServiceError("No data provided")
+    try:
+        start = datetime.date.fromisoformat(str(data.get('start_date') or ''))
+        if data.get('end_date'):
+            days = (datetime.date.fromisoformat(str(data['end_date'])) - start).days + 1
+        else:
+            days = int(data.get('days') or 7)
+    except ValueError:
+        raise ServiceError("start_date and end_date must be YYYY-MM-DD dates and days a number")
+    if not 1 <= days <= MEAL_PLAN_MAX_RANGE_DAYS:
+        raise ServiceError(f"A range must cover between 1 and {MEAL_PLAN_MAX_RANGE_DAYS} days")
+
+    dates = [(start + datetime.timedelta(days=offset)).isoformat() for offset in range(days)]
+    return data.get('profile', {}), dates, data.get('language', 'en')
+
+def dish_names(meal_plan):
+    return [meal.get('name') for meal in meal_plan.get('meals') or [] if isinstance(meal, dict) and meal.get('name')]
+
+async def iter_meal_plan_range(user_profile, dates, lang="en", parallelism=None):
+    """Plans for a range of dates, yielding one result per date as it is ready.
+
+    Days already cached for the profile's bucket are yielded first. The rest
+    are generated at most `parallelism` at a time; each one is asked to avoid
+    the dishes of every day known when it starts. Dates that share a rotation
+    variant share one plan.
+    """
+    bucket = profile_bucket(user_profile, lang, MEAL_PLAN_CALORIE_STEP, MEAL_PLAN_MACRO_STEP)
+    profile_popularity.record(bucket)
+    groups = {}
+    for date in dates:
+        groups.setdefault(meal_plan_key(bucket, date, MEAL_PLAN_VARIANTS), []).append(date)
+
+    planned = []
+    pending = []
+    for key, group in groups.items():
+        meal_plan = meal_plan_cache.get(key)
+        if meal_plan is None:
+            pending.append(group)
+            continue
+        planned.extend(dish_names(meal_plan))
+        for date in group:
+            yield {"date": date, "success": True, "cached": True, "plan": {**meal_plan, "date": date}}
+
+    semaphore = asyncio.Semaphore(max(1, parallelism or MEAL_PLAN_RANGE_PARALLELISM))
+
+    async def run(group):
+        async with semaphore:
+            # Read when the day starts, so it sees every day finished before it
+            avoid = list(dict.fromkeys(planned))[-MEAL_PLAN_AVOID_MAX:]
+            try:
+                meal_plan, cached = await generate_meal_plan(bucket, group[0], lang, record=False, avoid=avoid)
+                return group, meal_plan, cached, False, None
+            except UpstreamUnavailable as e:
+                meal_plan = stale_meal_plan(bucket, group[0], lang)
+                if meal_plan is None:
+                    return group, None, False, False, str(e)
+                return group, meal_plan, True, True, None
+            except ServiceError as e:
+                return group, None, False, False, str(e)
+            except Exception as e:
+                log_event("meal_plan_range_error", logging.ERROR, error=type(e).__name__, message=str(e))
+                return group, None, False, False, str(e)
+
+    tasks = [asyncio.create_task(run(group)) for group in pending]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            group, meal_plan, cached, stale, error = await next_done
+            if error is not None:
+                for date in group:
+                    yield {"date": date, "success": False, "error": error}
+                continue
+            planned.extend(dish_names(meal_plan))
+            for date in group:
+                result = {"date": date, "success": True, "cached": cached, "plan": {**meal_plan, "date": date}}
+                if stale:
+                    result["stale"] = True
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def meal_plan_range(user_profile, dates, lang="en"):
+    """Response body for a non-streaming /generate-meal-plan/range request, days in date order"""
+    days = {}
+    async for result in iter_meal_plan_range(user_profile, dates, lang):
+        days[result['date']] = result
+    results = [days[date] for date in dates]
+    succeeded = sum(result['success'] for result in results)
+    return {
+        "success": succeeded > 0,
+        "days": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    }
+
+async def stream_meal_plan_range(user_profile, dates, lang="en"):
+    """NDJSON lines for /generate-meal-plan/range: one per day as it is ready, then a summary"""
+    succeeded = 0
+    async for result in iter_meal_plan_range(user_profile, dates, lang):
+        succeeded += result['success']
+        yield json.dumps({"type": "day", **result}, ensure_ascii=False) + "\n"
+
+    yield json.dumps({
+        "type": "summary",
+        "success": succeeded > 0,
+        "succeeded": succeeded,
+        "failed": len(dates) - succeeded
+    }, ensure_ascii=False) + "\n"
+
+def stale_meal_plan(user_profile, date, lang="en"):
+    """Any plan cached for the profile's bucket, expired or for another day, or None"""
+    bucket = profile_bucket(user_profile, lang, MEAL_PLAN_CALORIE_STEP, MEAL_PLAN_MACRO_STEP)
+    for key in meal_plan_keys(bucket, date, MEAL_PLAN_VARIANTS):
+        meal_plan = meal_plan_cache.get_stale(key)
+        if meal_plan is not None:
+            if date:
+                meal_plan['date'] = date
+            return meal_plan
+    return None
+
+# Analyses and meal plans can also run as jobs: /jobs answers with a job ID at once and a
+# worker pool on the event loop does the work, so no HTTP worker waits on the model.
+# Jobs are kept in SQLite (JOB_DB) and survive restarts; finished ones are retained for
+# JOB_RETENTION seconds. Processes may share JOB_DB; a job whose worker stops renewing its
+# JOB_LEASE-second lease is run again. Interactive requests outrank the nightly meal-plan precompute.
+JOB_PRIORITIES = {"high": 20, "normal": 10, "low": 0}
+JOB_DEFAULT_PRIORITY = {"analyze": "high", "meal_plan": "normal"}
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", 30))
+job_queue = JobQueue(
+    db_path=os.environ.get("JOB_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3")),
+    workers=int(os.environ.get("JOB_WORKERS", 8)),
+    retention=int(os.environ.get("JOB_RETENTION", 24 * 3600)),
+    max_finished=int(os.environ.get("JOB_MAX_FINISHED", 10_000)),
+    max_queued=int(os.environ.get("JOB_MAX_QUEUED", 1000)),
+    lease=float(os.environ.get("JOB_LEASE", 60)),
+)
+
+async def precompute_meal_plan_job(payload):
+    meal_plan, cached = await generate_meal_plan(payload["profile"], payload["date"], payload["language"], record=False)
+    return {"plan": meal_plan, "cached": cached}
+
+job_queue.register("analyze", analyze_request)
+job_queue.register("meal_plan", meal_plan_request)
+job_queue.register("meal_plan_precompute", precompute_meal_plan_job)
+
+async def submit_job(data):
+    """Response body for POST /jobs: the queued (or matching earlier) job"""
+    if not data:
+        raise ServiceError("No data provided")
+    kind = data.get('type')
+    if kind not in JOB_DEFAULT_PRIORITY:
+        raise ServiceError(f"type must be one of: {', '.join(JOB_DEFAULT_PRIORITY)}")
+    if not isinstance(data.get('request'), dict):
+        raise ServiceError("request must be the JSON body of the corresponding endpoint")
+    priority = data.get('priority') or JOB_DEFAULT_PRIORITY[kind]
+    if priority not in JOB_PRIORITIES:
+        raise ServiceError(f"priority must be one of: {', '.join(JOB_PRIORITIES)}")
+    return await job_queue.submit(kind, data['request'], JOB_PRIORITIES[priority])
+
+async def job_status(job_id, wait=0):
+    """Response body for GET /jobs/<id>, waiting up to `wait` seconds for the job to finish"""
+    try:
+        wait = min(max(float(wait or 0), 0), JOB_MAX_WAIT)
+    except ValueError:
+        raise ServiceError("wait must be a number of seconds")
+    job = await job_queue.wait(job_id, wait)
+    if job is None:
+        raise ServiceError("Job not found", status=404)
+    return job
+
+async def queued_meal_plan(user_profile, date, lang="en", record=False):
+    """generate_meal_plan() run as a low-priority job, so interactive jobs go first"""
+    job = await job_queue.submit(
+        "meal_plan_precompute", {"profile": user_profile, "date": date, "language": lang}, JOB_PRIORITIES["low"]
+    )
+    job = await job_queue.wait(job["id"])
+    if job["status"] != "succeeded":
+        raise ServiceError(job["error"], status=job["error_status"])
+    return job["result"]["plan"], job["result"]["cached"]
+
+# Warms the cache for the most requested profile buckets during off-peak hours.
+# Started by the server (see asgi.py / app.py) unless MEAL_PLAN_PRECOMPUTE=0.
+MEAL_PLAN_PRECOMPUTE = os.environ.get("MEAL_PLAN_PRECOMPUTE", "1") != "0"
+meal_plan_precomputer = MealPlanPrecomputer(
+    queued_meal_plan,
+    profile_popularity,
+    top_n=int(os.environ.get("MEAL_PLAN_PRECOMPUTE_TOP_N", 20)),
+    hours=tuple(int(hour) for hour in os.environ.get("MEAL_PLAN_PRECOMPUTE_HOURS", "2-5").split("-")),
+    variants=MEAL_PLAN_VARIANTS,
+)
+
+def cache_stats():
+    """Hit/miss counters for the result caches and request coalescing"""
+    return {
+        "analyze": analyze_cache.stats(),
+        "chat_answer": chat_answer_cache.stats(),
+        "chat_context": chat_context.stats(),
+        "chat_question_index": question_index.stats(),
+        "chat_summary": chat_summary_cache.stats(),
+        "image_index": image_index.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "label_parser": dict(label_parser_stats),
+        "food_db": food_db.stats() if food_db is not None else None,
+        "meal_plan": meal_plan_cache.stats(),
+        "meal_plan_precompute": meal_plan_precomputer.stats(),
+        "upstream": {endpoint: policy.stats() for endpoint, policy in upstream_policies.items()},
+        "model_budget": {model: budget.stats() for model, budget in model_budget_items},
+        "upstream_slots": {endpoint: limiter.stats() for endpoint, limiter in upstream_slots.items()},
+        "admission": admission.stats(),
+        "model_router": model_router.stats(),
+        "jobs": job_queue.stats(),
+        "token_sizer": token_sizer.stats(),
+        "single_flight": {
+            "analyze": analyze_flight.stats(),
+            "chat": chat_flight.stats(),
+            "meal_plan": meal_plan_flight.stats()
+        }
+    }
+
+def cache_samples():
+    """Numeric leaves of cache_stats() as (component, stat) gauge samples"""
+    samples = []
+    for component, stats in cache_stats().items():
+        for name, value in (stats or {}).items():
+            if isinstance(value, dict):
+                samples.extend(((f"{component}.{name}", key), v) for key, v in value.items()
+                               if isinstance(v, (int, float)) and not isinstance(v, bool))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                samples.append(((component, name), value))
+    return samples
+
+registry.collector("cache_stat", "Result cache, coalescing and index counters from /cache/stats",
+                   ["component", "stat"], cache_samples)
+registry.collector(
+    "upstream_circuit_open", "1 while the endpoint's circuit breaker is refusing upstream calls", ["operation"],
+    lambda: [((endpoint,), int(policy.breaker.state != CircuitBreaker.CLOSED)) for endpoint, policy in upstream_policies.items()],
+)
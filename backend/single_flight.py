@@ -0,0 +1,79 @@
+import asyncio
+import copy
+import hashlib
+import json
+
+from errors import ServiceError
+
+
+def flight_key(payload):
+    """Stable key for a JSON-serializable request payload"""
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into one.
+
+    The first caller for a key (the leader) runs the call; callers arriving
+    while it is in flight (followers) wait for the leader's result or
+    exception instead of issuing their own. Followers give up with a 504
+    after `follower_timeout` seconds so a hung leader cannot hold them forever.
+    """
+
+    def __init__(self, follower_timeout=180):
+        self.follower_timeout = follower_timeout
+        self._calls = {}
+
+        self.leaders = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    async def do(self, key, factory, follower=None):
+        """Return `await factory()`, sharing one in-flight call per key.
+
+        A follower's copy of the result is passed through `follower`, if given,
+        e.g. to mark it as answered without a call of its own.
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.follower_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise ServiceError("Timed out waiting for an identical request in progress", status=504)
+            # Each follower gets its own copy, as if it had made the call itself
+            result = copy.deepcopy(result)
+            return follower(result) if follower else result
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.leaders += 1
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            self.failures += 1
+            future.set_exception(ServiceError("Identical request in progress was cancelled", status=503))
+            future.exception()  # Mark retrieved so an unobserved failure is not logged
+            raise
+        except Exception as e:
+            self.failures += 1
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+        }
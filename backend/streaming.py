@@ -0,0 +1,54 @@
+import json
+import re
+
+ACTION_TAG = re.compile(r"\[ACTION:(\w+)\]")
+ACTION_TAG_PREFIX = "[ACTION:"
+
+
+def sse_event(event, payload):
+    """Encode one Server-Sent Event with a JSON payload"""
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def find_action(text):
+    """Name of the first [ACTION:...] tag in a reply, or None"""
+    match = ACTION_TAG.search(text or "")
+    return match.group(1) if match else None
+
+
+class ActionTagFilter:
+    """Strips [ACTION:...] tags out of a token stream.
+
+    Tags can arrive split across several chunks, so any trailing text that
+    could still become a tag is held back until it either completes or stops
+    matching. Detected action names are collected in `actions`.
+    """
+
+    def __init__(self):
+        self.actions = []
+        self._pending = ""
+
+    def feed(self, delta):
+        """Return the part of the stream so far that is safe to show"""
+        text = self._pending + delta
+        for match in ACTION_TAG.finditer(text):
+            self.actions.append(match.group(1))
+        text = ACTION_TAG.sub("", text)
+
+        start = text.rfind("[")
+        if start != -1:
+            tail = text[start:]
+            if ACTION_TAG_PREFIX.startswith(tail) or (
+                tail.startswith(ACTION_TAG_PREFIX) and re.fullmatch(r"\w*", tail[len(ACTION_TAG_PREFIX):])
+            ):
+                self._pending = tail
+                return text[:start]
+
+        self._pending = ""
+        return text
+
+    def flush(self):
+        """Release whatever was held back once the stream ends"""
+        text, self._pending = self._pending, ""
+        return text
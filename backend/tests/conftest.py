@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the job queue out of backend/data while tests import services
+os.environ.setdefault("JOB_DB", ":memory:")
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import services
+from admission import PriorityLimiter, RateLimiter
+from async_bridge import background_loop
+
+
+class BlockedCompletions:
+    """Upstream calls that hang until `gate` is set"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+
+    async def create(self, **kwargs):
+        while not self.gate.is_set():
+            await asyncio.sleep(0.01)
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        choice = SimpleNamespace(finish_reason="stop", message=SimpleNamespace(content="{}"))
+        return SimpleNamespace(id="x", model=kwargs["model"], usage=usage, choices=[choice])
+
+
+def test_saturated_endpoint_sheds_with_503(monkeypatch):
+    import app
+
+    completions = BlockedCompletions()
+    monkeypatch.setattr(services, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    monkeypatch.setitem(services.upstream_slots, "analyze", PriorityLimiter(2))
+    monkeypatch.setattr(services.admission, "max_queue", 4)
+
+    calls = [
+        asyncio.run_coroutine_threadsafe(
+            services.create_completion("analyze", model="test-model", messages=[{"role": "user", "content": str(n)}]),
+            background_loop(),
+        )
+        for n in range(8)
+    ]
+    try:
+        deadline = time.monotonic() + 5
+        while services.upstream_backlog() < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # The model budget has room; the calls are waiting on the endpoint's own cap
+        assert services.model_budget("test-model").waiting() == 0
+        assert services.upstream_backlog() == 6
+
+        response = app.app.test_client().post("/analyze", json={"description": "one boiled egg"})
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) >= 1
+    finally:
+        completions.gate.set()
+        for call in calls:
+            call.result(10)
+    assert services.upstream_backlog() == 0
+
+
+def test_user_header_is_only_trusted_behind_a_proxy(monkeypatch):
+    import app
+
+    monkeypatch.setattr(services.admission, "user_limiter", RateLimiter(rate=0.001, burst=1))
+    monkeypatch.setattr(services.admission, "ip_limiter", None)
+    client = app.app.test_client()
+
+    def submit(user):
+        return client.post("/jobs", json={}, headers={"X-User-Id": user}).status_code
+
+    # A client's own header is ignored: it neither gets a bucket nor spends one
+    monkeypatch.setattr(services, "TRUST_PROXY_HEADERS", False)
+    assert submit("alice") != 429
+    assert submit("alice") != 429
+    assert services.admission.user_limiter.stats()["clients"] == 0
+
+    monkeypatch.setattr(services, "TRUST_PROXY_HEADERS", True)
+    assert submit("alice") != 429
+    assert submit("alice") == 429
+
+
+def test_backlog_can_be_read_while_models_are_added(monkeypatch):
+    monkeypatch.setattr(services, "model_budgets", {})
+    monkeypatch.setattr(services, "model_budget_items", ())
+    stop = threading.Event()
+
+    def add_models():
+        for n in range(500):
+            services.model_budget(f"model-{n}")
+        stop.set()
+
+    adder = threading.Thread(target=add_models)
+    adder.start()
+    try:
+        while not stop.is_set():
+            assert services.upstream_backlog() == 0
+            assert services.upstream_expected_wait() == 0.0
+    finally:
+        adder.join()
+    assert len(services.model_budget_items) == len(services.model_budgets)
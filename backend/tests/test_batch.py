@@ -0,0 +1,47 @@
+import pytest
+
+import services
+from errors import ServiceError
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None), ("", None), (3, 3), ("3", 3), (0, 1), (-5, 1), (10_000, services.MAX_BATCH_ITEMS),
+])
+def test_parallelism_is_clamped(value, expected):
+    assert services.parse_batch_parallelism({"parallelism": value}) == expected
+
+
+@pytest.mark.parametrize("value", ["fast", "2.5", 2.5, True, [2], {"n": 2}])
+def test_invalid_parallelism_is_a_client_error(value):
+    with pytest.raises(ServiceError) as error:
+        services.parse_batch_parallelism({"parallelism": value})
+    assert error.value.status == 400
+
+
+def test_invalid_parallelism_returns_400():
+    from starlette.testclient import TestClient
+
+    import app
+    import asgi
+
+    body = {"items": [{"description": "one boiled egg"}], "parallelism": "fast"}
+    response = app.app.test_client().post("/analyze/batch", json=body)
+    assert response.status_code == 400
+    assert "parallelism" in response.get_json()["error"]
+
+    response = TestClient(asgi.app).post("/analyze/batch", json=body)
+    assert response.status_code == 400
+    assert "parallelism" in response.json()["error"]
+
+
+@pytest.mark.parametrize("description", [42, ["rice"], {"name": "rice"}])
+def test_non_text_description_fails_only_its_item(description):
+    items = services.parse_batch_items({"items": [{"description": description}, {"image": "x", "description": description},
+                                                  {"description": "one boiled egg"}]})
+    assert [item.get("error") for _, item in items] == ["description must be text", "description must be text", None]
+
+
+def test_non_text_meal_is_a_client_error():
+    with pytest.raises(ServiceError) as error:
+        services.parse_batch_items({"meal": 42})
+    assert error.value.status == 400
@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import services
+
+
+class FakeCompletions:
+    def __init__(self, content, finish_reason):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        choice = SimpleNamespace(finish_reason=self.finish_reason, message=SimpleNamespace(content=self.content))
+        return SimpleNamespace(id="x", model=kwargs["model"], usage=usage, choices=[choice])
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    def install(content, finish_reason):
+        completions = FakeCompletions(content, finish_reason)
+        monkeypatch.setattr(services, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+        return completions
+    return install
+
+
+def ask(question):
+    return asyncio.run(services.complete_chat(services.build_chat_messages([{"role": "user", "content": question}])))
+
+
+@pytest.mark.parametrize("content, finish_reason", [
+    ("Oats are a good source of fibre and", "length"),
+    ("", "stop"),
+    (None, "stop"),
+])
+def test_incomplete_answers_are_not_cached(fake_chat, content, finish_reason):
+    completions = fake_chat(content, finish_reason)
+    question = f"are oats healthy {finish_reason} {content is None}"
+    assert ask(question)["cached"] is False
+    assert ask(question)["cached"] is False
+    assert completions.calls == 2
+
+
+def test_complete_answers_are_cached(fake_chat):
+    completions = fake_chat("Yes, oats are a good source of fibre.", "stop")
+    assert ask("are rolled oats healthy")["cached"] is False
+    assert ask("are rolled oats healthy")["cached"] is True
+    assert completions.calls == 1
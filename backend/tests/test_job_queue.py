@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from job_queue import QUEUED, RUNNING, SUCCEEDED, JobQueue
+
+
+def test_two_processes_never_claim_the_same_job(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    first, second = JobQueue(db, workers=0), JobQueue(db, workers=0)
+    for queue in (first, second):
+        queue.register("echo", lambda payload: payload)
+    with first._lock, first._transaction():
+        for n in range(20):
+            first._db.execute(
+                "INSERT INTO jobs (id, kind, request_key, priority, status, payload, created_at) "
+                "VALUES (?, 'echo', ?, 0, ?, '{}', ?)", (str(n), str(n), QUEUED, time.time()),
+            )
+
+    claimed = []
+    while True:
+        jobs = [queue._claim() for queue in (first, second)]
+        if not any(jobs):
+            break
+        claimed += [job[0] for job in jobs if job]
+    assert sorted(claimed, key=int) == [str(n) for n in range(20)]
+
+
+def test_restart_requeues_only_expired_leases(tmp_path):
+    db = str(tmp_path / "jobs.sqlite3")
+    queue = JobQueue(db, workers=0, lease=60)
+    queue.register("echo", lambda payload: payload)
+    now = time.time()
+    with queue._lock, queue._transaction():
+        for job_id, lease_until in (("alive", now + 60), ("dead", now - 1), ("old", None)):
+            queue._db.execute(
+                "INSERT INTO jobs (id, kind, request_key, priority, status, payload, created_at, owner, lease_until) "
+                "VALUES (?, 'echo', ?, 0, ?, '{}', ?, 'other', ?)", (job_id, job_id, RUNNING, now, lease_until),
+            )
+
+    restarted = JobQueue(db, workers=0)
+    assert restarted.requeued == 2
+    assert restarted.get("alive")["status"] == RUNNING
+    assert restarted.get("dead")["status"] == QUEUED
+    assert restarted.get("old")["status"] == QUEUED
+
+
+def test_worker_renews_its_lease_and_finishes(tmp_path):
+    async def run():
+        queue = JobQueue(str(tmp_path / "jobs.sqlite3"), workers=1, lease=0.3)
+
+        async def slow(payload):
+            await asyncio.sleep(0.5)
+            return payload
+
+        queue.register("slow", slow)
+        job = await queue.submit("slow", {"n": 1})
+        await asyncio.sleep(0.4)
+        # Past the first lease, but renewed by the heartbeat
+        assert queue._requeue_expired() == 0
+        done = await queue.wait(job["id"], timeout=2)
+        await queue.stop()
+        return done
+
+    done = asyncio.run(run())
+    assert done["status"] == SUCCEEDED
+    assert done["result"] == {"n": 1}
@@ -0,0 +1,15 @@
+import pytest
+
+from meal_plan_cache import DEFAULT_PROFILE, profile_bucket, quantize
+
+
+@pytest.mark.parametrize("value, expected", [(2049, 2000), (2050, 2100), ("1830", 1800), (None, 2000), ("lots", 2000)])
+def test_quantize(value, expected):
+    assert quantize(value, 100, 2000) == expected
+
+
+@pytest.mark.parametrize("value", ["inf", "-inf", "nan", float("inf"), float("nan")])
+def test_non_finite_goal_falls_back_to_the_default(value):
+    bucket = profile_bucket({"daily_calorie_goal": value, "daily_fats_goal": value})
+    assert bucket["daily_calorie_goal"] == DEFAULT_PROFILE["daily_calorie_goal"]
+    assert bucket["daily_fats_goal"] == 70
@@ -0,0 +1,17 @@
+import pytest
+
+import services
+from errors import ServiceError
+from meal_plan_cache import meal_plan_key, profile_bucket
+
+
+def test_longest_range_has_no_repeated_day():
+    _, dates, _ = services.parse_meal_plan_range({"start_date": "2026-10-01", "days": services.MEAL_PLAN_MAX_RANGE_DAYS})
+    bucket = profile_bucket({}, "en")
+    assert len({meal_plan_key(bucket, date, services.MEAL_PLAN_VARIANTS) for date in dates}) == len(dates)
+
+
+def test_range_longer_than_the_rotation_is_rejected():
+    with pytest.raises(ServiceError) as error:
+        services.parse_meal_plan_range({"start_date": "2026-10-01", "days": services.MEAL_PLAN_VARIANTS + 1})
+    assert error.value.status == 400
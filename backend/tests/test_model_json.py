@@ -0,0 +1,53 @@
+import pytest
+
+from model_json import extract_json, to_int, validate_analysis, validate_meal_plan
+
+
+def test_bracketed_preamble_is_skipped_for_an_object():
+    text = 'Here is the estimate [per 100g]:\n{"name": "Nasi lemak", "calories": 607}'
+    assert extract_json(text, dict) == ({"name": "Nasi lemak", "calories": 607}, False)
+    assert extract_json(text) == ({"name": "Nasi lemak", "calories": 607}, False)
+
+
+def test_fenced_reply_with_trailing_text():
+    text = 'Sure!\n```json\n{"name": "Roti canai", "calories": 301}\n```\nEnjoy [1].'
+    assert extract_json(text, dict) == ({"name": "Roti canai", "calories": 301}, False)
+
+
+def test_list_when_expected():
+    assert extract_json('Meals: [{"name": "a"}]', list) == ([{"name": "a"}], False)
+
+
+def test_repairs_comments_trailing_commas_and_units():
+    text = '{"name": "Laksa", // main dish\n "calories": 607kcal, "protein": 20,}'
+    value, repaired = extract_json(text, dict)
+    assert repaired
+    assert value == {"name": "Laksa", "calories": "607kcal", "protein": 20}
+    assert validate_analysis(dict(value, carbs=70, fats=30))["calories"] == 607
+
+
+def test_repairs_a_cut_off_object_after_a_bracketed_preamble():
+    text = 'Estimate [per serving]:\n{"meals": [{"name": "Oats", "nutrition": {"calories": 300}}, {"name": "Ric'
+    value, repaired = extract_json(text, dict)
+    assert repaired
+    plan = validate_meal_plan(value)
+    assert [meal["name"] for meal in plan["meals"]] == ["Oats"]
+    assert plan["total_nutrition"]["calories"] == 300
+
+
+def test_nothing_to_salvage():
+    with pytest.raises(ValueError):
+        extract_json("I cannot identify this food [sorry].", dict)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (607, 607), (12.6, 13), ("12.6 g", 13), ("1,200 mg", 1200), ("none", None), (True, None),
+    (float("inf"), None), (float("nan"), None), ("9" * 400, None),
+])
+def test_to_int(value, expected):
+    assert to_int(value) == expected
+
+
+def test_non_finite_numbers_make_the_analysis_invalid():
+    value, _ = extract_json('{"name": "Rice", "calories": Infinity, "protein": NaN, "carbs": 40, "fats": 1}', dict)
+    assert validate_analysis(value) is None
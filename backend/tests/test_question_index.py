@@ -0,0 +1,51 @@
+import pytest
+
+from question_index import QuestionIndex, content_words
+
+
+def add(index, question, value):
+    index.add(index.signature(question), "en", content_words(question), value)
+
+
+def lookup(index, question):
+    return index.lookup(index.signature(question), "en", content_words(question))
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Is brown rice bad for people with type 2 diabetes?", "is brown rice bad for people with type 2 diabetes"),
+    ("is rice bad for diabetes", "rice bad for diabetes?"),
+    ("What should I eat to lose weight?", "What should I eat if I want to lose weight"),
+    ("Is rice bad for diabetes", "Is rice bad for people with diabetes"),
+    ("Is rice bad for people with diabetes", "Is rice bad for diabetes"),
+])
+def test_rephrased_question_matches(stored, asked):
+    index = QuestionIndex()
+    add(index, stored, "answer")
+    match = lookup(index, asked)
+    assert match is not None and match.value == "answer"
+
+
+def test_question_about_another_food_does_not_match():
+    index = QuestionIndex()
+    add(index, "is brown rice bad for people with type 2 diabetes", "brown")
+    assert lookup(index, "is white rice bad for people with type 2 diabetes") is None
+    assert lookup(index, "is brown rice bad for people with type 1 diabetes") is None
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("is rice bad for diabetes", "is rice not bad for diabetes"),
+    ("is rice bad for diabetes", "is rice bad for diabetes and cholesterol"),
+    ("is rice worse than bread for diabetes", "is bread worse than rice for diabetes"),
+])
+def test_question_with_another_meaning_does_not_match(stored, asked):
+    index = QuestionIndex()
+    add(index, stored, "answer")
+    assert lookup(index, asked) is None
+
+
+def test_chinese_question_about_another_food_does_not_match():
+    index = QuestionIndex()
+    add(index, "糖尿病人可以吃糙米吗", "brown")
+    assert lookup(index, "糖尿病人可以吃糙米吗？") is not None
+    assert lookup(index, "糖尿病能吃糙米吗") is not None
+    assert lookup(index, "糖尿病人可以吃白米吗") is None
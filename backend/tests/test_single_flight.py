@@ -0,0 +1,30 @@
+import asyncio
+
+import services
+
+
+async def concurrently(factory, count=3):
+    return await asyncio.gather(*(factory() for _ in range(count)))
+
+
+def test_coalesced_image_analysis_is_reported_as_cached(monkeypatch):
+    async def analyze_uncached_image(image_bytes, cache_key, additional_context="", lang="en"):
+        await asyncio.sleep(0.05)
+        return {"name": "Rice"}, False, {"resized": True}
+
+    monkeypatch.setattr(services, "analyze_uncached_image", analyze_uncached_image)
+    results = asyncio.run(concurrently(lambda: services.analyze_image_bytes(b"coalesced image")))
+    assert results[0] == ({"name": "Rice"}, False, {"resized": True})
+    assert results[1:] == [({"name": "Rice"}, True, None)] * 2
+
+
+def test_coalesced_text_analysis_is_reported_as_cached(monkeypatch):
+    async def analyze_text_with_ernie(description, lang="en"):
+        await asyncio.sleep(0.05)
+        return {"name": description}
+
+    monkeypatch.setattr(services, "analyze_text_with_ernie", analyze_text_with_ernie)
+    monkeypatch.setattr(services, "LABEL_PARSER_ENABLED", False)
+    monkeypatch.setattr(services, "food_db", None)
+    results = asyncio.run(concurrently(lambda: services.analyze_description("a coalesced dish")))
+    assert [result["cached"] for result in results] == [False, True, True]
@@ -0,0 +1,52 @@
+import asyncio
+
+from admission import PriorityLimiter
+from upstream_policy import UpstreamPolicy
+
+
+def hedging_policy():
+    policy = UpstreamPolicy("test", deadline=5, hedge=True)
+    for _ in range(policy.latency.min_samples):
+        policy.latency.add(0.01)
+    return policy
+
+
+def reserve_from(limiter):
+    def reserve():
+        if not limiter.try_acquire():
+            return None
+        return limiter.release
+    return reserve
+
+
+def run_slow_call(limiter, holders):
+    policy = hedging_policy()
+    attempts = []
+
+    async def attempt():
+        attempts.append(limiter.active)
+        await asyncio.sleep(0.1 if len(attempts) == 1 else 0.01)
+        return len(attempts)
+
+    async def call():
+        for _ in range(holders):
+            await limiter.acquire(0)
+        return await policy.call(attempt, reserve_hedge=reserve_from(limiter))
+
+    return policy, asyncio.run(call()), attempts
+
+
+def test_hedge_takes_a_free_slot_and_gives_it_back():
+    limiter = PriorityLimiter(2)
+    policy, result, attempts = run_slow_call(limiter, holders=1)
+    assert policy.hedges == 1 and policy.hedge_wins == 1
+    assert attempts == [1, 2]
+    assert limiter.active == 1
+
+
+def test_hedge_is_skipped_when_no_slot_is_free():
+    limiter = PriorityLimiter(1)
+    policy, result, attempts = run_slow_call(limiter, holders=1)
+    assert policy.hedges == 0 and policy.hedges_skipped == 1
+    assert attempts == [1]
+    assert limiter.active == 1
@@ -0,0 +1,29 @@
+from errors import ServiceError
+
+
+class UploadTooLarge(ServiceError):
+    """Raised when an upload exceeds the configured size limit"""
+
+    def __init__(self, limit):
+        super().__init__(f"Image exceeds the {limit} byte upload limit", status=413)
+        self.limit = limit
+
+
+def read_bounded(stream, limit, declared_length=None, chunk_size=64 * 1024):
+    """Read a binary upload stream into memory, failing as soon as it passes `limit` bytes.
+
+    `declared_length` (the Content-Length, if any) lets oversized uploads be
+    rejected before a single byte is read.
+    """
+    if declared_length is not None and declared_length > limit:
+        raise UploadTooLarge(limit)
+
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if len(buffer) + len(chunk) > limit:
+            raise UploadTooLarge(limit)
+        buffer += chunk
+    return buffer
@@ -0,0 +1,351 @@
+"""Deadlines, retries, hedging and circuit breaking for upstream completions.
+
+Every non-streamed call to the chat completions API goes through an
+UpstreamPolicy for its endpoint. The policy bounds the whole call by a
+deadline, retries transient failures with full-jitter backoff while the
+retry budget allows, optionally hedges slow attempts with a second one, and
+stops calling an upstream that keeps failing until it has had time to recover.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import openai
+
+from errors import ServiceError
+
+
+class UpstreamUnavailable(ServiceError):
+    """The upstream failed, timed out or is switched off by the circuit breaker"""
+
+    def __init__(self, message, status=503):
+        super().__init__(message, status)
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+    def __init__(self, message):
+        super().__init__(message, status=504)
+
+
+class AttemptTimeout(Exception):
+    """One attempt ran past its own timeout (the call may still retry)"""
+
+
+def retryable(error):
+    """Transient failures worth another attempt: timeouts, dropped connections, 429s and 5xx"""
+    if isinstance(error, (AttemptTimeout, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class LatencyTracker:
+    """Latencies of the last `window` successful attempts, for the hedging delay"""
+
+    def __init__(self, window=512, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._sorted = None
+
+    def quantile(self, q):
+        """The q-quantile of recent latencies, or None until there are enough of them"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * q))]
+
+
+class RetryBudget:
+    """Caps retries and hedges at a fraction of recent calls.
+
+    Each call deposits `ratio` tokens and each retry or hedge spends one, so
+    during an outage the extra load is at most `ratio` of normal traffic
+    instead of multiplying it. `min_per_second` tokens trickle in regardless,
+    so a quiet endpoint can still retry now and then.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=0.5, max_tokens=20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.spent = 0
+        self.exhausted = 0
+
+    def _refill(self, amount=0.0):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + amount + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                self.exhausted += 1
+                return False
+            self._tokens -= 1
+            self.spent += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {"tokens": round(self._tokens, 2), "spent": self.spent, "exhausted": self.exhausted}
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream whose recent calls mostly failed.
+
+    Outcomes are counted per call, after its retries, so an upstream that is
+    flaky but recovers on retry does not trip it. Closed: calls go through,
+    and once at least `min_calls` calls in the last `window` seconds have a
+    failure ratio of `failure_ratio` or more, the circuit opens. Open: calls
+    fail at once for `open_seconds`. Half-open: one probe call goes through;
+    its success closes the circuit and its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_ratio=0.5, min_calls=10, window=30, open_seconds=30):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+
+        self.state = self.CLOSED
+        self._outcomes = deque()  # (time, ok)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+
+            self._outcomes.append((now, ok))
+            self._failures += not ok
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                _, old_ok = self._outcomes.popleft()
+                self._failures -= not old_ok
+            if len(self._outcomes) >= self.min_calls and self._failures >= self.failure_ratio * len(self._outcomes):
+                self._open(now)
+
+    def release(self):
+        """An allowed call ended without an outcome (it was cancelled)"""
+        with self._lock:
+            self._probing = False
+
+    def _open(self, now):
+        # Caller holds the lock
+        self.state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "opened": self.opened, "rejected": self.rejected}
+
+
+class UpstreamPolicy:
+    """Runs upstream attempts for one endpoint within a deadline.
+
+    `attempt` is a zero-argument coroutine function making one upstream call.
+    Each attempt is cut off after `attempt_timeout` seconds and the whole call
+    after `deadline` seconds. Transient failures are retried up to `attempts`
+    times in total, after a full-jitter exponential backoff, as long as the
+    retry budget has tokens left. With `hedge` set, an attempt still running
+    after the observed p95 latency gets a twin, and whichever answers first
+    wins; use it only for idempotent calls. The twin needs capacity of its
+    own: `call()` takes a `reserve_hedge` function that claims it without
+    waiting and returns a function releasing it, or None when there is none
+    free, in which case the attempt is not hedged.
+    """
+
+    def __init__(self, name, deadline=120, attempt_timeout=None, attempts=3, backoff=0.5, backoff_cap=8,
+                 hedge=False, hedge_quantile=0.95, budget=None, breaker=None):
+        self.name = name
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self.deadline_exceeded = 0
+
+    async def call(self, attempt, reserve_hedge=None):
+        """Return the first successful result of `attempt()`, or raise UpstreamUnavailable"""
+        if not self.breaker.allow():
+            raise CircuitOpen(f"The {self.name} service is temporarily unavailable, please try again shortly")
+        self.calls += 1
+        self.budget.deposit()
+        try:
+            result = await self._call(attempt, reserve_hedge)
+        except UpstreamUnavailable:
+            self.breaker.record(False)
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            # Errors the upstream answered with (bad requests) say nothing about its health
+            self.breaker.record(True)
+            raise
+        self.breaker.record(True)
+        return result
+
+    async def _call(self, attempt, reserve_hedge=None):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        error = None
+
+        for number in range(1, self.attempts + 1):
+            try:
+                run = self._hedged(attempt, reserve_hedge) if self.hedge else self._attempt(attempt)
+                return await asyncio.wait_for(run, deadline - loop.time())
+            except TimeoutError:
+                self.deadline_exceeded += 1
+                raise UpstreamTimeout(f"The {self.name} service did not answer within {self.deadline:g}s")
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                error = e
+
+            if number == self.attempts:
+                break
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** (number - 1)))
+            if loop.time() + delay >= deadline or not self.budget.withdraw():
+                break
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+        raise UpstreamUnavailable(f"The {self.name} service failed: {error}") from error
+
+    def hedge_delay(self):
+        return self.latency.quantile(self.hedge_quantile)
+
+    async def _attempt(self, attempt):
+        started = time.perf_counter()
+        if self.attempt_timeout:
+            try:
+                result = await asyncio.wait_for(attempt(), self.attempt_timeout)
+            except TimeoutError:
+                raise AttemptTimeout(f"no answer within {self.attempt_timeout:g}s") from None
+        else:
+            result = await attempt()
+        self.latency.add(time.perf_counter() - started)
+        return result
+
+    async def _hedged(self, attempt, reserve_hedge=None):
+        tasks = [asyncio.ensure_future(self._attempt(attempt))]
+        try:
+            delay = self.hedge_delay()
+            if delay is None:
+                return await tasks[0]
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return await tasks[0]
+            release = reserve_hedge() if reserve_hedge else (lambda: None)
+            if release is None:
+                self.hedges_skipped += 1
+                return await tasks[0]
+            if not self.budget.withdraw():
+                release()
+                return await tasks[0]
+
+            self.hedges += 1
+            tasks.append(asyncio.ensure_future(self._attempt(attempt)))
+            # A callback rather than a finally, so the capacity comes back even if the task never starts
+            tasks[1].add_done_callback(lambda _: release())
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Both failed; report the original attempt's error
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {
+            "deadline": self.deadline,
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "hedge_delay": round(self.hedge_delay(), 3) if self.hedge and self.hedge_delay() is not None else None,
+            "deadline_exceeded": self.deadline_exceeded,
+            "budget": self.budget.stats(),
+            "breaker": self.breaker.stats(),
+        }